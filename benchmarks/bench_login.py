@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+    Login path benchmark
+    ====================
+
+    Runs the authenticate -> callback and authorize -> callback flows of a
+    MicropubClient against local stand-in servers for the user's homepage,
+    authorization endpoint and token endpoint, and reports throughput,
+    p50/p99 latency, allocations and outbound requests per login.
+
+    Usage::
+
+        python benchmarks/bench_login.py --flows 500 --concurrency 8 \\
+            --latency 20 --page-size 200000
+
+    Any MICROPUB_* setting can be overridden to compare configurations,
+    e.g. ``--config MICROPUB_DISCOVERY_CACHE_SIZE=0``. Values are parsed as
+    JSON when possible (so ``0``, ``true`` and ``"x"`` work), and used as
+    strings otherwise.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    sys.exit('the benchmark requires Python 3.7+')
+
+import flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import flask_micropub  # noqa: E402
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Serves user homepages under /user/<n>, plus an authorization
+    endpoint at /auth and a token endpoint at /token, adding a fixed
+    latency to every response and counting the requests it receives.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency, page_size, link_header):
+        ThreadingHTTPServer.__init__(
+            self, ('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.page_size = page_size
+        self.link_header = link_header
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # clients close streamed discovery responses early on purpose
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def count(self, method, path):
+        with self.lock:
+            self.counts[method + ' ' + path] += 1
+
+    def homepage(self):
+        links = ''.join(
+            '<link rel="{}" href="{}/{}">\n'.format(rel, self.base_url, path)
+            for rel, path in (('authorization_endpoint', 'auth'),
+                              ('token_endpoint', 'token'),
+                              ('micropub', 'micropub')))
+        head = '<!DOCTYPE html>\n<html><head><title>home</title>\n'
+        if not self.link_header:
+            head += links
+        head += '</head><body>\n'
+        filler = '<p>' + 'lorem ipsum dolor sit amet ' * 3 + '</p>\n'
+        body = filler * max(1, (self.page_size - len(head)) // len(filler))
+        return (head + body + '</body></html>\n').encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        server = self.server
+        path = urlsplit(self.path).path
+        server.count(self.command, path.split('/')[1])
+        time.sleep(server.latency)
+        if not path.startswith('/user/'):
+            return self.respond(404, b'not found', 'text/plain')
+        headers = {}
+        if server.link_header:
+            headers['Link'] = ', '.join(
+                '<{}/{}>; rel="{}"'.format(server.base_url, path, rel)
+                for rel, path in (('authorization_endpoint', 'auth'),
+                                  ('token_endpoint', 'token'),
+                                  ('micropub', 'micropub')))
+        self.respond(200, server.homepage(), 'text/html; charset=utf-8',
+                     headers, body)
+
+    def do_POST(self):
+        server = self.server
+        path = urlsplit(self.path).path
+        server.count('POST', path.strip('/'))
+        length = int(self.headers.get('Content-Length') or 0)
+        data = parse_qs(self.rfile.read(length).decode('utf-8'))
+        time.sleep(server.latency)
+        me = data.get('me', [server.base_url + '/user/0'])[0]
+        if path == '/auth':
+            payload = {'me': me}
+        elif path == '/token':
+            payload = {'me': me, 'access_token': 'token-' + data['code'][0],
+                       'scope': 'create'}
+        else:
+            return self.respond(404, b'not found', 'text/plain')
+        self.respond(200, json.dumps(payload).encode('utf-8'),
+                     'application/json')
+
+    def respond(self, status, content, content_type, headers=None,
+                body=True):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+
+def make_app(config):
+    app = flask.Flask('bench')
+    app.config['SECRET_KEY'] = 'benchmark'
+    app.config['SERVER_NAME'] = 'client.example'
+    app.config.update(config)
+    micropub = flask_micropub.MicropubClient(app, client_id='bench')
+
+    @app.route('/authenticate')
+    def authenticate():
+        return micropub.authenticate(flask.request.args['me'], state='s')
+
+    @app.route('/authorize')
+    def authorize():
+        return micropub.authorize(
+            flask.request.args['me'], state='s', scope='create')
+
+    @app.route('/authenticated')
+    @micropub.authenticated_handler
+    def authenticated(resp):
+        return resp.error or resp.me
+
+    @app.route('/authorized')
+    @micropub.authorized_handler
+    def authorized(resp):
+        return resp.error or resp.access_token
+
+    return app
+
+
+def run_flow(test_client, flow, me, n):
+    """One login: start it, then come back to the callback the way the
+    authorization endpoint would have sent the user.
+    """
+    start = test_client.get('/' + flow, query_string={'me': me})
+    if start.status_code != 302:
+        raise RuntimeError('{} returned {}'.format(flow, start.status_code))
+    query = parse_qs(urlsplit(start.headers['Location']).query)
+    callback = {'authenticate': '/authenticated',
+                'authorize': '/authorized'}[flow]
+    resp = test_client.get(callback, query_string={
+        'code': 'code{}'.format(n), 'state': query['state'][0], 'me': me})
+    if resp.status_code != 200:
+        raise RuntimeError('callback returned {}'.format(resp.status_code))
+    return resp.get_data(as_text=True)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run(app, server, flow, flows, concurrency, users):
+    server.counts.clear()
+    clients = threading.local()
+
+    def one(n):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        me = '{}/user/{}'.format(server.base_url, n % users)
+        started = time.perf_counter()
+        run_flow(clients.client, flow, me, n)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(executor.map(one, range(flows)))
+    wall = time.perf_counter() - started
+
+    # allocations are measured in a separate, single-threaded pass,
+    # since tracemalloc slows everything down
+    tracemalloc.start()
+    test_client = app.test_client()
+    before = tracemalloc.take_snapshot()
+    samples = min(flows, 50)
+    for n in range(samples):
+        run_flow(test_client, flow, '{}/user/{}'.format(
+            server.base_url, (flows + n) % users), flows + n)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in
+                    after.compare_to(before, 'filename') if stat.size_diff > 0)
+
+    total = flows + samples
+    return collections.OrderedDict([
+        ('flow', flow),
+        ('flows', flows),
+        ('concurrency', concurrency),
+        ('throughput', flows / wall),
+        ('p50_ms', percentile(latencies, 50) * 1000),
+        ('p99_ms', percentile(latencies, 99) * 1000),
+        ('mean_ms', sum(latencies) / len(latencies) * 1000),
+        ('alloc_bytes_per_flow', allocated / float(samples)),
+        ('peak_traced_bytes', peak),
+        ('outbound_per_flow', collections.OrderedDict(
+            (key, value / float(total))
+            for key, value in sorted(server.counts.items()))),
+    ])
+
+
+def parse_config(pairs):
+    config = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--flow', choices=['authenticate', 'authorize', 'both'],
+                        default='both')
+    parser.add_argument('--flows', type=int, default=200,
+                        help='logins to run per flow')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='logins in flight at once')
+    parser.add_argument('--users', type=int, default=50,
+                        help='distinct homepages to log in as')
+    parser.add_argument('--latency', type=float, default=10,
+                        help='milliseconds added to every stand-in response')
+    parser.add_argument('--page-size', type=int, default=20000,
+                        help='size of each homepage in bytes')
+    parser.add_argument('--link-header', action='store_true',
+                        help='advertise endpoints in a Link header instead '
+                        'of in the page')
+    parser.add_argument('--config', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='override an app config setting')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    server = StandInServer(args.latency / 1000.0, args.page_size,
+                           args.link_header)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    app = make_app(parse_config(args.config))
+    flows = (['authenticate', 'authorize'] if args.flow == 'both'
+             else [args.flow])
+    results = [run(app, server, flow, args.flows, args.concurrency,
+                   args.users) for flow in flows]
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print('{flow}: {flows} logins, concurrency {concurrency}'.format(
+            **result))
+        print('  throughput  {:10.1f} logins/s'.format(result['throughput']))
+        print('  latency     p50 {:.1f} ms, p99 {:.1f} ms, mean {:.1f} ms'
+              .format(result['p50_ms'], result['p99_ms'], result['mean_ms']))
+        print('  allocations {:10.0f} bytes/login, peak {} bytes'.format(
+            result['alloc_bytes_per_flow'], result['peak_traced_bytes']))
+        print('  outbound    ' + ', '.join(
+            '{} {:.2f}'.format(key, value)
+            for key, value in result['outbound_per_flow'].items())
+            + ' per login')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    Discovery parser benchmark
+    ==========================
+
+    Scans synthetic homepages with each of the discovery parser backends
+    (html.parser, lxml, bs4) and reports pages per second and throughput,
+    after checking every backend against the conformance corpus in
+    tests/discovery_corpus.json. Backends whose library is not installed
+    are skipped.
+
+    Usage::
+
+        python benchmarks/bench_parsers.py --pages 200 --page-size 200000 \\
+            --position end
+
+    ``--position`` puts the endpoint links at the start of <head>, or at
+    the end of the page (where every byte has to be read).
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import flask_micropub  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(__file__), os.pardir, 'tests',
+                      'discovery_corpus.json')
+
+LINKS = ''.join(
+    '<link rel="{}" href="https://foo.bar/{}">\n'.format(rel, path)
+    for rel, path in (('authorization_endpoint', 'auth'),
+                      ('token_endpoint', 'token'),
+                      ('micropub', 'micropub')))
+
+
+def make_page(page_size, position):
+    head = '<!DOCTYPE html>\n<html><head><title>home</title>\n'
+    if position == 'head':
+        head += LINKS
+    head += '</head><body>\n'
+    filler = ('<p class="entry">' + 'lorem <a href="/x">ipsum</a> dolor '
+              * 3 + '</p>\n')
+    body = filler * max(1, (page_size - len(head)) // len(filler))
+    if position == 'end':
+        body += LINKS.replace('<link', '<a').replace('>\n', '>x</a>\n')
+    return (head + body + '</body></html>\n').encode('utf-8')
+
+
+def scan(parser, page, chunk_size):
+    scanner = flask_micropub.BodyLinkScanner(
+        {}, 'utf-8', base_url='https://foo.bar/', parser=parser)
+    if chunk_size:
+        for start in range(0, len(page), chunk_size):
+            if scanner.feed(page[start:start + chunk_size]):
+                break
+    else:
+        scanner.parse(page.decode('utf-8'))
+    return scanner.endpoints()
+
+
+def conforms(parser):
+    with io.open(CORPUS, encoding='utf-8') as f:
+        cases = json.load(f)
+    for case in cases:
+        scanner = flask_micropub.BodyLinkScanner(
+            {}, 'utf-8', base_url=case.get('url', 'https://foo.bar/'),
+            head_only=case.get('head_only', False), parser=parser)
+        scanner.parse(case['html'])
+        if list(scanner.endpoints()) != case['expected']:
+            return False
+    return True
+
+
+def run(parser, page, pages, chunk_size):
+    expected = ('https://foo.bar/auth', 'https://foo.bar/token',
+                'https://foo.bar/micropub')
+    if tuple(scan(parser, page, chunk_size)) != expected:
+        raise AssertionError('{} found the wrong endpoints'.format(parser))
+    started = time.perf_counter()
+    for _ in range(pages):
+        scan(parser, page, chunk_size)
+    elapsed = time.perf_counter() - started
+    return {
+        'parser': parser,
+        'pages': pages,
+        'page_bytes': len(page),
+        'pages_per_s': pages / elapsed,
+        'mb_per_s': pages * len(page) / elapsed / 1e6,
+        'conforms': conforms(parser),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--parser', action='append',
+                        choices=sorted(flask_micropub.LINK_PARSERS),
+                        help='backend to run (default: all installed)')
+    parser.add_argument('--pages', type=int, default=100,
+                        help='pages to scan per backend')
+    parser.add_argument('--page-size', type=int, default=50000,
+                        help='size of each page in bytes')
+    parser.add_argument('--position', choices=['head', 'end'],
+                        default='end', help='where the links are')
+    parser.add_argument('--chunk-size', type=int,
+                        default=flask_micropub.DISCOVERY_CHUNK_SIZE,
+                        help='feed the page in chunks of this size; 0 to '
+                        'parse it all at once')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    page = make_page(args.page_size, args.position)
+    results = []
+    for name in args.parser or sorted(flask_micropub.LINK_PARSERS):
+        try:
+            results.append(run(name, page, args.pages, args.chunk_size))
+        except ImportError as e:
+            print('skipping {}: {}'.format(name, e), file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in sorted(results, key=lambda r: -r['pages_per_s']):
+        print('{parser:12} {pages_per_s:10.1f} pages/s {mb_per_s:8.1f} MB/s'
+              '  corpus {0}'.format(
+                  'ok' if result['conforms'] else 'FAILED', **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,20 +8,50 @@
     an [Micropub](https://indiewebcamp.com/Micropub) access token.
 """
 
-import requests
-import bs4
+import click
 import flask
+import flask.cli
+import itsdangerous
+import calendar
+import codecs
+import collections
+import contextlib
+import copy
+import email.utils
 import functools
+import hashlib
+import hmac
+import inspect
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
 import uuid
-
-import sys
-if sys.version < '3':
-    from urlparse import parse_qs
-    from urllib import urlencode
-else:
-    from urllib.parse import urlencode, parse_qs
+import weakref
+from urllib.parse import urlencode, parse_qs, urljoin, urlsplit, urlunsplit
 
 DEFAULT_AUTH_URL = 'https://indieauth.com/auth'
+STATE_COOKIE_PREFIX = '_micropub_state_'
+
+logger = logging.getLogger(__name__)
+
+_signals = flask.signals.Namespace()
+
+#: Sent after every outbound call a MicropubClient makes (or, for
+#: discovery, answers from its cache), with the client as sender and an
+#: OutboundCall as the ``call`` keyword argument.
+outbound_call = _signals.signal('micropub-outbound-call')
+
+DISCOVERY_RELS = ('authorization_endpoint', 'token_endpoint', 'micropub')
+DISCOVERY_CHUNK_SIZE = 8192
+
+Endpoints = collections.namedtuple('Endpoints', [
+    'authorization_endpoint', 'token_endpoint', 'micropub_endpoint'])
+
+Callback = collections.namedtuple('Callback', [
+    'code', 'me', 'redirect_uri', 'wrapped_state', 'state', 'started'])
 
 
 class MicropubClient:
@@ -29,16 +59,72 @@ class MicropubClient:
     authentication and authorization.
     """
 
-    def __init__(self, app=None, client_id=None):
+    def __init__(self, app=None, client_id=None, discovery_cache=None,
+                 tracer=None, token_store=None):
         """Initialize the Micropub extension
 
         Args:
           app (flask.Flask, optional): the flask application to extend.
           client_id (string, optional): the IndieAuth client id, will be displayed
             when the user is asked to authorize this client.
+          discovery_cache (DiscoveryCache, optional): where discovered
+            endpoints are kept between requests. Defaults to an in-process
+            LRUDiscoveryCache; pass a shared backend to let several workers
+            reuse each other's discoveries.
+          tracer (opentelemetry.trace.Tracer, optional): if given, every
+            outbound call is recorded as a span. Anything with an
+            OpenTelemetry-style start_as_current_span method will do.
+          token_store (TokenStore, optional): where successful
+            authorizations are saved. Defaults to an SQLiteTokenStore if
+            MICROPUB_TOKEN_STORE_PATH is set, and to none otherwise.
         """
         self.app = app
         self.client_id = client_id
+        self.tracer = tracer
+        self._custom_discovery_cache = discovery_cache is not None
+        self.discovery_cache = discovery_cache
+        if discovery_cache is None:
+            self.discovery_cache = LRUDiscoveryCache()
+        self.discovery_cache_ttl = 300
+        self.discovery_cache_max_ttl = 3600
+        self._handler_endpoints = weakref.WeakKeyDictionary()
+        self.discovery_streaming = True
+        self.discovery_max_bytes = 1024 * 1024
+        self.discovery_head_only = False
+        self.discovery_head_first = False
+        self.discovery_parser = HTMLLinkParser
+        self.reuse_endpoints = True
+        self.verify_endpoints = False
+        self.stateless = False
+        self.state_max_age = 600
+        self.state_replay_cache = ReplayCache()
+        self.query_cache = LRUCache()
+        self.query_cache_ttl = 60
+        self.query_cache_max_ttl = 3600
+        self.query_refresh_ahead = 0.2
+        self._query_flights = SingleFlight()
+        self._discovery_flights = SingleFlight()
+        self.background_workers = 4
+        self.discovery_negative_ttl = 30
+        self.breaker_failures = 5
+        self.breaker_reset_timeout = 30
+        self.circuit_breakers = LRUCache(10000)
+        self.me = None
+        self.token_endpoint = None
+        self.token_cache = LRUCache()
+        self.token_cache_ttl = 300
+        self._token_flights = SingleFlight()
+        self._custom_token_store = token_store is not None
+        self.token_store = token_store
+        self.prefetch_limiter = RateLimiter(5, 20)
+        self._prefetches = set()
+        self._prefetch_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.timeout = (5, 10)
+        self._session = None
+        self._session_options = {}
+        self._session_lock = threading.Lock()
         if app is not None:
             self.init_app(app, client_id)
 
@@ -58,6 +144,141 @@ class MicropubClient:
             else:
                 self.client_id = app.name
 
+        app.extensions['micropub'] = self
+        app.cli.add_command(cli)
+
+        app.config.setdefault('MICROPUB_DISCOVERY_CACHE_SIZE', 1024)
+        app.config.setdefault('MICROPUB_DISCOVERY_CACHE_TTL', 300)
+        app.config.setdefault('MICROPUB_DISCOVERY_CACHE_MAX_TTL', 3600)
+
+        app.config.setdefault('MICROPUB_DISCOVERY_CACHE_PATH', None)
+
+        if not self._custom_discovery_cache:
+            size = app.config['MICROPUB_DISCOVERY_CACHE_SIZE']
+            path = app.config['MICROPUB_DISCOVERY_CACHE_PATH']
+            if not size:
+                self.discovery_cache = None
+            elif path:
+                self.discovery_cache = SQLiteDiscoveryCache(path, size)
+            else:
+                self.discovery_cache = LRUDiscoveryCache(size)
+        self.discovery_cache_ttl = app.config['MICROPUB_DISCOVERY_CACHE_TTL']
+        self.discovery_cache_max_ttl = \
+            app.config['MICROPUB_DISCOVERY_CACHE_MAX_TTL']
+
+        app.config.setdefault('MICROPUB_DISCOVERY_STREAMING', True)
+        app.config.setdefault('MICROPUB_DISCOVERY_MAX_BYTES', 1024 * 1024)
+        app.config.setdefault('MICROPUB_DISCOVERY_HEAD_ONLY', False)
+        app.config.setdefault('MICROPUB_DISCOVERY_HEAD_FIRST', False)
+        app.config.setdefault('MICROPUB_DISCOVERY_PARSER', 'html.parser')
+
+        self.discovery_streaming = app.config['MICROPUB_DISCOVERY_STREAMING']
+        self.discovery_max_bytes = app.config['MICROPUB_DISCOVERY_MAX_BYTES']
+        self.discovery_head_only = app.config['MICROPUB_DISCOVERY_HEAD_ONLY']
+        self.discovery_head_first = app.config['MICROPUB_DISCOVERY_HEAD_FIRST']
+        self.discovery_parser = link_parser(
+            app.config['MICROPUB_DISCOVERY_PARSER'])
+
+        app.config.setdefault('MICROPUB_REUSE_ENDPOINTS', True)
+        app.config.setdefault('MICROPUB_VERIFY_ENDPOINTS', False)
+
+        self.reuse_endpoints = app.config['MICROPUB_REUSE_ENDPOINTS']
+        self.verify_endpoints = app.config['MICROPUB_VERIFY_ENDPOINTS']
+
+        app.config.setdefault('MICROPUB_STATELESS', False)
+        app.config.setdefault('MICROPUB_STATE_MAX_AGE', 600)
+        app.config.setdefault('MICROPUB_STATE_REPLAY_CACHE_SIZE', 10000)
+
+        self.stateless = app.config['MICROPUB_STATELESS']
+        self.state_max_age = app.config['MICROPUB_STATE_MAX_AGE']
+        self.state_replay_cache = ReplayCache(
+            app.config['MICROPUB_STATE_REPLAY_CACHE_SIZE'])
+
+        app.config.setdefault('MICROPUB_QUERY_CACHE_SIZE', 1024)
+        app.config.setdefault('MICROPUB_QUERY_CACHE_TTL', 60)
+        app.config.setdefault('MICROPUB_QUERY_CACHE_MAX_TTL', 3600)
+        app.config.setdefault('MICROPUB_QUERY_REFRESH_AHEAD', 0.2)
+        app.config.setdefault('MICROPUB_BACKGROUND_WORKERS', 4)
+
+        size = app.config['MICROPUB_QUERY_CACHE_SIZE']
+        self.query_cache = LRUCache(size) if size else None
+        self.query_cache_ttl = app.config['MICROPUB_QUERY_CACHE_TTL']
+        self.query_cache_max_ttl = app.config['MICROPUB_QUERY_CACHE_MAX_TTL']
+        self.query_refresh_ahead = app.config['MICROPUB_QUERY_REFRESH_AHEAD']
+        self.background_workers = app.config['MICROPUB_BACKGROUND_WORKERS']
+
+        app.config.setdefault('MICROPUB_DISCOVERY_NEGATIVE_TTL', 30)
+        app.config.setdefault('MICROPUB_BREAKER_FAILURES', 5)
+        app.config.setdefault('MICROPUB_BREAKER_RESET_TIMEOUT', 30)
+
+        self.discovery_negative_ttl = \
+            app.config['MICROPUB_DISCOVERY_NEGATIVE_TTL']
+        self.breaker_failures = app.config['MICROPUB_BREAKER_FAILURES']
+        self.breaker_reset_timeout = \
+            app.config['MICROPUB_BREAKER_RESET_TIMEOUT']
+
+        app.config.setdefault('MICROPUB_PREFETCH_RATE', 5)
+        app.config.setdefault('MICROPUB_PREFETCH_BURST', 20)
+
+        self.prefetch_limiter = RateLimiter(
+            app.config['MICROPUB_PREFETCH_RATE'],
+            app.config['MICROPUB_PREFETCH_BURST'])
+
+        app.config.setdefault('MICROPUB_ME', None)
+        app.config.setdefault('MICROPUB_TOKEN_ENDPOINT', None)
+        app.config.setdefault('MICROPUB_TOKEN_CACHE_SIZE', 1024)
+        app.config.setdefault('MICROPUB_TOKEN_CACHE_TTL', 300)
+
+        self.me = app.config['MICROPUB_ME']
+        self.token_endpoint = app.config['MICROPUB_TOKEN_ENDPOINT']
+        size = app.config['MICROPUB_TOKEN_CACHE_SIZE']
+        self.token_cache = LRUCache(size) if size else None
+        self.token_cache_ttl = app.config['MICROPUB_TOKEN_CACHE_TTL']
+
+        app.config.setdefault('MICROPUB_TOKEN_STORE_PATH', None)
+        app.config.setdefault('MICROPUB_TOKEN_STORE_KEY', None)
+
+        if not self._custom_token_store:
+            path = app.config['MICROPUB_TOKEN_STORE_PATH']
+            self.token_store = None
+            if path:
+                self.token_store = SQLiteTokenStore(
+                    path, key=app.config['MICROPUB_TOKEN_STORE_KEY'])
+
+        app.config.setdefault('MICROPUB_POOL_CONNECTIONS', 10)
+        app.config.setdefault('MICROPUB_POOL_MAXSIZE', 10)
+        app.config.setdefault('MICROPUB_CONNECT_TIMEOUT', 5)
+        app.config.setdefault('MICROPUB_READ_TIMEOUT', 10)
+        app.config.setdefault('MICROPUB_MAX_RETRIES', 2)
+        app.config.setdefault('MICROPUB_RETRY_BACKOFF', 0.3)
+
+        self.timeout = (app.config['MICROPUB_CONNECT_TIMEOUT'],
+                        app.config['MICROPUB_READ_TIMEOUT'])
+        self._session_options = dict(
+            pool_connections=app.config['MICROPUB_POOL_CONNECTIONS'],
+            pool_maxsize=app.config['MICROPUB_POOL_MAXSIZE'],
+            max_retries=app.config['MICROPUB_MAX_RETRIES'],
+            backoff_factor=app.config['MICROPUB_RETRY_BACKOFF'])
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    @property
+    def session(self):
+        """The pooled requests.Session for outbound calls. It is made on
+        first use, so that requests is only imported by processes that
+        actually call out.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = make_session(**self._session_options)
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
     def authenticate(self, me, state=None, next_url=None):
         """Authenticate a user via IndieAuth.
 
@@ -75,7 +296,7 @@ class MicropubClient:
           https://indieauth.com/auth if none is provided.
         """
         redirect_url = flask.url_for(
-            self.flask_endpoint_for_function(self._authenticated_handler),
+            self._handler_endpoint(self._authenticated_handler),
             _external=True)
         return self._start_indieauth(me, redirect_url, state or next_url, None)
 
@@ -98,7 +319,7 @@ class MicropubClient:
           https://indieauth.com/auth if none is provided.
         """
         redirect_url = flask.url_for(
-            self.flask_endpoint_for_function(self._authorized_handler),
+            self._handler_endpoint(self._authorized_handler),
             _external=True)
         return self._start_indieauth(
             me, redirect_url, state or next_url, scope)
@@ -119,24 +340,58 @@ class MicropubClient:
 
         Returns:
           a redirect to the user's specified authorization
-          https://indieauth.com/auth if none is provided.
+          https://indieauth.com/auth if none is provided. If the user's
+          homepage could not be fetched, a redirect straight back to
+          redirect_url, whose handler gets an 'endpoint_unavailable' error.
         """
 
         if not me.startswith('http://') and not me.startswith('https://'):
             me = 'http://' + me
-        auth_url, token_url, micropub_url = self._discover_endpoints(me)
-        if not auth_url:
-            auth_url = DEFAULT_AUTH_URL
+        return self._redirect_to_auth(
+            me, self.discover(me), redirect_url, state, scope)
+
+    def _redirect_to_auth(self, me, discovered, redirect_url, state, scope):
+        endpoints = discovered.endpoints
+        auth_url = endpoints.authorization_endpoint or DEFAULT_AUTH_URL
 
         csrf_token = uuid.uuid4().hex
-        flask.session['_micropub_csrf_token'] = csrf_token
+        # remember what was discovered, so the callback need not discover
+        # it all over again
+        started = None
+        if discovered.error:
+            # no authorization endpoint could fetch the homepage either, so
+            # fail at once: go straight back to the callback with the error
+            started = {'me': normalize_me(me), 'error': discovered.error}
+        elif self.reuse_endpoints:
+            started = {
+                'me': normalize_me(me),
+                'endpoints': list(endpoints),
+            }
+
+        if self.stateless:
+            wrapped_state = self._state_serializer().dumps(
+                {'n': csrf_token, 's': state, 'd': started})
+        else:
+            flask.session['_micropub_csrf_token'] = csrf_token
+            # replace (or drop) whatever an earlier login left behind
+            if started:
+                flask.session['_micropub_endpoints'] = started
+            else:
+                flask.session.pop('_micropub_endpoints', None)
+            wrapped_state = '{}|{}'.format(csrf_token, state or '')
+
+        if discovered.error:
+            return self._state_cookie(flask.redirect(
+                redirect_url + '?' + urlencode({
+                    'me': me, 'state': wrapped_state})),
+                redirect_url, csrf_token)
 
         auth_params = {
             'me': me,
             'client_id': self.client_id,
             'redirect_uri': redirect_url,
             'response_type': 'code',
-            'state': '{}|{}'.format(csrf_token, state or ''),
+            'state': wrapped_state,
         }
         if scope:
             auth_params['scope'] = scope
@@ -144,7 +399,22 @@ class MicropubClient:
         auth_url = auth_url + '?' + urlencode(auth_params)
         flask.current_app.logger.debug('redirecting to %s', auth_url)
 
-        return flask.redirect(auth_url)
+        return self._state_cookie(
+            flask.redirect(auth_url), redirect_url, csrf_token)
+
+    def _state_cookie(self, response, redirect_url, csrf_token):
+        """In stateless mode, tie the state token to the browser that
+        started the login with a short-lived cookie holding its nonce, so
+        that a state token made for someone else is useless (login CSRF).
+        Each login has a cookie of its own, so several can run at once.
+        """
+        if self.stateless:
+            response.set_cookie(
+                STATE_COOKIE_PREFIX + csrf_token[:8], csrf_token,
+                max_age=self.state_max_age, path=urlsplit(redirect_url).path,
+                secure=flask.request.is_secure, httponly=True,
+                samesite='Lax')
+        return response
 
     def authenticated_handler(self, f):
         """Decorates the authentication callback endpoint. The endpoint should
@@ -169,189 +439,3350 @@ class MicropubClient:
         return decorated
 
     def _handle_authenticate_response(self):
-        code = flask.request.args.get('code')
+        callback, error = self._read_callback()
+        if error:
+            return error
+
+        endpoints, error = self._callback_endpoints(callback)
+        if error:
+            return error
+
+        auth_url = endpoints.authorization_endpoint or DEFAULT_AUTH_URL
+        try:
+            with self._instrument('verify_code', 'POST', auth_url) as call, \
+                    self._circuit(auth_url) as guarded:
+                response = self.session.post(
+                    auth_url, data=self._verification_data(callback, auth_url),
+                    timeout=self.timeout)
+                call.responded(response)
+                guarded.record(response.status_code)
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return self._request_failed(callback, 'authorization', e)
+        return self._authenticate_result(callback, response)
+
+    def _handle_authorize_response(self):
+        callback, error = self._read_callback()
+        if error:
+            return error
+
+        endpoints, error = self._callback_endpoints(callback)
+        if error:
+            return error
+
+        token_url, micropub_url = endpoints[1:]
+        if not token_url or not micropub_url:
+            # successfully auth'ed user, no micropub endpoint
+            return AuthResponse(
+                me=callback.me,
+                state=callback.state,
+                error='no micropub endpoint found.',
+                error_code='no_micropub_endpoint')
+
+        try:
+            with self._instrument('token', 'POST', token_url) as call, \
+                    self._circuit(token_url) as guarded:
+                token_response = self.session.post(
+                    token_url,
+                    data=self._token_request_data(callback, token_url),
+                    timeout=self.timeout)
+                call.responded(token_response)
+                guarded.record(token_response.status_code)
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return self._request_failed(callback, 'token', e, me=callback.me)
+        return self._authorize_result(
+            callback, micropub_url, token_url, token_response)
+
+    def _read_callback(self):
+        """Read the redirect back from the authorization endpoint and check
+        its CSRF token.
+
+        Returns:
+          a (Callback, AuthResponse) pair; the AuthResponse describes the
+          error, and is None if the callback can go on to be verified.
+        """
         wrapped_state = flask.request.args.get('state')
-        me = flask.request.args.get('me')
-        redirect_uri = flask.url_for(flask.request.endpoint, _external=True)
+        callback = Callback(
+            code=flask.request.args.get('code'),
+            me=flask.request.args.get('me'),
+            redirect_uri=flask.url_for(flask.request.endpoint, _external=True),
+            wrapped_state=wrapped_state,
+            state=None,
+            started=None)
+
+        if self.stateless:
+            return self._read_signed_state(callback)
 
         if wrapped_state and '|' in wrapped_state:
             csrf_token, state = wrapped_state.split('|', 1)
         else:
             csrf_token = state = None
+        callback = callback._replace(
+            state=state, started=flask.session.get('_micropub_endpoints'))
 
         if not csrf_token:
-            return AuthResponse(
-                state=state, error='no CSRF token in response')
+            return callback, AuthResponse(
+                state=state, error='no CSRF token in response',
+                error_code='missing_csrf_token')
 
         if csrf_token != flask.session.get('_micropub_csrf_token'):
+            return callback, AuthResponse(
+                state=state, error='mismatched CSRF token',
+                error_code='mismatched_csrf_token')
+
+        return callback, None
+
+    def _read_signed_state(self, callback):
+        """Check a state token made in stateless mode: its signature, its
+        age, that it was made for this browser, and that it has not been
+        used before.
+        """
+        if not callback.wrapped_state:
+            return callback, AuthResponse(
+                error='no CSRF token in response',
+                error_code='missing_csrf_token')
+
+        try:
+            data, signed_at = self._state_serializer().loads(
+                callback.wrapped_state, max_age=self.state_max_age,
+                return_timestamp=True)
+        except itsdangerous.SignatureExpired:
+            return callback, AuthResponse(
+                error='expired state token', error_code='expired_state')
+        except itsdangerous.BadData:
+            return callback, AuthResponse(
+                error='mismatched CSRF token',
+                error_code='mismatched_csrf_token')
+
+        callback = callback._replace(state=data.get('s'), started=data.get('d'))
+        nonce = str(data.get('n') or '')
+        cookie = STATE_COOKIE_PREFIX + nonce[:8]
+        if not nonce or not hmac.compare_digest(
+                flask.request.cookies.get(cookie, ''), nonce):
+            return callback, AuthResponse(
+                state=callback.state, error='mismatched CSRF token',
+                error_code='mismatched_csrf_token')
+        path = urlsplit(callback.redirect_uri).path
+        flask.after_this_request(
+            lambda response: response.delete_cookie(cookie, path=path)
+            or response)
+        expires = calendar.timegm(signed_at.utctimetuple()) + self.state_max_age
+        if not self.state_replay_cache.add(data.get('n'), expires):
+            return callback, AuthResponse(
+                state=callback.state, error='state token already used',
+                error_code='replayed_state')
+        return callback, None
+
+    def _state_serializer(self):
+        return itsdangerous.URLSafeTimedSerializer(
+            flask.current_app.secret_key, salt='flask-micropub-state')
+
+    def _callback_endpoints(self, callback):
+        """The endpoints to finish the flow with: those discovered when it
+        started, if they were discovered for the same user URL the callback
+        is for, otherwise freshly discovered ones.
+
+        With MICROPUB_VERIFY_ENDPOINTS set, the endpoints are always
+        rediscovered (normally from the discovery cache), and the flow fails
+        if they no longer match the ones it started with.
+
+        Returns:
+          an (Endpoints, AuthResponse) pair; the AuthResponse describes an
+          error, and is None if the flow can continue.
+        """
+        error = self._started_error(callback)
+        if error:
+            return None, error
+        stored = self._stored_endpoints(callback)
+        if stored is not None and not self.verify_endpoints:
+            return stored, None
+        return self._checked_endpoints(
+            callback, stored, self.discover(callback.me))
+
+    @staticmethod
+    def _started_error(callback):
+        """The error of a flow whose discovery failed when it started."""
+        started = callback.started or {}
+        error = started.get('error')
+        if error and callback.me \
+                and started.get('me') == normalize_me(callback.me):
             return AuthResponse(
-                state=state, error='mismatched CSRF token')
+                state=callback.state,
+                error='could not discover endpoints: {}'.format(error),
+                error_code='endpoint_unavailable')
+        return None
 
-        auth_url = self._discover_endpoints(me)[0]
-        if not auth_url:
-            auth_url = DEFAULT_AUTH_URL
+    def _stored_endpoints(self, callback):
+        stored = callback.started
+        if (not self.reuse_endpoints or not stored or not callback.me
+                or stored.get('me') != normalize_me(callback.me)):
+            return None
+        return Endpoints(*stored['endpoints'])
+
+    @staticmethod
+    def _checked_endpoints(callback, stored, discovered):
+        if discovered.error:
+            return None, AuthResponse(
+                me=callback.me, state=callback.state,
+                error='could not discover endpoints: {}'.format(
+                    discovered.error),
+                error_code='endpoint_unavailable')
+        if stored is not None and stored != discovered.endpoints:
+            return discovered.endpoints, AuthResponse(
+                state=callback.state,
+                error='endpoints changed since authorization began',
+                error_code='endpoints_changed')
+        return discovered.endpoints, None
 
+    def _verification_data(self, callback, auth_url):
         # validate the authorization code
         auth_data = {
-            'code': code,
+            'code': callback.code,
             'client_id': self.client_id,
-            'redirect_uri': redirect_uri,
-            'state': wrapped_state,
+            'redirect_uri': callback.redirect_uri,
+            'state': callback.wrapped_state,
         }
         flask.current_app.logger.debug(
             'Flask-Micropub: checking code against auth url: %s, data: %s',
             auth_url, auth_data)
-        response = requests.post(auth_url, data=auth_data)
+        return auth_data
+
+    @staticmethod
+    def _request_failed(callback, endpoint, error, me=None):
+        return AuthResponse(me=me, state=callback.state,
+                            error=request_failure(endpoint, error),
+                            error_code='endpoint_unavailable')
+
+    def _authenticate_result(self, callback, response):
         flask.current_app.logger.debug(
             'Flask-Micropub: auth response: %d - %s', response.status_code,
             response.text)
 
-        try:
-            rdata = dict((k,[v]) for (k,v) in response.json().items())
-        except ValueError:
-            rdata = parse_qs(response.text)
+        rdata = parse_response_data(response)
         if response.status_code < 200 or response.status_code >= 300:
             error_vals = rdata.get('error')
             error_descs = rdata.get('error_description')
             return AuthResponse(
-                state=state,
+                state=callback.state,
                 error='authorization failed. {}: {}'.format(
                     error_vals[0] if error_vals else 'Unknown Error',
-                    error_descs[0] if error_descs else 'Unknown Error'))
+                    error_descs[0] if error_descs else 'Unknown Error'),
+                error_code='authorization_failed')
 
         if 'me' not in rdata:
             return AuthResponse(
-                state=state,
-                error='missing "me" in response')
+                state=callback.state,
+                error='missing "me" in response', error_code='missing_me')
 
         confirmed_me = rdata.get('me')[0]
-        return AuthResponse(me=confirmed_me, state=state)
-
-    def _handle_authorize_response(self):
-        code = flask.request.args.get('code')
-        wrapped_state = flask.request.args.get('state')
-        me = flask.request.args.get('me')
-        redirect_uri = flask.url_for(flask.request.endpoint, _external=True)
-
-        if wrapped_state and '|' in wrapped_state:
-            csrf_token, state = wrapped_state.split('|', 1)
-        else:
-            csrf_token = state = None
-
-        if not csrf_token:
-            return AuthResponse(
-                state=state, error='no CSRF token in response')
-
-        if csrf_token != flask.session.get('_micropub_csrf_token'):
-            return AuthResponse(
-                state=state, error='mismatched CSRF token')
-
-        token_url, micropub_url = self._discover_endpoints(me)[1:]
-
-        if not token_url or not micropub_url:
-            # successfully auth'ed user, no micropub endpoint
-            return AuthResponse(
-                me=me,
-                state=state,
-                error='no micropub endpoint found.')
+        return AuthResponse(me=confirmed_me, state=callback.state)
 
+    def _token_request_data(self, callback, token_url):
         # request an access token
         token_data = {
-            'code': code,
-            'me': me,
-            'redirect_uri': redirect_uri,
+            'code': callback.code,
+            'me': callback.me,
+            'redirect_uri': callback.redirect_uri,
             'client_id': self.client_id,
-            'state': wrapped_state,
+            'state': callback.wrapped_state,
             'grant_type': 'authorization_code',
         }
         flask.current_app.logger.debug(
             'Flask-Micropub: requesting access token from: %s, data: %s',
             token_url, token_data)
-        token_response = requests.post(token_url, data=token_data)
+        return token_data
+
+    def _authorize_result(self, callback, micropub_url, token_url,
+                          token_response):
+        # the body holds the access token, so it is not logged
         flask.current_app.logger.debug(
-            'Flask-Micropub: token response: %d - %s',
-            token_response.status_code, token_response.text)
+            'Flask-Micropub: token response: %d (%d bytes)',
+            token_response.status_code, len(token_response.content))
 
         if token_response.status_code < 200 or token_response.status_code >= 300:
             return AuthResponse(
-                me=me,
-                state=state,
+                me=callback.me,
+                state=callback.state,
                 error='bad response from token endpoint: {}'
-                .format(token_response))
+                .format(token_response), error_code='token_request_failed')
 
-        try:
-            tdata = dict((k,[v]) for (k,v) in token_response.json().items())
-        except ValueError:
-            tdata = parse_qs(token_response.text)
+        tdata = parse_response_data(token_response)
         if 'access_token' not in tdata:
             return AuthResponse(
-                me=me,
-                state=state,
+                me=callback.me,
+                state=callback.state,
                 error='response from token endpoint missing access_token: {}'
-                .format(tdata))
+                .format(tdata), error_code='missing_access_token')
 
         # success!
         access_token = tdata.get('access_token')[0]
         confirmed_me = tdata.get('me')[0]
         confirmed_scope = tdata.get('scope')[0]
-        return AuthResponse(
+        auth = AuthResponse(
             me=confirmed_me,
             micropub_endpoint=micropub_url,
             access_token=access_token,
             scope=confirmed_scope,
-            state=state)
+            state=callback.state,
+            refresh_token=tdata.get('refresh_token', [None])[0],
+            expires=token_expiry(tdata, time.time()),
+            token_endpoint=token_url)
+        if self.token_store is not None:
+            self.token_store.save(auth)
+        return auth
+
+    def discover(self, me):
+        """Find the authorization, token and micropub endpoints advertised
+        by a user's homepage, consulting the discovery cache first.
+
+        A fresh cache entry is returned without touching the network. A
+        stale entry that has an ETag or Last-Modified validator is
+        revalidated with a conditional GET, so an unchanged homepage costs
+        a 304 instead of a full download and parse.
+
+        The body of the page is only read when the HTTP Link header does
+        not advertise all three endpoints. With MICROPUB_DISCOVERY_HEAD_FIRST
+        set, a HEAD request is tried before the GET, so that sites which
+        advertise their endpoints in headers never send a body at all.
+        Relative endpoints are resolved against the URL the page was
+        finally fetched from, after redirects.
+
+        Args:
+          me (string): the user's URL.
+
+        Returns:
+          a DiscoveryResult
+        """
+        # concurrent discoveries of the same user share one fetch
+        return self._discovery_flights.do(
+            normalize_me(me), functools.partial(self._discover, me))
+
+    def _discover(self, me):
+        # instrumented here rather than in discover, so that a fetch
+        # shared by concurrent discoveries is only reported once
+        with self._instrument('discovery', 'GET', me) as call:
+            result = self._lookup_endpoints(me)
+            call.discovered(result)
+            return result
+
+    def _lookup_endpoints(self, me):
+        started = time.perf_counter()
+        key, entry, now = self._discovery_cache_lookup(me)
+        if entry and entry.expires > now:
+            return DiscoveryResult(me, entry.endpoints, cached=True,
+                                   error=entry.error,
+                                   elapsed=time.perf_counter() - started)
+        if entry and entry.error:
+            entry = None
+
+        try:
+            with self._circuit(me) as breaker:
+                result = self._fetch_endpoints(me, key, entry, now, started)
+                breaker.record(result.status_code)
+                return result
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return self._discovery_failed(me, key, now, started, e)
+
+    def _fetch_endpoints(self, me, key, entry, now, started):
+        headers = entry.conditional_headers() if entry else {}
+        if self.discovery_head_first:
+            try:
+                head_response = self.session.head(
+                    me, headers=headers, timeout=self.timeout,
+                    allow_redirects=True)
+            except self._transport_errors:
+                # some servers reset or time out on HEAD; the GET may
+                # still work
+                head_response = None
+            if head_response is not None \
+                    and head_response.status_code < 400:
+                endpoints = self._endpoints_from_headers(
+                    key, entry, head_response, now)
+                if endpoints:
+                    return self._discovery_result(
+                        me, endpoints, head_response, started)
+
+        # always stream, so that the body is left unread (and the
+        # response closed) when the Link header is enough
+        me_response = self.session.get(
+            me, headers=headers, timeout=self.timeout, stream=True)
+        try:
+            endpoints = self._endpoints_from_headers(
+                key, entry, me_response, now)
+            if endpoints:
+                return self._discovery_result(
+                    me, endpoints, me_response, started)
+
+            scanner = self._body_scanner(me_response)
+            if self.discovery_streaming:
+                for chunk in me_response.iter_content(DISCOVERY_CHUNK_SIZE):
+                    if scanner.feed(chunk):
+                        break
+            else:
+                scanner.parse(me_response.text)
+            endpoints = scanner.endpoints()
+            self._cache_endpoints(key, endpoints, me_response, now)
+            return self._discovery_result(
+                me, endpoints, me_response, started, scanner.bytes_read)
+        finally:
+            me_response.close()
 
     def _discover_endpoints(self, me):
-        me_response = requests.get(me)
+        return self.discover(me).endpoints
+
+    def prewarm(self, me_urls, max_workers=16):
+        """Discover the endpoints of many users at once, e.g. right after a
+        deploy, so that their next logins are answered from the discovery
+        cache. Users whose cache entries are still fresh cost nothing.
+
+        Args:
+          me_urls (iterable): the users' URLs.
+          max_workers (int, optional): discoveries in flight at once.
+
+        Returns:
+          a list of DiscoveryResults, in the same order as me_urls. A
+          discovery that failed has its error set instead of raising.
+        """
+        import concurrent.futures
+
+        me_urls = list(me_urls)
+        if not me_urls:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(
+                min(max_workers, len(me_urls)),
+                thread_name_prefix='flask-micropub-prewarm') as executor:
+            return list(executor.map(self._prewarm_one, me_urls))
+
+    def prefetch(self, me):
+        """Start discovering a user's endpoints in the background, without
+        waiting for the result, e.g. while they are still filling in the
+        login form. When they submit it, authenticate or authorize finds
+        the endpoints in the discovery cache, or joins the discovery still
+        in flight.
+
+        Nothing is started for a user whose endpoints are already cached,
+        or are already being prefetched, or when more prefetches have been
+        asked for than MICROPUB_PREFETCH_RATE per second (in bursts of up
+        to MICROPUB_PREFETCH_BURST).
+
+        Args:
+          me (string): the user's URL, as typed.
+
+        Returns:
+          'started' if a discovery was started; otherwise why not:
+          'invalid', 'cached', 'pending' or 'limited'.
+        """
+        me = prewarm_url(me)
+        if len(me) > 2048 or len(me.split()) != 1 \
+                or not urlsplit(me).hostname:
+            return 'invalid'
+        key, entry, now = self._discovery_cache_lookup(me)
+        if entry and entry.expires > now:
+            return 'cached'
+        with self._prefetch_lock:
+            if key in self._prefetches:
+                return 'pending'
+            if not self.prefetch_limiter.allow():
+                return 'limited'
+            self._prefetches.add(key)
+        self._spawn(self._prefetch, key, me)
+        return 'started'
+
+    def _prefetch(self, key, me):
+        try:
+            self.discover(me)
+        finally:
+            with self._prefetch_lock:
+                self._prefetches.discard(key)
+
+    def prefetch_blueprint(self, name='micropub_prefetch', url_prefix=None):
+        """A blueprint with a single route, POST /prefetch, that calls
+        prefetch with the me form field, for a login form to hit when the
+        user leaves its URL field. It answers 202 when the prefetch was
+        started or is not needed, 400 for an invalid URL and 429 when
+        prefetches are being rate limited.
+
+        Args:
+          name (string, optional): the blueprint's name.
+          url_prefix (string, optional): where to mount the route.
+
+        Returns:
+          a flask.Blueprint, to register on the app.
+        """
+        blueprint = flask.Blueprint(name, __name__, url_prefix=url_prefix)
+
+        @blueprint.route('/prefetch', methods=['POST'])
+        def prefetch():
+            status = self.prefetch(flask.request.values.get('me', ''))
+            code = {'invalid': 400, 'limited': 429}.get(status, 202)
+            return flask.jsonify(prefetch=status), code
+
+        return blueprint
+
+    def _prewarm_one(self, me):
+        me = prewarm_url(me)
+        try:
+            return self.discover(me)
+        except Exception as e:
+            return DiscoveryResult(me, (None, None, None), exception=e,
+                                   error=str(e) or e.__class__.__name__)
+
+    def _discovery_cache_lookup(self, me):
+        key = normalize_me(me)
+        entry = None
+        if self.discovery_cache is not None:
+            entry = self.discovery_cache.get(key)
+        return key, entry, time.time()
+
+    def _endpoints_from_headers(self, key, entry, me_response, now):
+        """Settle discovery from the status and headers of a response, when
+        that is possible without reading the body: a 304 confirming a
+        cached entry, an error status, or a Link header advertising every
+        endpoint.
+
+        Returns:
+          an Endpoints tuple, or None if the body needs to be read.
+        """
+        if me_response.status_code == 304 and entry:
+            self._cache_endpoints(
+                key, entry.endpoints, me_response, now, previous=entry)
+            return entry.endpoints
         if me_response.status_code < 200 or me_response.status_code >= 300:
-            return None, None, None
+            self._cache_failure(
+                key, now, 'HTTP {}'.format(me_response.status_code))
+            return Endpoints(None, None, None)
+
+        links = header_links(me_response)
+        if len(links) == len(DISCOVERY_RELS):
+            endpoints = Endpoints(*(links[rel] for rel in DISCOVERY_RELS))
+            self._cache_endpoints(key, endpoints, me_response, now)
+            return endpoints
+
+    def _body_scanner(self, me_response):
+        return BodyLinkScanner(
+            header_links(me_response), response_charset(me_response),
+            base_url=response_url(me_response),
+            head_only=self.discovery_head_only,
+            max_bytes=self.discovery_max_bytes,
+            parser=self.discovery_parser)
+
+    @staticmethod
+    def _discovery_result(me, endpoints, me_response, started, bytes_read=0):
+        status_code = me_response.status_code
+        error = None
+        if status_code != 304 and (status_code < 200 or status_code >= 300):
+            error = 'HTTP {}'.format(status_code)
+        return DiscoveryResult(
+            me, endpoints, url=response_url(me_response),
+            status_code=status_code, cached=status_code == 304,
+            error=error, bytes_read=bytes_read,
+            elapsed=time.perf_counter() - started)
+
+    def _discovery_failed(self, me, key, now, started, exception):
+        error = str(exception) or exception.__class__.__name__
+        self._cache_failure(key, now, error)
+        return DiscoveryResult(me, (None, None, None), error=error,
+                               exception=exception,
+                               elapsed=time.perf_counter() - started)
+
+    def _cache_failure(self, key, now, error):
+        """Remember for a little while that discovery failed, so that a
+        dead homepage is not fetched again on every retry.
+        """
+        if self.discovery_cache is None or not self.discovery_negative_ttl:
+            return
+        self.discovery_cache.set(key, DiscoveryCacheEntry(
+            (None, None, None), expires=now + self.discovery_negative_ttl,
+            fetched=now, error=error))
+
+    @property
+    def _transport_errors(self):
+        """The exceptions the HTTP client raises when a request fails."""
+        import requests
+
+        return (requests.RequestException,)
+
+    @contextlib.contextmanager
+    def _circuit(self, url):
+        """Guard a call to url's host with that host's circuit breaker.
+
+        Raises CircuitOpenError straight away while the breaker is open.
+        Otherwise the call counts as a failure if it raises (or is
+        cancelled) or records a 5xx status, and as a success if not.
+        """
+        host = urlsplit(url).hostname
+        breaker = None
+        if self.breaker_failures and self.circuit_breakers is not None:
+            breaker = self.circuit_breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    self.breaker_failures, self.breaker_reset_timeout)
+                self.circuit_breakers.set(host, breaker)
+            if not breaker.allow():
+                raise CircuitOpenError(host, breaker.retry_at)
+
+        call = _GuardedCall()
+        try:
+            yield call
+        except BaseException:
+            # including cancellation, which must not leave a trial call
+            # outstanding forever
+            if breaker is not None:
+                breaker.failed()
+            raise
+        if breaker is not None:
+            if call.status_code is not None and call.status_code >= 500:
+                breaker.failed()
+            else:
+                breaker.succeeded()
+
+    def _cache_endpoints(self, key, endpoints, me_response, now,
+                         previous=None):
+        if self.discovery_cache is None:
+            return
+        expires = cache_expiry(me_response.headers, now,
+                               self.discovery_cache_ttl,
+                               self.discovery_cache_max_ttl)
+        if expires is None:
+            self.discovery_cache.delete(key)
+            return
+        # a 304 need not repeat the validators of the response it confirms
+        etag = me_response.headers.get('ETag') or (previous and previous.etag)
+        last_modified = (me_response.headers.get('Last-Modified')
+                         or (previous and previous.last_modified))
+        self.discovery_cache.set(key, DiscoveryCacheEntry(
+            endpoints, expires=expires, etag=etag,
+            last_modified=last_modified, fetched=now))
+
+    def _cached_query(self, session, params):
+        key = (session.auth.micropub_endpoint,
+               token_key(session.auth.access_token),
+               tuple(sorted(params.items())))
+        entry = None
+        if self.query_cache is not None:
+            entry = self.query_cache.get(key)
+        now = time.time()
+        if entry and entry.expires > now:
+            if now >= entry.refresh_at and key not in self._query_flights:
+                self._spawn(self._query_flights.do, key, functools.partial(
+                    self._refresh_query, key, session, params))
+            return entry.value
+        return self._query_flights.do(key, functools.partial(
+            self._refresh_query, key, session, params))
+
+    def _refresh_query(self, key, session, params):
+        response = session._query(params)
+        now = time.time()
+        value = response.json()
+        expires = cache_expiry(response.headers, now, self.query_cache_ttl,
+                               self.query_cache_max_ttl)
+        if self.query_cache is not None and expires is not None:
+            refresh_at = expires - (expires - now) * self.query_refresh_ahead
+            self.query_cache.set(key, QueryCacheEntry(
+                value, expires, refresh_at))
+        return value
+
+    def _spawn(self, func, *args):
+        """Run func in the client's pool of background threads."""
+        import concurrent.futures
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.background_workers,
+                    thread_name_prefix='flask-micropub')
+        return self._executor.submit(func, *args)
+
+    def refresh(self, auth, scope=None):
+        """Exchange the refresh token of an AuthResponse for a new access
+        token, without sending the user through authorization again.
+
+        Args:
+          auth (AuthResponse): from a successful authorization (or an
+            earlier refresh) whose token endpoint issued a refresh token.
+          scope (string, optional): ask for a narrower scope.
+
+        Returns:
+          an AuthResponse with the new access token, expiry and (if the
+          token endpoint rotated it) refresh token. If the refresh failed,
+          auth itself with error and error_code set, so that its tokens
+          are not lost.
+        """
+        if not auth.refresh_token:
+            return self._refresh_error(auth, 'no_refresh_token')
+        token_url = auth.token_endpoint
+        if not token_url and auth.me:
+            token_url = self._discover_endpoints(auth.me).token_endpoint
+        if not token_url:
+            return self._refresh_error(auth, 'no_token_endpoint')
+        try:
+            with self._instrument('refresh', 'POST', token_url) as call, \
+                    self._circuit(token_url) as guarded:
+                response = self.session.post(
+                    token_url, data=self._refresh_data(auth, scope),
+                    timeout=self.timeout)
+                call.responded(response)
+                guarded.record(response.status_code)
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return auth.replace(error=request_failure('token', e),
+                                error_code='endpoint_unavailable')
+        return self._refresh_result(auth, token_url, response)
+
+    def refresh_batch(self, auths, max_workers=8, max_per_host=2):
+        """Refresh many tokens concurrently, with at most max_workers
+        requests in flight, and at most max_per_host to any one token
+        endpoint.
+
+        Args:
+          auths (iterable): AuthResponses, as for refresh.
+          max_workers (int, optional): requests in flight at once.
+          max_per_host (int, optional): requests in flight per host.
+
+        Returns:
+          a list of AuthResponses, in the same order as auths.
+        """
+        def refresh(auth):
+            try:
+                return self.refresh(auth)
+            except Exception as e:
+                return auth.replace(error=str(e), error_code='refresh_failed')
+
+        return self._run_per_host(
+            [(urlsplit(auth.token_endpoint or auth.me or '').hostname,
+              functools.partial(refresh, auth)) for auth in auths],
+            max_workers, max_per_host)
+
+    def _refresh_data(self, auth, scope):
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': auth.refresh_token,
+            'client_id': self.client_id,
+        }
+        if scope:
+            data['scope'] = scope
+        return data
 
-        auth_endpoint = me_response.links.get('authorization_endpoint', {}).get('url')
-        token_endpoint = me_response.links.get('token_endpoint', {}).get('url')
-        micropub_endpoint = me_response.links.get('micropub', {}).get('url')
+    @staticmethod
+    def _refresh_error(auth, error_code):
+        return auth.replace(error={
+            'no_refresh_token': 'no refresh token',
+            'no_token_endpoint': 'no token endpoint found',
+        }[error_code], error_code=error_code)
+
+    @staticmethod
+    def _refresh_result(auth, token_url, response):
+        rdata = parse_response_data(response)
+        if response.status_code < 200 or response.status_code >= 300:
+            return auth.replace(
+                error='refresh failed. {}: {}'.format(
+                    (rdata.get('error') or ['Unknown Error'])[0],
+                    (rdata.get('error_description') or ['Unknown Error'])[0]),
+                error_code='refresh_failed')
+        if 'access_token' not in rdata:
+            return auth.replace(
+                error='response from token endpoint missing access_token',
+                error_code='missing_access_token')
+        return auth.replace(
+            access_token=rdata['access_token'][0],
+            refresh_token=rdata.get('refresh_token', [auth.refresh_token])[0],
+            scope=rdata.get('scope', [auth.scope])[0],
+            expires=token_expiry(rdata, time.time()),
+            token_endpoint=token_url, error=None, error_code=None)
+
+    @staticmethod
+    def _run_per_host(jobs, max_workers, max_per_host):
+        """Call the functions of (host, func) jobs on a pool of threads,
+        at most max_workers at once and max_per_host for any one host,
+        each host's jobs in the order given. The functions should not
+        raise.
+
+        Returns:
+          the functions' return values, in the order of jobs.
+        """
+        import concurrent.futures
+
+        queues = collections.OrderedDict()
+        count = 0
+        for index, (host, func) in enumerate(jobs):
+            queues.setdefault(host, collections.deque()).append((index, func))
+            count = index + 1
+        results = [None] * count
+        in_flight = collections.Counter()
+        # hosts with jobs waiting and a free slot, each at most once, so
+        # scheduling costs the same per job however many hosts there are
+        ready = collections.deque(queues)
+        done = collections.deque()
+        finished = threading.Condition()
+
+        def run(host, index, func):
+            try:
+                results[index] = func()
+            finally:
+                with finished:
+                    done.append(host)
+                    finished.notify()
+
+        remaining = count
+        total = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            with finished:
+                while remaining:
+                    while ready and total < max_workers:
+                        host = ready.popleft()
+                        queue = queues[host]
+                        in_flight[host] += 1
+                        total += 1
+                        executor.submit(run, host, *queue.popleft())
+                        if queue and in_flight[host] < max_per_host:
+                            ready.append(host)
+                    while not done:
+                        finished.wait()
+                    while done:
+                        host = done.popleft()
+                        remaining -= 1
+                        total -= 1
+                        in_flight[host] -= 1
+                        # a host that was full has a free slot again
+                        if (queues[host]
+                                and in_flight[host] == max_per_host - 1):
+                            ready.append(host)
+        return results
+
+    def publisher(self, auth):
+        """A MicropubSession for publishing with an AuthResponse, sharing
+        this client's connection pool.
+        """
+        return MicropubSession(auth, self)
+
+    def publish_batch(self, posts, max_workers=8, max_per_host=2):
+        """Publish many posts concurrently, possibly for many users.
+
+        At most max_workers requests are in flight at once, and at most
+        max_per_host of them to any one Micropub host, so one slow server
+        neither holds up the others nor gets flooded. Posts to the same
+        host are sent in the order given.
+
+        Args:
+          posts (iterable): (AuthResponse, post) pairs, where post is a
+            request body as for MicropubSession.publish.
+          max_workers (int, optional): requests in flight at once.
+          max_per_host (int, optional): requests in flight per host.
+
+        Returns:
+          a list of PublishResults, in the same order as posts.
+        """
+        def publish(auth, post):
+            try:
+                return self.publisher(auth).publish(post)
+            except Exception as e:
+                return PublishResult(error=str(e))
+
+        return self._run_per_host(
+            [(urlsplit(auth.micropub_endpoint or '').hostname,
+              functools.partial(publish, auth, post))
+             for auth, post in posts],
+            max_workers, max_per_host)
+
+    def verify_token(self, token, me=None, token_endpoint=None):
+        """Check the bearer token an incoming Micropub request was made
+        with against the token endpoint that issued it.
+
+        Tokens that check out are cached, keyed by a hash of the token, for
+        MICROPUB_TOKEN_CACHE_TTL seconds (or until the token expires, if
+        sooner), so a client posting repeatedly costs one verification
+        request rather than one per post. Rejected tokens are never cached.
+
+        Args:
+          token (string): the access token.
+          me (string, optional): the URL of the site the request is for.
+            The token must have been issued to this user. Defaults to
+            MICROPUB_ME.
+          token_endpoint (string, optional): the token endpoint to verify
+            with. Defaults to MICROPUB_TOKEN_ENDPOINT, or else the one
+            discovered from me.
+
+        Returns:
+          a TokenInfo, whose error is set if the token is not valid.
+        """
+        me = me or self.me
+        token_endpoint = token_endpoint or self.token_endpoint
+        if token and not token_endpoint and me:
+            token_endpoint = self._discover_endpoints(me).token_endpoint
+        info = self._token_precheck(token, token_endpoint)
+        if info is None:
+            key = token_key(token)
+            info = self._cached_token(key, token_endpoint)
+            if info is None:
+                info = self._token_flights.do(
+                    (key, token_endpoint), functools.partial(
+                        self._verify_token, key, token, token_endpoint))
+        return self._check_token_owner(info, me)
+
+    def _verify_token(self, key, token, token_endpoint):
+        try:
+            with self._instrument('verify_token', 'GET',
+                                  token_endpoint) as call, \
+                    self._circuit(token_endpoint) as guarded:
+                response = self.session.get(
+                    token_endpoint, headers=self._bearer_headers(token),
+                    timeout=self.timeout)
+                call.responded(response)
+                guarded.record(response.status_code)
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return self._token_endpoint_failed(token_endpoint, e)
+        return self._token_result(key, token_endpoint, response)
+
+    def revoke_token(self, token, me=None, token_endpoint=None):
+        """Revoke a token at the token endpoint that issued it, and forget
+        any cached verification of it.
 
-        if not auth_endpoint or not token_endpoint or not micropub_endpoint:
-            soup = bs4.BeautifulSoup(me_response.text)
-            if not auth_endpoint:
-                auth_link = soup.find('link', {'rel': 'authorization_endpoint'})
-                auth_endpoint = auth_link and auth_link['href']
+        Args:
+          token (string): the access token.
+          me (string, optional): as for verify_token.
+          token_endpoint (string, optional): as for verify_token.
+
+        Returns:
+          True if the token endpoint accepted the revocation.
+        """
+        me = me or self.me
+        token_endpoint = token_endpoint or self.token_endpoint
+        if not token_endpoint and me:
+            token_endpoint = self._discover_endpoints(me).token_endpoint
+        try:
             if not token_endpoint:
-                token_link = soup.find('link', {'rel': 'token_endpoint'})
-                token_endpoint = token_link and token_link['href']
-            if not micropub_endpoint:
-                micropub_link = soup.find('link', {'rel': 'micropub'})
-                micropub_endpoint = micropub_link and micropub_link['href']
+                return False
+            with self._instrument('revoke_token', 'POST',
+                                  token_endpoint) as call, \
+                    self._circuit(token_endpoint) as guarded:
+                response = self.session.post(
+                    token_endpoint, data={'action': 'revoke', 'token': token},
+                    timeout=self.timeout)
+                call.responded(response)
+                guarded.record(response.status_code)
+            return 200 <= response.status_code < 300
+        except (CircuitOpenError,) + self._transport_errors:
+            return False
+        finally:
+            # after the request, so a verification racing with it cannot
+            # put the token back
+            self.invalidate_token(token)
+
+    def invalidate_token(self, token):
+        """Forget the cached verification of a token, e.g. when it has been
+        revoked by some other means. Only this process's cache is cleared.
+        """
+        if self.token_cache is not None:
+            self.token_cache.delete(token_key(token))
+
+    def token_required(self, scope=None, me=None):
+        """Decorates a Micropub endpoint so that it only runs for requests
+        with a valid bearer token, in the Authorization header or the
+        access_token form field. The verified TokenInfo is available to
+        the view as flask.g.micropub_token.
 
-        return auth_endpoint, token_endpoint, micropub_endpoint
+        Requests without a valid token get a JSON error response: 401 for a
+        missing or invalid token or one lacking the scope, 403 for a token
+        issued to another user, and 503 if the token endpoint cannot be
+        reached.
+
+        Args:
+          scope (string, optional): a scope the token must have.
+          me (string, optional): as for verify_token.
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def decorated(*args, **kwargs):
+                info = self.verify_token(request_token(), me)
+                error = self._token_error_response(info, scope)
+                if error is not None:
+                    return error
+                flask.g.micropub_token = info
+                return f(*args, **kwargs)
+            return decorated
+        return decorator
 
     @staticmethod
-    def flask_endpoint_for_function(func):
-        for endpt, view_func in flask.current_app.view_functions.items():
-            if func == view_func:
-                return endpt
+    def _bearer_headers(token):
+        return {'Authorization': 'Bearer ' + token,
+                'Accept': 'application/json'}
 
+    @staticmethod
+    def _token_precheck(token, token_endpoint):
+        if not token:
+            return TokenInfo(error='unauthorized',
+                             error_description='no access token')
+        if not token_endpoint:
+            return TokenInfo(
+                error='temporarily_unavailable',
+                error_description='no token endpoint to verify with')
+        return None
 
-class AuthResponse:
-    """Authorization response, passed to the authorized_handler endpoint.
+    def _cached_token(self, key, token_endpoint):
+        if self.token_cache is None:
+            return None
+        entry = self.token_cache.get(key)
+        if entry is None:
+            return None
+        info, cache_until = entry
+        if cache_until <= time.time() or info.token_endpoint != token_endpoint:
+            return None
+        info = copy.copy(info)
+        info.cached = True
+        return info
 
-    Attributes:
-      me (string): The authenticated user's URL. This will be non-None if and
-        only if the user was successfully authenticated.
-      micropub_endpoint (string): The endpoint to POST micropub requests to.
-      access_token (string): The authorized user's micropub access token.
-      state (string): The optional state that was passed to authorize.
-      scope (string): The scope that comes with the micropub access token
-      error (string): describes the error encountered if any. It is possible
-        that the authentication step will succeed but the access token step
-        will fail, in which case me will be non-None, and error will describe
-        this condition.
-    """
-    def __init__(self, me=None, micropub_endpoint=None,
-                 access_token=None, state=None, scope=None,
+    @staticmethod
+    def _token_endpoint_failed(token_endpoint, error):
+        if isinstance(error, CircuitOpenError):
+            description = 'token endpoint unavailable: {}'.format(error)
+        else:
+            description = 'request to token endpoint failed: {}'.format(
+                str(error) or error.__class__.__name__)
+        return TokenInfo(token_endpoint=token_endpoint,
+                         error='temporarily_unavailable',
+                         error_description=description)
+
+    def _token_result(self, key, token_endpoint, response):
+        rdata = parse_response_data(response)
+        me = rdata.get('me', [None])[0]
+        if response.status_code < 200 or response.status_code >= 300 \
+                or rdata.get('active') == [False] or not me:
+            if response.status_code >= 500:
+                return TokenInfo(
+                    token_endpoint=token_endpoint,
+                    error='temporarily_unavailable',
+                    error_description='bad response from token endpoint: '
+                    '{}'.format(response.status_code))
+            return TokenInfo(
+                token_endpoint=token_endpoint, error='unauthorized',
+                error_description=(rdata.get('error_description')
+                                   or ['invalid access token'])[0])
+
+        now = time.time()
+        expires = token_expiry(rdata, now)
+        if expires is not None and expires <= now:
+            return TokenInfo(token_endpoint=token_endpoint,
+                             error='unauthorized',
+                             error_description='access token has expired')
+
+        info = TokenInfo(
+            me=me, client_id=rdata.get('client_id', [None])[0],
+            scope=rdata.get('scope', [''])[0],
+            token_endpoint=token_endpoint, expires=expires)
+        if self.token_cache is not None and self.token_cache_ttl:
+            cache_until = now + self.token_cache_ttl
+            if expires is not None:
+                cache_until = min(cache_until, expires)
+            self.token_cache.set(key, (info, cache_until))
+        return info
+
+    @staticmethod
+    def _check_token_owner(info, me):
+        if info.error or not me or normalize_me(info.me) == normalize_me(me):
+            return info
+        return TokenInfo(
+            me=info.me, client_id=info.client_id, scope=info.scope,
+            token_endpoint=info.token_endpoint, expires=info.expires,
+            error='forbidden', error_description='token is for {}, not {}'
+            .format(info.me, me))
+
+    @staticmethod
+    def _token_error_response(info, scope):
+        error, description = info.error, info.error_description
+        if error is None:
+            if not scope or info.has_scope(scope):
+                return None
+            error = 'insufficient_scope'
+            description = 'access token lacks the {} scope'.format(scope)
+        status = {'forbidden': 403,
+                  'temporarily_unavailable': 503}.get(error, 401)
+        response = flask.jsonify(error=error, error_description=description)
+        response.status_code = status
+        if status == 401:
+            response.headers['WWW-Authenticate'] = 'Bearer'
+        return response
+
+    @contextlib.contextmanager
+    def _instrument(self, operation, method, url):
+        """Time an outbound call, then send the outbound_call signal and,
+        if a tracer was given, record it as a span.
+
+        Yields:
+          the OutboundCall being timed, for the caller to fill in with
+          what it learns from the response.
+        """
+        call = OutboundCall(operation, method, url)
+        span_context = None
+        if self.tracer is not None:
+            span_context = self.tracer.start_as_current_span(
+                'micropub.' + operation,
+                attributes={'http.method': method, 'http.url': url,
+                            'server.address': call.host})
+            span = span_context.__enter__()
+        started = time.perf_counter()
+        try:
+            yield call
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            call.duration = time.perf_counter() - started
+            outbound_call.send(self, call=call)
+            if span_context is not None:
+                for name, value in call.attributes().items():
+                    span.set_attribute(name, value)
+                if call.error is not None:
+                    span_context.__exit__(type(call.error), call.error,
+                                          call.error.__traceback__)
+                else:
+                    span_context.__exit__(None, None, None)
+
+    def _handler_endpoint(self, handler):
+        """The endpoint name of a decorated handler in the current app.
+
+        The view functions are only searched the first time a handler is
+        looked up in a given app; after that the name is remembered, and
+        just checked against app.view_functions in case the app has since
+        replaced the view.
+        """
+        app = flask.current_app._get_current_object()
+        endpoints = self._handler_endpoints.get(app)
+        if endpoints is None:
+            endpoints = self._handler_endpoints.setdefault(app, {})
+        endpoint = endpoints.get(handler)
+        if endpoint is None or app.view_functions.get(endpoint) is not handler:
+            endpoint = self.flask_endpoint_for_function(handler)
+            if endpoint is not None:
+                endpoints[handler] = endpoint
+        return endpoint
+
+    @staticmethod
+    def flask_endpoint_for_function(func):
+        for endpt, view_func in flask.current_app.view_functions.items():
+            if func == view_func:
+                return endpt
+
+
+class AsyncMicropubClient(MicropubClient):
+    """Flask-Micropub for ``async def`` views (Flask 2+, installed with the
+    ``async`` extra).
+
+    authenticate and authorize are coroutines, and the handlers decorated
+    with authenticated_handler and authorized_handler may be either plain
+    or ``async def`` functions. Outbound requests are made with a pooled
+    httpx.AsyncClient, so the worker thread is free while discovery and the
+    token exchange are in flight. CSRF handling, discovery caching and
+    response parsing are shared with MicropubClient.
+
+    httpx clients are bound to the event loop they were created on. Flask
+    runs each async view in a fresh event loop, so connections are pooled
+    within a request: authenticate, authorize, the decorated handlers and
+    token_required views close the view's client when they finish, and
+    other views that make calls should end with aclose(). Outside a
+    request, e.g. prewarm on an event loop of your own, the client is
+    kept and its connections reused until aclose().
+    """
+
+    def __init__(self, app=None, client_id=None, discovery_cache=None,
+                 tracer=None, transport=None, token_store=None):
+        """Initialize the Micropub extension
+
+        Args:
+          app (flask.Flask, optional): the flask application to extend.
+          client_id (string, optional): the IndieAuth client id.
+          discovery_cache (DiscoveryCache, optional): where discovered
+            endpoints are kept between requests.
+          tracer (opentelemetry.trace.Tracer, optional): records every
+            outbound call as a span.
+          transport (httpx.AsyncBaseTransport, optional): the transport the
+            httpx clients send requests through. By default a pooled
+            AsyncHTTPTransport configured from the MICROPUB_POOL_* and
+            MICROPUB_MAX_RETRIES settings.
+          token_store (TokenStore, optional): where successful
+            authorizations are saved.
+        """
+        self.transport = transport
+        self._async_sessions = weakref.WeakKeyDictionary()
+        self._async_discovery_flights = AsyncSingleFlight()
+        self._async_token_flights = AsyncSingleFlight()
+        self.max_connections = 100
+        self.max_keepalive_connections = 10
+        self.max_retries = 2
+        MicropubClient.__init__(self, app, client_id, discovery_cache, tracer,
+                                token_store)
+
+    def init_app(self, app, client_id=None):
+        MicropubClient.init_app(self, app, client_id)
+        self.max_connections = (app.config['MICROPUB_POOL_CONNECTIONS']
+                                * app.config['MICROPUB_POOL_MAXSIZE'])
+        self.max_keepalive_connections = app.config['MICROPUB_POOL_MAXSIZE']
+        self.max_retries = app.config['MICROPUB_MAX_RETRIES']
+
+    def _get_async_session(self):
+        """The httpx.AsyncClient for the running event loop, creating it
+        on first use.
+        """
+        import asyncio
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        session = self._async_sessions.get(loop)
+        if session is None:
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections)
+            transport = self.transport or httpx.AsyncHTTPTransport(
+                limits=limits, retries=self.max_retries)
+            session = httpx.AsyncClient(
+                transport=transport,
+                timeout=httpx.Timeout(self.timeout[1],
+                                      connect=self.timeout[0]))
+            self._async_sessions[loop] = session
+        return session
+
+    @property
+    def _transport_errors(self):
+        import httpx
+
+        return (httpx.HTTPError,)
+
+    async def aclose(self):
+        """Close the httpx client of the running event loop, if any."""
+        import asyncio
+
+        session = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.aclose()
+
+    async def _view_finished(self):
+        # Flask runs every async view on an event loop of its own, which
+        # is gone by the next request, so the view's httpx client cannot
+        # be reused: close it rather than leave its connections to the
+        # garbage collector
+        if flask.has_request_context():
+            await self.aclose()
+
+    async def authenticate(self, me, state=None, next_url=None):
+        """Authenticate a user via IndieAuth; see
+        MicropubClient.authenticate.
+        """
+        redirect_url = flask.url_for(
+            self._handler_endpoint(self._authenticated_handler),
+            _external=True)
+        try:
+            return await self._start_indieauth(
+                me, redirect_url, state or next_url, None)
+        finally:
+            await self._view_finished()
+
+    async def authorize(self, me, state=None, next_url=None, scope='read'):
+        """Authorize a user via Micropub; see MicropubClient.authorize."""
+        redirect_url = flask.url_for(
+            self._handler_endpoint(self._authorized_handler),
+            _external=True)
+        try:
+            return await self._start_indieauth(
+                me, redirect_url, state or next_url, scope)
+        finally:
+            await self._view_finished()
+
+    async def _start_indieauth(self, me, redirect_url, state, scope):
+        if not me.startswith('http://') and not me.startswith('https://'):
+            me = 'http://' + me
+        return self._redirect_to_auth(
+            me, await self.discover(me), redirect_url, state, scope)
+
+    def authenticated_handler(self, f):
+        """Decorates the authentication callback endpoint. The endpoint should
+        take one argument, a flask.ext.micropub.AuthResponse, and may be a
+        coroutine function.
+        """
+        @functools.wraps(f)
+        async def decorated():
+            try:
+                resp = await self._handle_authenticate_response()
+                return await _maybe_await(f(resp))
+            finally:
+                await self._view_finished()
+        self._authenticated_handler = decorated
+        return decorated
+
+    def authorized_handler(self, f):
+        """Decorates the authorization callback endpoint. The endpoint should
+        take one argument, a flask.ext.micropub.AuthResponse, and may be a
+        coroutine function.
+        """
+        @functools.wraps(f)
+        async def decorated():
+            try:
+                resp = await self._handle_authorize_response()
+                return await _maybe_await(f(resp))
+            finally:
+                await self._view_finished()
+        self._authorized_handler = decorated
+        return decorated
+
+    async def _handle_authenticate_response(self):
+        callback, error = self._read_callback()
+        if error:
+            return error
+
+        endpoints, error = await self._callback_endpoints(callback)
+        if error:
+            return error
+
+        auth_url = endpoints.authorization_endpoint or DEFAULT_AUTH_URL
+        try:
+            with self._instrument('verify_code', 'POST', auth_url) as call, \
+                    self._circuit(auth_url) as guarded:
+                response = await self._get_async_session().post(
+                    auth_url, data=self._verification_data(callback, auth_url))
+                call.responded(response)
+                guarded.record(response.status_code)
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return self._request_failed(callback, 'authorization', e)
+        return self._authenticate_result(callback, response)
+
+    async def _handle_authorize_response(self):
+        callback, error = self._read_callback()
+        if error:
+            return error
+
+        endpoints, error = await self._callback_endpoints(callback)
+        if error:
+            return error
+
+        token_url, micropub_url = endpoints[1:]
+        if not token_url or not micropub_url:
+            return AuthResponse(
+                me=callback.me,
+                state=callback.state,
+                error='no micropub endpoint found.',
+                error_code='no_micropub_endpoint')
+
+        try:
+            with self._instrument('token', 'POST', token_url) as call, \
+                    self._circuit(token_url) as guarded:
+                token_response = await self._get_async_session().post(
+                    token_url,
+                    data=self._token_request_data(callback, token_url))
+                call.responded(token_response)
+                guarded.record(token_response.status_code)
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return self._request_failed(callback, 'token', e, me=callback.me)
+        return self._authorize_result(
+            callback, micropub_url, token_url, token_response)
+
+    async def discover(self, me):
+        """Coroutine version of MicropubClient.discover."""
+        return await self._async_discovery_flights.do(
+            normalize_me(me), functools.partial(self._discover, me))
+
+    async def _discover(self, me):
+        with self._instrument('discovery', 'GET', me) as call:
+            result = await self._lookup_endpoints(me)
+            call.discovered(result)
+            return result
+
+    async def _lookup_endpoints(self, me):
+        started = time.perf_counter()
+        key, entry, now = self._discovery_cache_lookup(me)
+        if entry and entry.expires > now:
+            return DiscoveryResult(me, entry.endpoints, cached=True,
+                                   error=entry.error,
+                                   elapsed=time.perf_counter() - started)
+        if entry and entry.error:
+            entry = None
+
+        try:
+            with self._circuit(me) as breaker:
+                result = await self._fetch_endpoints(
+                    me, key, entry, now, started)
+                breaker.record(result.status_code)
+                return result
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return self._discovery_failed(me, key, now, started, e)
+
+    async def _fetch_endpoints(self, me, key, entry, now, started):
+        session = self._get_async_session()
+        headers = entry.conditional_headers() if entry else {}
+        if self.discovery_head_first:
+            try:
+                head_response = await session.head(
+                    me, headers=headers, follow_redirects=True)
+            except self._transport_errors:
+                head_response = None
+            if head_response is not None \
+                    and head_response.status_code < 400:
+                endpoints = self._endpoints_from_headers(
+                    key, entry, head_response, now)
+                if endpoints:
+                    return self._discovery_result(
+                        me, endpoints, head_response, started)
+
+        me_response = await session.send(
+            session.build_request('GET', me, headers=headers),
+            stream=True, follow_redirects=True)
+        try:
+            endpoints = self._endpoints_from_headers(
+                key, entry, me_response, now)
+            if endpoints:
+                return self._discovery_result(
+                    me, endpoints, me_response, started)
+
+            scanner = self._body_scanner(me_response)
+            if self.discovery_streaming:
+                async for chunk in me_response.aiter_bytes(
+                        DISCOVERY_CHUNK_SIZE):
+                    if scanner.feed(chunk):
+                        break
+            else:
+                await me_response.aread()
+                scanner.parse(me_response.text)
+            endpoints = scanner.endpoints()
+            self._cache_endpoints(key, endpoints, me_response, now)
+            return self._discovery_result(
+                me, endpoints, me_response, started, scanner.bytes_read)
+        finally:
+            await me_response.aclose()
+
+    async def _discover_endpoints(self, me):
+        return (await self.discover(me)).endpoints
+
+    async def prewarm(self, me_urls, max_workers=16):
+        """Coroutine version of MicropubClient.prewarm, running the
+        discoveries as tasks on the current event loop.
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def prewarm_one(me):
+            me = prewarm_url(me)
+            async with semaphore:
+                try:
+                    return await self.discover(me)
+                except Exception as e:
+                    return DiscoveryResult(
+                        me, (None, None, None), exception=e,
+                        error=str(e) or e.__class__.__name__)
+
+        return list(await asyncio.gather(
+            *[prewarm_one(me) for me in me_urls]))
+
+    async def refresh(self, auth, scope=None):
+        """Coroutine version of MicropubClient.refresh."""
+        if not auth.refresh_token:
+            return self._refresh_error(auth, 'no_refresh_token')
+        token_url = auth.token_endpoint
+        if not token_url and auth.me:
+            token_url = (await self._discover_endpoints(auth.me)).token_endpoint
+        if not token_url:
+            return self._refresh_error(auth, 'no_token_endpoint')
+        try:
+            with self._instrument('refresh', 'POST', token_url) as call, \
+                    self._circuit(token_url) as guarded:
+                response = await self._get_async_session().post(
+                    token_url, data=self._refresh_data(auth, scope))
+                call.responded(response)
+                guarded.record(response.status_code)
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return auth.replace(error=request_failure('token', e),
+                                error_code='endpoint_unavailable')
+        return self._refresh_result(auth, token_url, response)
+
+    async def refresh_batch(self, auths, max_workers=8, max_per_host=2):
+        """Coroutine version of MicropubClient.refresh_batch."""
+        import asyncio
+
+        semaphore = asyncio.Semaphore(max_workers)
+        host_semaphores = collections.defaultdict(
+            lambda: asyncio.Semaphore(max_per_host))
+
+        async def refresh(auth):
+            host = urlsplit(auth.token_endpoint or auth.me or '').hostname
+            async with host_semaphores[host], semaphore:
+                try:
+                    return await self.refresh(auth)
+                except Exception as e:
+                    return auth.replace(error=str(e),
+                                        error_code='refresh_failed')
+
+        return list(await asyncio.gather(*[refresh(auth) for auth in auths]))
+
+    def _prefetch(self, key, me):
+        # runs in a background thread, outliving the request's event loop,
+        # so it gets a loop (and an httpx client) of its own
+        import asyncio
+
+        async def prefetch():
+            try:
+                await self.discover(me)
+            finally:
+                await self.aclose()
+
+        try:
+            asyncio.run(prefetch())
+        finally:
+            with self._prefetch_lock:
+                self._prefetches.discard(key)
+
+    async def _callback_endpoints(self, callback):
+        error = self._started_error(callback)
+        if error:
+            return None, error
+        stored = self._stored_endpoints(callback)
+        if stored is not None and not self.verify_endpoints:
+            return stored, None
+        return self._checked_endpoints(
+            callback, stored, await self.discover(callback.me))
+
+    async def verify_token(self, token, me=None, token_endpoint=None):
+        """Coroutine version of MicropubClient.verify_token."""
+        me = me or self.me
+        token_endpoint = token_endpoint or self.token_endpoint
+        if token and not token_endpoint and me:
+            token_endpoint = (await self._discover_endpoints(me)).token_endpoint
+        info = self._token_precheck(token, token_endpoint)
+        if info is None:
+            key = token_key(token)
+            info = self._cached_token(key, token_endpoint)
+            if info is None:
+                info = await self._async_token_flights.do(
+                    (key, token_endpoint), functools.partial(
+                        self._verify_token, key, token, token_endpoint))
+        return self._check_token_owner(info, me)
+
+    async def _verify_token(self, key, token, token_endpoint):
+        try:
+            with self._instrument('verify_token', 'GET',
+                                  token_endpoint) as call, \
+                    self._circuit(token_endpoint) as guarded:
+                response = await self._get_async_session().get(
+                    token_endpoint, headers=self._bearer_headers(token))
+                call.responded(response)
+                guarded.record(response.status_code)
+        except (CircuitOpenError,) + self._transport_errors as e:
+            return self._token_endpoint_failed(token_endpoint, e)
+        return self._token_result(key, token_endpoint, response)
+
+    async def revoke_token(self, token, me=None, token_endpoint=None):
+        """Coroutine version of MicropubClient.revoke_token."""
+        me = me or self.me
+        token_endpoint = token_endpoint or self.token_endpoint
+        if not token_endpoint and me:
+            token_endpoint = (await self._discover_endpoints(me)).token_endpoint
+        try:
+            if not token_endpoint:
+                return False
+            with self._instrument('revoke_token', 'POST',
+                                  token_endpoint) as call, \
+                    self._circuit(token_endpoint) as guarded:
+                response = await self._get_async_session().post(
+                    token_endpoint, data={'action': 'revoke', 'token': token})
+                call.responded(response)
+                guarded.record(response.status_code)
+            return 200 <= response.status_code < 300
+        except (CircuitOpenError,) + self._transport_errors:
+            return False
+        finally:
+            self.invalidate_token(token)
+
+    def token_required(self, scope=None, me=None):
+        """As MicropubClient.token_required; the view may be a coroutine
+        function.
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            async def decorated(*args, **kwargs):
+                try:
+                    info = await self.verify_token(request_token(), me)
+                    error = self._token_error_response(info, scope)
+                    if error is not None:
+                        return error
+                    flask.g.micropub_token = info
+                    return await _maybe_await(f(*args, **kwargs))
+                finally:
+                    await self._view_finished()
+            return decorated
+        return decorator
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AuthResponse:
+    """Authorization response, passed to the authorized_handler endpoint.
+
+    AuthResponses are immutable and slotted, so they are small, and they
+    serialize compactly with to_dict/to_json/to_bytes (and pickle).
+
+    Attributes:
+      me (string): The authenticated user's URL. This will be non-None if and
+        only if the user was successfully authenticated.
+      micropub_endpoint (string): The endpoint to POST micropub requests to.
+      access_token (string): The authorized user's micropub access token.
+      state (string): The optional state that was passed to authorize.
+      scope (string): The scope that comes with the micropub access token
+      error (string): describes the error encountered if any. It is possible
+        that the authentication step will succeed but the access token step
+        will fail, in which case me will be non-None, and error will describe
+        this condition.
+      error_code (string): identifies the error, for code to check instead
+        of the description. One of 'missing_csrf_token',
+        'mismatched_csrf_token', 'expired_state', 'replayed_state',
+        'endpoints_changed', 'endpoint_unavailable', 'authorization_failed',
+        'missing_me', 'no_micropub_endpoint', 'token_request_failed' or
+        'missing_access_token', or from a refresh, 'no_refresh_token',
+        'no_token_endpoint' or 'refresh_failed'.
+      refresh_token (string): the refresh token, if the token endpoint
+        issued one.
+      expires (float): unix timestamp when the access token expires, if
+        the token endpoint said.
+      token_endpoint (string): the token endpoint that issued the access
+        token, where it can be refreshed.
+    """
+    __slots__ = ('me', 'micropub_endpoint', 'access_token', 'state', 'scope',
+                 'error', 'error_code', 'refresh_token', 'expires',
+                 'token_endpoint')
+
+    #: The version of the to_dict/to_bytes formats.
+    FORMAT_VERSION = 1
+
+    def __init__(self, me=None, micropub_endpoint=None,
+                 access_token=None, state=None, scope=None,
+                 error=None, error_code=None, refresh_token=None,
+                 expires=None, token_endpoint=None):
+        for name, value in zip(self.__slots__, (
+                me, micropub_endpoint, access_token, state, scope, error,
+                error_code, refresh_token, expires, token_endpoint)):
+            object.__setattr__(self, name, value)
+
+    @property
+    def next_url(self):
+        """Deprecated alias of state."""
+        return self.state
+
+    @property
+    def expired(self):
+        """Whether the access token is known to have expired."""
+        return self.expires is not None and self.expires <= time.time()
+
+    def replace(self, **changes):
+        """A copy of this AuthResponse with some attributes changed."""
+        values = dict(zip(self.__slots__, self._values()))
+        values.update(changes)
+        return AuthResponse(**values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('AuthResponse is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('AuthResponse is immutable')
+
+    def __reduce__(self):
+        return (AuthResponse, self._values())
+
+    def __setstate__(self, state):
+        # pickles from before AuthResponse was slotted restore their
+        # attributes from a dict, which may hold next_url as well
+        for name in self.__slots__:
+            object.__setattr__(self, name, state.get(name))
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, AuthResponse):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return '<AuthResponse {} {}>'.format(
+            self.me, self.error_code or self.error or self.scope)
+
+    def to_dict(self):
+        """A JSON-serializable dict, leaving out unset attributes."""
+        data = {'v': self.FORMAT_VERSION}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild an AuthResponse from to_dict.
+
+        Raises:
+          ValueError: if data is in a format this version cannot read.
+        """
+        if data.get('v') != cls.FORMAT_VERSION:
+            raise ValueError('unsupported AuthResponse format: {!r}'.format(
+                data.get('v')))
+        return cls(**dict((name, data.get(name)) for name in cls.__slots__))
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def to_bytes(self):
+        """A compact encoding: a JSON array of the version and the
+        attribute values in order, without trailing unset values.
+        """
+        values = list(self._values())
+        while values and values[-1] is None:
+            values.pop()
+        return json.dumps([self.FORMAT_VERSION] + values,
+                          separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Rebuild an AuthResponse from to_bytes.
+
+        Raises:
+          ValueError: if data is in a format this version cannot read.
+        """
+        values = json.loads(data.decode('utf-8'))
+        if not values or values[0] != cls.FORMAT_VERSION \
+                or len(values) > len(cls.__slots__) + 1:
+            raise ValueError('unsupported AuthResponse format')
+        return cls(*values[1:])
+
+
+class MicropubSession:
+    """Publishes to a user's Micropub endpoint with the credentials from
+    a successful authorization.
+
+    Requests go through the client's pooled session, so posts to the same
+    endpoint reuse keep-alive connections, and are reported through the
+    outbound_call signal as 'publish' operations.
+
+    Args:
+      auth (AuthResponse): an authorization with a micropub_endpoint and
+        an access_token.
+      client (MicropubClient, optional): the client whose connection pool,
+        timeouts and instrumentation to use. A new one is made if not
+        given.
+    """
+    def __init__(self, auth, client=None):
+        if not auth.micropub_endpoint or not auth.access_token:
+            raise ValueError(
+                'a micropub endpoint and access token are required')
+        self.auth = auth
+        self.client = client or MicropubClient()
+        self.host = urlsplit(auth.micropub_endpoint).hostname
+
+    def create(self, properties, h='entry', as_json=False):
+        """Create a post.
+
+        Args:
+          properties (dict): the post's properties, e.g.
+            {'content': 'hello', 'category': ['indieweb', 'micropub']}.
+            Values may be single values or lists.
+          h (string, optional): the type of post, 'entry' by default.
+          as_json (bool, optional): send a JSON request rather than a
+            form-encoded one; needed for nested values.
+
+        Returns:
+          a PublishResult; its location is the URL of the new post.
+        """
+        if as_json:
+            return self.publish({
+                'type': ['h-' + h],
+                'properties': dict(
+                    (name, value if isinstance(value, list) else [value])
+                    for name, value in properties.items()),
+            })
+        post = {'h': h}
+        for name, value in properties.items():
+            if isinstance(value, list) and len(value) != 1:
+                post[name + '[]'] = value
+            else:
+                post[name] = value[0] if isinstance(value, list) else value
+        return self.publish(post)
+
+    def update(self, url, replace=None, add=None, delete=None):
+        """Update a post (always sent as JSON).
+
+        Args:
+          url (string): the post to update.
+          replace (dict, optional): property -> list of new values.
+          add (dict, optional): property -> list of values to add.
+          delete (dict or list, optional): property -> list of values to
+            remove, or a list of properties to remove entirely.
+        """
+        post = {'action': 'update', 'url': url}
+        for name, value in (('replace', replace), ('add', add),
+                            ('delete', delete)):
+            if value:
+                post[name] = value
+        return self.publish(post)
+
+    def delete(self, url):
+        """Delete a post."""
+        return self.publish({'action': 'delete', 'url': url})
+
+    def undelete(self, url):
+        """Restore a deleted post."""
+        return self.publish({'action': 'undelete', 'url': url})
+
+    def query(self, q, cache=True, **params):
+        """Make a Micropub query, e.g. q=config or q=syndicate-to.
+
+        Responses are cached by the client per endpoint, access token and
+        query, for as long as their Cache-Control or Expires headers allow
+        (MICROPUB_QUERY_CACHE_TTL if they say nothing). Concurrent identical
+        queries share one request, and entries that are about to expire are
+        refreshed in the background while the cached value is served.
+
+        Args:
+          q (string): the query.
+          cache (bool, optional): set to False to always ask the endpoint.
+          params: any further query parameters.
+
+        Returns:
+          the JSON response as a dict. Cached responses are shared, so do
+          not modify it.
+
+        Raises:
+          requests.HTTPError if the endpoint responds with an error.
+        """
+        params['q'] = q
+        if not cache:
+            return self._query(params).json()
+        return self.client._cached_query(self, params)
+
+    def _query(self, params):
+        client = self.client
+        with client._instrument(
+                'query', 'GET', self.auth.micropub_endpoint) as call:
+            response = client.session.get(
+                self.auth.micropub_endpoint, params=params,
+                headers={'Authorization': 'Bearer ' + self.auth.access_token,
+                         'Accept': 'application/json'},
+                timeout=client.timeout)
+            call.responded(response)
+        response.raise_for_status()
+        return response
+
+    def config(self):
+        """The endpoint's q=config response."""
+        return self.query('config')
+
+    def syndicate_to(self):
+        """The syndication targets from q=syndicate-to, as a list of dicts
+        with 'uid' and 'name'.
+        """
+        return self.query('syndicate-to').get('syndicate-to', [])
+
+    def media_endpoint(self):
+        """The URL of the user's media endpoint, from q=config, or None if
+        they do not have one.
+        """
+        return self.config().get('media-endpoint')
+
+    def upload(self, media, filename=None, content_type=None,
+               chunk_size=64 * 1024):
+        """Upload a file to the user's media endpoint.
+
+        The request body is streamed with chunked transfer encoding, a
+        chunk_size piece of the file at a time, so the file is never held
+        in memory as a whole.
+
+        Args:
+          media (string or file): a path, or anything with a read method
+            returning bytes, such as an open file or an mmap.mmap.
+          filename (string, optional): the name to send; by default the
+            path or the file object's name.
+          content_type (string, optional): by default guessed from the
+            filename.
+          chunk_size (int, optional): bytes to read and send at a time.
+
+        Returns:
+          a PublishResult; its location is the URL of the uploaded file.
+        """
+        media_endpoint = self.media_endpoint()
+        if not media_endpoint:
+            return PublishResult(error='no media endpoint found.')
+
+        opened = None
+        if isinstance(media, str):
+            opened = media = open(media, 'rb')
+        try:
+            filename = os.path.basename(
+                filename or getattr(media, 'name', None) or 'file')
+            content_type = (content_type
+                            or mimetypes.guess_type(filename)[0]
+                            or 'application/octet-stream')
+            boundary = uuid.uuid4().hex
+            client = self.client
+            with client._instrument(
+                    'media_upload', 'POST', media_endpoint) as call:
+                response = client.session.post(
+                    media_endpoint,
+                    data=multipart_stream(media, 'file', filename,
+                                          content_type, boundary, chunk_size),
+                    headers={
+                        'Authorization': 'Bearer ' + self.auth.access_token,
+                        'Content-Type':
+                            'multipart/form-data; boundary=' + boundary,
+                    },
+                    timeout=client.timeout)
+                call.responded(response)
+        finally:
+            if opened:
+                opened.close()
+        return PublishResult.from_response(response)
+
+    def publish(self, post):
+        """Send a Micropub request.
+
+        Args:
+          post (dict): the request body. It is sent as JSON if it is a
+            JSON-style create (has 'properties') or an update, and
+            form-encoded otherwise.
+
+        Returns:
+          a PublishResult
+        """
+        as_json = 'properties' in post or post.get('action') == 'update'
+        client = self.client
+        with client._instrument(
+                'publish', 'POST', self.auth.micropub_endpoint) as call:
+            response = client.session.post(
+                self.auth.micropub_endpoint,
+                headers={'Authorization': 'Bearer ' + self.auth.access_token},
+                timeout=client.timeout,
+                **{'json' if as_json else 'data': post})
+            call.responded(response)
+        return PublishResult.from_response(response)
+
+
+def multipart_stream(media, field, filename, content_type, boundary,
+                     chunk_size=64 * 1024):
+    """Generate a multipart/form-data body holding one file, reading the
+    file a chunk at a time as the body is sent.
+    """
+    filename = filename.replace('\\', '\\\\').replace('"', '\\"')
+    yield ('--{}\r\n'
+           'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'
+           'Content-Type: {}\r\n\r\n'.format(
+               boundary, field, filename, content_type)).encode('utf-8')
+    while True:
+        chunk = media.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+    yield '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+
+
+class PublishResult:
+    """The outcome of a Micropub request.
+
+    Attributes:
+      status_code (int): the response status, or None if no response was
+        received.
+      location (string): the Location header, i.e. the URL of a newly
+        created post.
+      data (dict): the JSON body of the response, if it had one.
+      error (string): describes what went wrong, None on success.
+    """
+    def __init__(self, status_code=None, location=None, data=None,
                  error=None):
+        self.status_code = status_code
+        self.location = location
+        self.data = data
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @classmethod
+    def from_response(cls, response):
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        error = None
+        if response.status_code < 200 or response.status_code >= 300:
+            error = 'micropub request failed. {}: {}'.format(
+                response.status_code,
+                (data or {}).get('error_description')
+                or (data or {}).get('error') or 'Unknown Error')
+        return cls(status_code=response.status_code,
+                   location=response.headers.get('Location'),
+                   data=data, error=error)
+
+    def __repr__(self):
+        return '<PublishResult {} {}>'.format(
+            self.status_code, self.location or self.error)
+
+
+class TokenInfo:
+    """What a token endpoint says about an access token.
+
+    Attributes:
+      me (string): the user the token was issued to.
+      client_id (string): the client the token was issued to.
+      scope (string): the space-separated scopes the token grants.
+      token_endpoint (string): the token endpoint that verified it.
+      expires (float): unix timestamp when the token expires, if the token
+        endpoint said.
+      cached (bool): True if the verification came from the token cache.
+      error (string): None if the token is valid, otherwise a Micropub
+        error code: 'unauthorized', 'forbidden' or
+        'temporarily_unavailable'.
+      error_description (string): a description of the error.
+    """
+    def __init__(self, me=None, client_id=None, scope=None,
+                 token_endpoint=None, expires=None, cached=False,
+                 error=None, error_description=None):
         self.me = me
-        self.micropub_endpoint = micropub_endpoint
-        self.access_token = access_token
-        self.next_url = self.state = state
+        self.client_id = client_id
         self.scope = scope
+        self.token_endpoint = token_endpoint
+        self.expires = expires
+        self.cached = cached
         self.error = error
+        self.error_description = error_description
+
+    @property
+    def scopes(self):
+        return (self.scope or '').split()
+
+    def has_scope(self, scope):
+        """Whether the token grants scope. The legacy 'post' scope counts
+        as 'create'.
+        """
+        scopes = self.scopes
+        return scope in scopes or (scope == 'create' and 'post' in scopes)
+
+    def __repr__(self):
+        return '<TokenInfo {} {}>'.format(
+            self.me, self.scope if self.error is None else self.error)
+
+
+def request_token():
+    """The bearer token of the current request, from its Authorization
+    header or its access_token form field, or None.
+    """
+    scheme, _, token = flask.request.headers.get(
+        'Authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and token.strip():
+        return token.strip()
+    return flask.request.form.get('access_token') or None
+
+
+def token_key(token):
+    """The key a token's verification is cached under. Tokens are hashed,
+    so the cache never holds them in the clear.
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def token_expiry(data, now):
+    """When a token expires, from the expires_in (seconds) or exp (unix
+    timestamp) of a token endpoint response parsed by parse_response_data.
+
+    Returns:
+      a unix timestamp, or None if the response did not say.
+    """
+    try:
+        if 'expires_in' in data:
+            return now + int(data['expires_in'][0])
+        if 'exp' in data:
+            return int(data['exp'][0])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def request_failure(endpoint, error):
+    """Describe a request to an endpoint that failed with error."""
+    if isinstance(error, CircuitOpenError):
+        return '{} endpoint unavailable: {}'.format(endpoint, error)
+    return 'request to {} endpoint failed: {}'.format(
+        endpoint, str(error) or error.__class__.__name__)
+
+
+def make_session(pool_connections=10, pool_maxsize=10, max_retries=2,
+                 backoff_factor=0.3):
+    """Build the keep-alive, connection-pooled requests.Session that a
+    MicropubClient uses for all of its outbound calls.
+
+    Args:
+      pool_connections (int): how many hosts to keep connection pools for.
+      pool_maxsize (int): how many connections to keep open per host.
+      max_retries (int): retries for failed connections, and for idempotent
+        requests that fail with a 502, 503 or 504. POSTs are only retried
+        when the connection could not be made, since authorization codes
+        may only be redeemed once.
+      backoff_factor (float): exponential backoff between retries, in
+        seconds, as for urllib3.util.retry.Retry.
+
+    Returns:
+      a requests.Session
+    """
+    import requests
+    import requests.adapters
+    import urllib3.util.retry
+
+    retry = urllib3.util.retry.Retry(
+        total=max_retries, backoff_factor=backoff_factor,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+        max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def header_links(response):
+    """The discovery rels advertised in a response's HTTP Link header,
+    resolved against the URL the response came from.
+
+    Returns:
+      a dict of rel -> url, containing only the rels that were found.
+    """
+    base_url = response_url(response)
+    links = {}
+    for link in response.links.values():
+        url = link.get('url')
+        for rel in (link.get('rel') or '').lower().split():
+            if url and rel in DISCOVERY_RELS and rel not in links:
+                links[rel] = urljoin(base_url, url)
+    return links
+
+
+def response_url(response):
+    """The final URL of a requests or httpx response, as a string."""
+    return str(response.url) if response.url is not None else ''
+
+
+def parse_response_data(response):
+    """Parse the body of a response from an authorization or token
+    endpoint, which may be JSON or form-encoded.
+
+    Returns:
+      a dict of name -> list of values, as from urllib's parse_qs.
+    """
+    try:
+        return dict((k, [v]) for (k, v) in response.json().items())
+    except ValueError:
+        return parse_qs(response.text)
+
+
+def response_charset(response):
+    """The charset declared in a response's Content-Type, or UTF-8.
+
+    Unlike response.encoding, this does not fall back to ISO-8859-1 for
+    text/* responses that declare no charset.
+    """
+    charset = 'utf-8'
+    if 'charset' in response.headers.get('Content-Type', ''):
+        charset = response.encoding or charset
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = 'utf-8'
+    return charset
+
+
+class LinkCollector:
+    """Picks the first href for each of the requested rels out of <link>
+    and <a> elements, in a single pass, as the document is fed to it piece
+    by piece. Multi-valued rel attributes (rel="micropub me") count towards
+    every rel they name. The document is tokenized by one of the
+    LinkParser backends.
+
+    Attributes:
+      links (dict): rel -> href for every rel found so far, as written in
+        the document (i.e. possibly relative).
+      base_href (string): the href of the document's <base> element, if
+        one has been seen.
+      done (bool): True once there is nothing more to look for, i.e. all
+        rels have been found, or the end of <head> has been reached and
+        head_only was requested.
+    """
+    def __init__(self, rels, head_only=False, parser='html.parser'):
+        self.rels = set(rels)
+        self.head_only = head_only
+        self.links = {}
+        self.base_href = None
+        self.done = not self.rels
+        self._parser_class = link_parser(parser)
+        self._parser = None
+        self._closed = False
+
+    def feed(self, text):
+        """Tokenize the next piece of the document."""
+        # the backend, and so its library, is only loaded once a body
+        # needs scanning
+        if self._parser is None:
+            self._parser = self._parser_class(self)
+        self._parser.feed(text)
+
+    def close(self):
+        """Finish tokenizing, at the end of the document or wherever
+        reading it stopped.
+        """
+        if self._parser is not None and not self._closed:
+            self._closed = True
+            self._parser.close()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body' and self.head_only:
+            self.done = True
+        if self.done:
+            return
+        attrs = dict(attrs)
+        if tag == 'base' and self.base_href is None:
+            self.base_href = attrs.get('href')
+        elif tag in ('link', 'a'):
+            self.add_link(attrs.get('rel'), attrs.get('href'))
+
+    def handle_endtag(self, tag):
+        if tag == 'head' and self.head_only:
+            self.done = True
+
+    def add_link(self, rel, href):
+        """Record an element's rel and href, if it names a wanted rel.
+
+        Args:
+          rel (string or list): the rel attribute, either as written or
+            already split into values.
+          href (string): the href attribute.
+        """
+        if not href or not rel:
+            return
+        if not isinstance(rel, list):
+            rel = rel.split()
+        for value in rel:
+            value = value.lower()
+            if value in self.rels and value not in self.links:
+                self.links[value] = href.strip()
+        if len(self.links) == len(self.rels):
+            self.done = True
+
+
+class LinkParser:
+    """Base class for the HTML parser backends that discovery can scan a
+    homepage with. A backend tokenizes the text fed to it and reports each
+    element to its LinkCollector, as collector.handle_starttag(tag, attrs)
+    and collector.handle_endtag(tag), with lowercased tag and attribute
+    names and unescaped attribute values. It may stop early once
+    collector.done is set.
+
+    Register a backend in LINK_PARSERS to make it selectable by name with
+    MICROPUB_DISCOVERY_PARSER, or set the setting to the class itself.
+
+    Args:
+      collector (LinkCollector): where to report elements.
+    """
+    def __init__(self, collector):
+        self.collector = collector
+
+    def feed(self, text):
+        """Tokenize the next piece of the document."""
+        raise NotImplementedError
+
+    def close(self):
+        """Tokenize whatever is left of the document."""
+
+
+class HTMLLinkParser(LinkParser):
+    """Incremental backend built on the standard library's html.parser."""
+    def __init__(self, collector):
+        from html.parser import HTMLParser
+
+        LinkParser.__init__(self, collector)
+        self._parser = HTMLParser()
+        self._parser.handle_starttag = collector.handle_starttag
+        self._parser.handle_startendtag = collector.handle_starttag
+        self._parser.handle_endtag = collector.handle_endtag
+
+    def feed(self, text):
+        self._parser.feed(text)
+
+    def close(self):
+        self._parser.close()
+
+
+class LxmlLinkParser(LinkParser):
+    """Incremental backend built on lxml's HTMLPullParser (libxml2)."""
+    def __init__(self, collector):
+        import lxml.etree
+
+        LinkParser.__init__(self, collector)
+        self._parser = lxml.etree.HTMLPullParser(events=('start', 'end'))
+
+    def feed(self, text):
+        self._parser.feed(text)
+        self._read_events()
+
+    def close(self):
+        self._parser.close()
+        self._read_events()
+
+    def _read_events(self):
+        collector = self.collector
+        for event, element in self._parser.read_events():
+            if collector.done:
+                continue
+            if event == 'start':
+                collector.handle_starttag(
+                    element.tag, list(element.attrib.items()))
+            else:
+                collector.handle_endtag(element.tag)
+                # the elements already seen are not needed again
+                element.clear()
+
+
+class SoupLinkParser(LinkParser):
+    """Backend built on BeautifulSoup, with the tree builder named by
+    features ('html.parser' unless overridden in a subclass). BeautifulSoup
+    needs the whole document, so this backend only reports elements once
+    it is closed.
+    """
+    features = 'html.parser'
+
+    def __init__(self, collector):
+        import bs4
+
+        LinkParser.__init__(self, collector)
+        self._bs4 = bs4
+        self._pieces = []
+
+    def feed(self, text):
+        self._pieces.append(text)
+
+    def close(self):
+        soup = self._bs4.BeautifulSoup(''.join(self._pieces), self.features)
+        self._pieces = []
+        collector = self.collector
+        # walk the tree without recursion, reporting the end of each
+        # element after its children
+        stack = [(None, iter(soup.contents))]
+        while stack and not collector.done:
+            name, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if name is not None:
+                    collector.handle_endtag(name)
+            elif isinstance(child, self._bs4.Tag):
+                collector.handle_starttag(child.name, list(child.attrs.items()))
+                stack.append((child.name, iter(child.contents)))
+
+
+#: The parser backends that can be chosen by name.
+LINK_PARSERS = {
+    'html.parser': HTMLLinkParser,
+    'lxml': LxmlLinkParser,
+    'bs4': SoupLinkParser,
+}
+
+
+def link_parser(parser):
+    """Look up a LinkParser backend by its name in LINK_PARSERS. A
+    LinkParser subclass is returned as it is.
+
+    Raises:
+      ValueError: if there is no backend of that name.
+    """
+    if isinstance(parser, type) and issubclass(parser, LinkParser):
+        return parser
+    try:
+        return LINK_PARSERS[parser]
+    except KeyError:
+        raise ValueError('unknown discovery parser {!r}, expected one of {}'
+                         .format(parser, ', '.join(sorted(LINK_PARSERS))))
+
+
+class BodyLinkScanner:
+    """Looks through the body of a homepage for the endpoints its Link
+    header did not advertise.
+
+    The body can be fed to the scanner a chunk at a time, as it arrives,
+    or parsed all at once. Either way each element is looked at once,
+    whatever the number of rels.
+
+    Args:
+      links (dict): rel -> url for the endpoints already found in the
+        Link header; these take precedence over the body.
+      charset (string): the encoding of the body.
+      base_url (string): the URL the body was fetched from, after
+        redirects, which relative hrefs are resolved against.
+      head_only (bool): stop at the end of <head>.
+      max_bytes (int): stop after this many bytes of the body.
+      parser (string or LinkParser subclass): the HTML parser backend.
+    """
+    def __init__(self, links, charset, base_url='', head_only=False,
+                 max_bytes=None, parser='html.parser'):
+        self.links = dict(links)
+        self.base_url = base_url
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self._collector = LinkCollector(
+            [rel for rel in DISCOVERY_RELS if rel not in self.links],
+            head_only=head_only, parser=parser)
+        self._decoder = codecs.getincrementaldecoder(charset)('replace')
+
+    def feed(self, chunk):
+        """Scan the next chunk of the body.
+
+        Returns:
+          True once there is no point in reading any more of the body.
+        """
+        self.bytes_read += len(chunk)
+        self._collector.feed(self._decoder.decode(chunk))
+        return self._collector.done or (
+            self.max_bytes is not None and self.bytes_read >= self.max_bytes)
+
+    def parse(self, text):
+        """Scan the whole body at once."""
+        self.bytes_read += len(text)
+        self._collector.feed(text)
+
+    def endpoints(self):
+        self._collector.close()
+        base_url = urljoin(self.base_url, self._collector.base_href or '')
+        links = dict((rel, urljoin(base_url, href))
+                     for rel, href in self._collector.links.items())
+        links.update(self.links)
+        return Endpoints(*(links.get(rel) for rel in DISCOVERY_RELS))
+
+
+class DiscoveryResult:
+    """The outcome of discovering a user's endpoints.
+
+    Attributes:
+      me (string): the URL discovery started from.
+      url (string): the URL the homepage was fetched from in the end,
+        after redirects. Relative endpoints are resolved against it. None
+        if the result came straight from the cache.
+      endpoints (Endpoints): the discovered authorization, token and
+        micropub endpoints; members are None if not found.
+      status_code (int): the status of the final response, or None if no
+        request was made.
+      cached (bool): True if the endpoints came from a fresh cache entry
+        without any request, or from a stale one confirmed by a 304.
+      error (string): why discovery failed (an error status, a network
+        error, or an open circuit breaker), None if it did not.
+      exception (Exception): the exception discovery failed with, if any.
+      bytes_read (int): how much of the page body was read.
+      elapsed (float): how long discovery took, in seconds.
+    """
+    def __init__(self, me, endpoints, url=None, status_code=None,
+                 cached=False, error=None, exception=None, bytes_read=0,
+                 elapsed=0.0):
+        self.me = me
+        self.url = url
+        self.endpoints = Endpoints(*endpoints)
+        self.status_code = status_code
+        self.cached = cached
+        self.error = error
+        self.exception = exception
+        self.bytes_read = bytes_read
+        self.elapsed = elapsed
+
+    @property
+    def authorization_endpoint(self):
+        return self.endpoints.authorization_endpoint
+
+    @property
+    def token_endpoint(self):
+        return self.endpoints.token_endpoint
+
+    @property
+    def micropub_endpoint(self):
+        return self.endpoints.micropub_endpoint
+
+    def __repr__(self):
+        return '<DiscoveryResult {} {!r} in {:.3f}s>'.format(
+            self.me, tuple(self.endpoints), self.elapsed)
+
+
+def normalize_me(me):
+    """Normalize a user's URL so that trivially different spellings of the
+    same homepage share a discovery cache entry: the scheme and host are
+    lowercased, an empty path becomes "/" and the fragment is dropped.
+    """
+    if not me.lower().startswith(('http://', 'https://')):
+        me = 'http://' + me
+    scheme, netloc, path, query, _ = urlsplit(me)
+    return urlunsplit((scheme.lower(), netloc.lower(), path or '/', query, ''))
+
+
+def cache_expiry(headers, now, default_ttl, max_ttl=None):
+    """Work out when a response stops being fresh from its Cache-Control,
+    Expires and Date headers.
+
+    Args:
+      headers (dict): the response headers (case-insensitive).
+      now (float): the time the response was received.
+      default_ttl (int): lifetime in seconds when the response gives no
+        explicit freshness information.
+      max_ttl (int, optional): upper bound on the lifetime in seconds.
+
+    Returns:
+      the expiry as a unix timestamp, or None if the response must not be
+      stored at all (Cache-Control: no-store).
+    """
+    directives = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return now
+
+    ttl = default_ttl
+    if 'max-age' in directives:
+        try:
+            ttl = int(directives['max-age']) - int(headers.get('Age', 0))
+        except ValueError:
+            ttl = 0
+    elif headers.get('Expires'):
+        expires = _parse_http_date(headers['Expires'])
+        date = _parse_http_date(headers.get('Date')) or now
+        ttl = expires - date if expires is not None else 0
+
+    if max_ttl is not None:
+        ttl = min(ttl, max_ttl)
+    return now + max(ttl, 0)
+
+
+def _parse_http_date(value):
+    parsed = value and email.utils.parsedate_tz(value)
+    if not parsed:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+class OutboundCall:
+    """One outbound call made by a MicropubClient, as sent with the
+    outbound_call signal. Subscribe to the signal to feed latency
+    histograms or logs, e.g. by operation and host.
+
+    Concurrent discoveries of the same user that share one fetch send a
+    single OutboundCall between them.
+
+    Attributes:
+      operation (string): 'discovery', 'verify_code', 'token', 'refresh',
+        'verify_token', 'revoke_token', 'publish', 'query' or
+        'media_upload'.
+      method (string): the HTTP method.
+      url (string): the URL called.
+      host (string): the host part of url.
+      status_code (int): the response status, or None if there was no
+        response (an error, or a discovery answered from the cache).
+      cache (string): for discovery, 'hit' if the endpoints came from a
+        fresh cache entry, 'revalidated' if a stale one was confirmed with
+        a 304, and 'miss' otherwise. None for other operations.
+      bytes_read (int): bytes of response body read, if known.
+      duration (float): how long the call took, in seconds.
+      error (Exception): the exception the call failed with, if any.
+    """
+    def __init__(self, operation, method, url):
+        self.operation = operation
+        self.method = method
+        self.url = url
+        self.host = urlsplit(url).hostname if url else None
+        self.status_code = None
+        self.cache = None
+        self.bytes_read = None
+        self.duration = None
+        self.error = None
+
+    @property
+    def status_class(self):
+        """'2xx', '4xx' and so on, or 'error' if the call raised."""
+        if self.error is not None:
+            return 'error'
+        if self.status_code is not None:
+            return '{}xx'.format(self.status_code // 100)
+
+    def responded(self, response):
+        self.status_code = response.status_code
+        self.bytes_read = len(response.content)
+
+    def discovered(self, result):
+        self.status_code = result.status_code
+        self.bytes_read = result.bytes_read
+        if result.exception is not None:
+            self.error = result.exception
+        if result.status_code is None:
+            self.cache = 'hit'
+        elif result.cached:
+            self.cache = 'revalidated'
+        else:
+            self.cache = 'miss'
+
+    def attributes(self):
+        """The call, as OpenTelemetry-style span attributes."""
+        attributes = {'micropub.operation': self.operation}
+        if self.status_code is not None:
+            attributes['http.status_code'] = self.status_code
+        if self.status_class:
+            attributes['micropub.status_class'] = self.status_class
+        if self.cache:
+            attributes['micropub.cache'] = self.cache
+        if self.bytes_read is not None:
+            attributes['micropub.bytes_read'] = self.bytes_read
+        return attributes
+
+    def __repr__(self):
+        return '<OutboundCall {} {} {} {}>'.format(
+            self.operation, self.method, self.url, self.status_class)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a host whose circuit breaker is open."""
+    def __init__(self, host, retry_at):
+        Exception.__init__(
+            self, 'too many failures from {}, retrying in {:.0f}s'.format(
+                host, max(0, retry_at - time.time())))
+        self.host = host
+        self.retry_at = retry_at
+
+
+class CircuitBreaker:
+    """Tracks failures of calls to one host. After max_failures failures
+    in a row the breaker opens, and calls fail fast for reset_timeout
+    seconds. Then a single trial call is let through: if it succeeds the
+    breaker closes, and if it fails the breaker opens again.
+    """
+    def __init__(self, max_failures=5, reset_timeout=30):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def retry_at(self):
+        if self.opened_at is None:
+            return time.time()
+        return self.opened_at + self.reset_timeout
+
+    def allow(self):
+        """Whether a call may go ahead now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and time.time() >= self.retry_at:
+                self._trial = True
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.max_failures:
+                self.opened_at = time.time()
+            self._trial = False
+
+
+class _GuardedCall:
+    def __init__(self):
+        self.status_code = None
+
+    def record(self, status_code):
+        self.status_code = status_code
+
+
+class DiscoveryCacheEntry:
+    """The endpoints discovered for one user's URL, together with what is
+    needed to decide when (and how cheaply) to fetch them again.
+
+    Attributes:
+      endpoints (Endpoints): the discovered authorization, token and
+        micropub endpoints.
+      expires (float): unix timestamp after which the entry is stale.
+      etag (string): the ETag validator of the response, if any.
+      last_modified (string): the Last-Modified validator, if any.
+      fetched (float): unix timestamp of the fetch that produced the entry.
+      error (string): for a negative entry, remembering that discovery
+        failed, why it did.
+    """
+    def __init__(self, endpoints, expires, etag=None, last_modified=None,
+                 fetched=None, error=None):
+        self.endpoints = Endpoints(*endpoints)
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+        self.error = error
+
+    def conditional_headers(self):
+        """Headers that turn a refetch into a conditional GET."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def to_dict(self):
+        """A JSON-friendly representation, for shared cache backends."""
+        return {
+            'endpoints': list(self.endpoints),
+            'expires': self.expires,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'fetched': self.fetched,
+            'error': self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class DiscoveryCache:
+    """Storage interface for discovered endpoints, keyed by normalized user
+    URL. Subclass this to share discoveries between processes (e.g. in
+    Redis or memcached); DiscoveryCacheEntry.to_dict and from_dict give a
+    serializable form.
+    """
+    def get(self, key):
+        """Return the DiscoveryCacheEntry for key, or None."""
+        raise NotImplementedError
+
+    def set(self, key, entry):
+        """Store a DiscoveryCacheEntry under key."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Forget the entry for key, if there is one."""
+        raise NotImplementedError
+
+
+class LRUCache:
+    """Thread-safe in-process mapping that holds at most max_size entries,
+    evicting the least recently used one when full.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LRUDiscoveryCache(LRUCache, DiscoveryCache):
+    """Thread-safe in-process DiscoveryCache that holds at most max_size
+    entries, evicting the least recently used one when full.
+    """
+
+
+class SQLiteDatabase:
+    """Base for the SQLite backends. The database is in WAL mode, so
+    readers in other processes are not blocked by a write, and every
+    thread of every process has a connection of its own.
+    """
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        """This thread's connection, opened on first use (and again in a
+        forked child, which must not use its parent's).
+        """
+        import sqlite3
+
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def close(self):
+        """Close this thread's connection."""
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            self._local.db = None
+            db.close()
+
+
+class SQLiteDiscoveryCache(SQLiteDatabase, DiscoveryCache):
+    """DiscoveryCache kept in an SQLite database on disk, so discoveries
+    survive restarts and are shared by all the worker processes on a host.
+
+    Stale entries are kept, since their validators still make refetching
+    cheap, until compaction. Every compact_every writes,
+    compaction drops entries that have been stale for longer than
+    max_stale seconds. Then, if there are still more than max_size entries,
+    it drops the ones that expire soonest.
+
+    Args:
+      path (string): the database file; created if it does not exist.
+      max_size (int): how many entries to keep.
+      max_stale (float): seconds past expiry to keep an entry for.
+      compact_every (int): writes between compactions.
+      timeout (float): seconds to wait for another process's write.
+    """
+    def __init__(self, path, max_size=1024, max_stale=7 * 86400,
+                 compact_every=100, timeout=5.0):
+        SQLiteDatabase.__init__(self, path, timeout)
+        self.max_size = max_size
+        self.max_stale = max_stale
+        self.compact_every = compact_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        with self._connection() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS discovery ('
+                'key TEXT PRIMARY KEY, authorization_endpoint TEXT, '
+                'token_endpoint TEXT, micropub_endpoint TEXT, '
+                'expires REAL NOT NULL, etag TEXT, last_modified TEXT, '
+                'fetched REAL, error TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS discovery_expires '
+                       'ON discovery (expires)')
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT authorization_endpoint, token_endpoint, '
+            'micropub_endpoint, expires, etag, last_modified, fetched, error '
+            'FROM discovery WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return DiscoveryCacheEntry(row[:3], *row[3:])
+
+    def set(self, key, entry):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO discovery VALUES (?, ?, ?, ?, ?, ?, ?, ?, '
+            '?)', (key,) + tuple(entry.endpoints) + (
+                entry.expires, entry.etag, entry.last_modified,
+                entry.fetched, entry.error))
+        with self._lock:
+            self._writes += 1
+            due = self._writes >= self.compact_every
+            if due:
+                self._writes = 0
+        if due:
+            self.compact()
+
+    def delete(self, key):
+        self._connection().execute(
+            'DELETE FROM discovery WHERE key = ?', (key,))
+
+    def compact(self, vacuum=False):
+        """Drop long-stale entries, and the soonest to expire beyond
+        max_size.
+
+        Args:
+          vacuum (bool): also give the freed space back to the filesystem.
+            This rewrites the whole database, so it is best done off-peak.
+        """
+        db = self._connection()
+        db.execute('DELETE FROM discovery WHERE expires < ?',
+                   (time.time() - self.max_stale,))
+        db.execute(
+            'DELETE FROM discovery WHERE key IN (SELECT key FROM discovery '
+            'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+        if vacuum:
+            db.execute('VACUUM')
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM discovery').fetchone()[0]
+
+
+class TokenStore:
+    """Storage interface for the AuthResponses of successful
+    authorizations, one per user, keyed by normalized user URL. Subclass
+    this to keep them elsewhere; AuthResponse.to_bytes and from_bytes give
+    a serializable form.
+    """
+    def get(self, me):
+        """Return the AuthResponse saved for user URL me, or None."""
+        raise NotImplementedError
+
+    def save(self, auth):
+        """Save an AuthResponse, replacing any saved for the same user."""
+        raise NotImplementedError
+
+    def delete(self, me):
+        """Forget the AuthResponse for user URL me, if there is one."""
+        raise NotImplementedError
+
+    def for_endpoint(self, micropub_endpoint):
+        """Return the AuthResponses for a Micropub endpoint."""
+        raise NotImplementedError
+
+    def expiring(self, before, limit=None):
+        """Return up to limit AuthResponses with refresh tokens whose access
+        tokens expire before the unix timestamp before, soonest first. This
+        is the load function of a TokenRefreshScheduler.
+        """
+        raise NotImplementedError
+
+    def sweep(self, before=None):
+        """Forget the AuthResponses that have no refresh token and whose
+        access tokens expired before the unix timestamp before (default
+        now).
+
+        Returns:
+          how many were forgotten.
+        """
+        raise NotImplementedError
+
+
+class SQLiteTokenStore(SQLiteDatabase, TokenStore):
+    """TokenStore kept in an SQLite database on disk, shared by all the
+    worker processes on a host.
+
+    Tokens are looked up through indexes on the user URL, the Micropub
+    endpoint and the expiry, so lookups and sweeps do not scan the table.
+    If a key is given, each AuthResponse is encrypted with Fernet (from
+    the cryptography package) before it is written, leaving only the user
+    URL, the Micropub endpoint and the expiry in the clear.
+
+    Args:
+      path (string): the database file; created if it does not exist.
+      key (bytes or list, optional): a Fernet key, from
+        cryptography.fernet.Fernet.generate_key(). To rotate keys, give a
+        list: the first key encrypts, and any of them decrypts.
+      timeout (float): seconds to wait for another process's write.
+    """
+    def __init__(self, path, key=None, timeout=5.0):
+        SQLiteDatabase.__init__(self, path, timeout)
+        self._fernet = None
+        if key:
+            from cryptography.fernet import Fernet, MultiFernet
+
+            keys = [key] if isinstance(key, (bytes, str)) else key
+            self._fernet = MultiFernet([Fernet(k) for k in keys])
+        with self._connection() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS tokens ('
+                'me TEXT PRIMARY KEY, micropub_endpoint TEXT, expires REAL, '
+                'refreshable INTEGER NOT NULL, saved REAL NOT NULL, '
+                'auth BLOB NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS tokens_micropub_endpoint '
+                       'ON tokens (micropub_endpoint)')
+            db.execute('CREATE INDEX IF NOT EXISTS tokens_expires '
+                       'ON tokens (refreshable, expires)')
+
+    def _dump(self, auth):
+        data = auth.replace(state=None).to_bytes()
+        if self._fernet is not None:
+            data = self._fernet.encrypt(data)
+        return data
+
+    def _load(self, data):
+        if self._fernet is not None:
+            data = self._fernet.decrypt(bytes(data))
+        return AuthResponse.from_bytes(bytes(data))
+
+    def get(self, me):
+        row = self._connection().execute(
+            'SELECT auth FROM tokens WHERE me = ?',
+            (normalize_me(me),)).fetchone()
+        return None if row is None else self._load(row[0])
+
+    def save(self, auth):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?)', (
+                normalize_me(auth.me), auth.micropub_endpoint, auth.expires,
+                bool(auth.refresh_token), time.time(), self._dump(auth)))
+
+    def delete(self, me):
+        self._connection().execute(
+            'DELETE FROM tokens WHERE me = ?', (normalize_me(me),))
+
+    def for_endpoint(self, micropub_endpoint):
+        return [self._load(row[0]) for row in self._connection().execute(
+            'SELECT auth FROM tokens WHERE micropub_endpoint = ?',
+            (micropub_endpoint,))]
+
+    def expiring(self, before, limit=None):
+        return [self._load(row[0]) for row in self._connection().execute(
+            'SELECT auth FROM tokens WHERE refreshable = 1 AND expires < ? '
+            'ORDER BY expires LIMIT ?',
+            (before, -1 if limit is None else limit))]
+
+    def sweep(self, before=None):
+        return self._connection().execute(
+            'DELETE FROM tokens WHERE refreshable = 0 AND expires < ?',
+            (time.time() if before is None else before,)).rowcount
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM tokens').fetchone()[0]
+
+
+class QueryCacheEntry:
+    """A cached Micropub query response.
+
+    Attributes:
+      value (dict): the parsed JSON response.
+      expires (float): unix timestamp after which the entry is stale.
+      refresh_at (float): unix timestamp after which the entry is still
+        served, but refreshed in the background.
+    """
+    def __init__(self, value, expires, refresh_at):
+        self.value = value
+        self.expires = expires
+        self.refresh_at = refresh_at
+
+
+class SingleFlight:
+    """Makes concurrent calls for the same key share one execution: the
+    first caller runs the function, and callers that arrive while it is
+    running wait for, and get, the same result (or exception).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if leader:
+            try:
+                flight.result = func()
+            except BaseException as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def __contains__(self, key):
+        return key in self._flights
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutine functions.
+
+    Flights are shared between event loops as well as within one: Flask
+    runs each async view in an event loop of its own, so callers from other
+    loops wait on a thread-safe future for the first caller's result.
+
+    Cancellation is not shared: if the first caller is cancelled, a caller
+    that is still waiting runs the function in its place, and a waiting
+    caller that is cancelled leaves the others waiting.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    async def do(self, key, func):
+        import asyncio
+        import concurrent.futures
+
+        while True:
+            with self._lock:
+                future = self._flights.get(key)
+                leader = future is None
+                if leader:
+                    future = self._flights[key] = concurrent.futures.Future()
+                    # a running future cannot be cancelled, so a waiting
+                    # caller that is cancelled does not cancel it for the rest
+                    future.set_running_or_notify_cancel()
+
+            if leader:
+                break
+            try:
+                return await asyncio.wrap_future(future)
+            except _FlightAbandoned:
+                continue
+
+        try:
+            result = await func()
+        except BaseException as e:
+            with self._lock:
+                del self._flights[key]
+            future.set_exception(_FlightAbandoned()
+                                 if isinstance(e, asyncio.CancelledError)
+                                 else e)
+            raise
+        with self._lock:
+            del self._flights[key]
+        future.set_result(result)
+        return result
+
+
+class _FlightAbandoned(Exception):
+    """The first caller of an AsyncSingleFlight was cancelled."""
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ReplayCache:
+    """Remembers the nonces of state tokens that have been used, until the
+    tokens expire, so that each one is only accepted once. At most
+    max_size nonces are kept; when full, the oldest is forgotten.
+
+    The cache is per process. With several workers, a token can be replayed
+    against a different worker until it expires.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._nonces = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, nonce, expires):
+        """Record that nonce has been used.
+
+        Returns:
+          False if the nonce had already been used, True otherwise.
+        """
+        now = time.time()
+        with self._lock:
+            while self._nonces and next(iter(self._nonces.values())) <= now:
+                self._nonces.popitem(last=False)
+            if nonce in self._nonces:
+                return False
+            self._nonces[nonce] = expires
+            while len(self._nonces) > self.max_size:
+                self._nonces.popitem(last=False)
+            return True
+
+
+class TokenRefreshScheduler:
+    """Refreshes access tokens in the background before they expire, so
+    that users are not sent through authorization again, and a wave of
+    expiring tokens becomes a steady trickle of refreshes.
+
+    Every interval seconds, the tokens that expire within margin seconds
+    are loaded and refreshed batch_size at a time with refresh_batch.
+
+    Args:
+      client (MicropubClient): refreshes the tokens.
+      load (callable): load(before) returns the AuthResponses with refresh
+        tokens whose access tokens expire before the unix timestamp before.
+      save (callable): save(old, new) is called with each refreshed
+        AuthResponse and the one it replaces.
+      on_error (callable, optional): on_error(old, failed) is called for
+        each refresh that failed, e.g. to forget a revoked grant. Failures
+        are retried at the next check otherwise.
+      margin (float): how long before expiry to refresh, in seconds.
+      interval (float): seconds between checks.
+      batch_size (int): tokens to refresh at a time.
+      max_workers (int): refreshes in flight at once.
+      max_per_host (int): refreshes in flight per token endpoint host.
+    """
+    def __init__(self, client, load, save, on_error=None, margin=300,
+                 interval=60, batch_size=100, max_workers=8, max_per_host=2):
+        self.client = client
+        self.load = load
+        self.save = save
+        self.on_error = on_error
+        self.margin = margin
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """Refresh the tokens that are due now.
+
+        Returns:
+          a (refreshed, failed) pair of counts.
+        """
+        refreshed = failed = 0
+        due = iter(self.load(time.time() + self.margin))
+        while True:
+            batch = [auth for _, auth in zip(range(self.batch_size), due)]
+            if not batch:
+                return refreshed, failed
+            results = run_sync(self.client, self.client.refresh_batch(
+                batch, self.max_workers, self.max_per_host))
+            for old, new in zip(batch, results):
+                if new.error is None:
+                    refreshed += 1
+                    self.save(old, new)
+                else:
+                    failed += 1
+                    if self.on_error is not None:
+                        self.on_error(old, new)
+
+    def start(self):
+        """Start checking in a daemon thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='flask-micropub-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop checking, waiting for a check in progress to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                refreshed, failed = self.run_once()
+                if refreshed or failed:
+                    logger.info('Flask-Micropub: refreshed %d tokens, '
+                                '%d failed', refreshed, failed)
+            except Exception:
+                logger.exception('Flask-Micropub: token refresh failed')
+            self._stop.wait(self.interval)
+
+
+def run_sync(client, result):
+    """The result of a client call made outside of any event loop: for an
+    AsyncMicropubClient, whose calls are coroutines, the coroutine is run
+    on an event loop of its own.
+    """
+    if not inspect.isawaitable(result):
+        return result
+    import asyncio
+
+    async def run():
+        try:
+            return await result
+        finally:
+            await client.aclose()
+    return asyncio.run(run())
+
+
+class RateLimiter:
+    """Token bucket allowing rate calls per second on average, in bursts
+    of up to burst calls.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Take a token if there is one.
+
+        Returns:
+          True if the call may go ahead.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+def prewarm_url(me):
+    """A me URL as typed into a login form or listed for prewarming, with
+    http:// added if it has no scheme, as authenticate and authorize do.
+    """
+    me = me.strip()
+    if not me.lower().startswith(('http://', 'https://')):
+        me = 'http://' + me
+    return me
+
+
+#: The ``flask micropub`` command group, added to the app by init_app.
+cli = flask.cli.AppGroup('micropub', help='Flask-Micropub commands.')
+
+
+@cli.command('prewarm')
+@click.argument('source', type=click.File('r'), default='-')
+@click.option('--workers', default=16, show_default=True,
+              help='Discoveries to run at once.')
+@click.option('--quiet', is_flag=True, help='Only report failures.')
+def prewarm_command(source, workers, quiet):
+    """Discover the endpoints of the me URLs listed in SOURCE, one per
+    line ("-" for stdin), to warm the discovery cache.
+    """
+    client = flask.current_app.extensions['micropub']
+    if client.discovery_cache is None:
+        raise click.ClickException('the discovery cache is disabled')
+    if isinstance(client.discovery_cache, LRUCache):
+        click.echo('warning: the discovery cache is in-process, so it is '
+                   'only warm until this command exits', err=True)
+
+    me_urls = [line.strip() for line in source
+               if line.strip() and not line.lstrip().startswith('#')]
+    started = time.perf_counter()
+    results = run_sync(client, client.prewarm(me_urls, max_workers=workers))
+    elapsed = time.perf_counter() - started
+
+    failed = 0
+    for result in results:
+        if result.error:
+            failed += 1
+        elif quiet:
+            continue
+        click.echo('{:9.1f} ms  {}  {}'.format(
+            result.elapsed * 1000, result.me,
+            result.error or ('cached' if result.cached else 'ok')))
+    click.echo('warmed {} of {} sites in {:.1f}s, {} failed'.format(
+        len(results) - failed, len(results), elapsed, failed))
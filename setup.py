@@ -22,11 +22,18 @@ setup(
     zip_safe=False,
     include_package_data=True,
     platforms='any',
+    python_requires='>=3.7',
     install_requires=[
         'Flask',
         'requests',
-        'BeautifulSoup4',
+        'urllib3>=1.26',
     ],
+    extras_require={
+        'async': ['Flask[async]>=2.0', 'httpx'],
+        'lxml': ['lxml'],
+        'bs4': ['BeautifulSoup4'],
+        'crypto': ['cryptography'],
+    },
     tests_require=[
         'mock',
     ],
@@ -0,0 +1,223 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import json
+import unittest
+import unittest.mock
+
+import flask
+
+import flask_micropub
+
+try:
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from urlparse import urlsplit, parse_qs
+
+try:
+    import asgiref
+    import httpx
+except ImportError:
+    httpx = None
+
+
+LINK_HEADER = '<http://foo.bar/auth>;rel=authorization_endpoint, <http://baz.bux/token>;rel=token_endpoint, <http://do.re/micropub>;rel=micropub'
+
+
+@unittest.skipIf(httpx is None, 'requires the async extra')
+class AsyncMicropubClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.app = flask.Flask('test')
+        self.app.config['SECRET_KEY'] = 'secret'
+        self.client = flask_micropub.AsyncMicropubClient(
+            self.app, transport=httpx.MockTransport(self.handle_request))
+
+        @self.app.route('/login')
+        async def login():
+            return await self.client.authorize('foo.bar', state='s', scope='post')
+
+        @self.app.route('/callback')
+        @self.client.authorized_handler
+        async def callback(resp):
+            return json.dumps([resp.me, resp.access_token, resp.scope,
+                               resp.micropub_endpoint, resp.state, resp.error])
+
+    def handle_request(self, request):
+        self.requests.append((request.method, str(request.url)))
+        if request.url.host == 'foo.bar':
+            return httpx.Response(200, headers={'Link': LINK_HEADER})
+        if request.url.host == 'baz.bux':
+            data = parse_qs(request.content.decode('utf-8'))
+            self.assertEqual(['abc'], data['code'])
+            return httpx.Response(200, json={
+                'access_token': 'token', 'me': 'http://foo.bar/',
+                'scope': 'post'})
+        return httpx.Response(404)
+
+    def test_authorize_flow(self):
+        with self.app.test_client() as test_client:
+            redirect = test_client.get('/login')
+            self.assertEqual(302, redirect.status_code)
+            location = urlsplit(redirect.headers['Location'])
+            self.assertEqual('foo.bar', location.netloc)
+            state = parse_qs(location.query)['state'][0]
+
+            resp = test_client.get('/callback', query_string={
+                'code': 'abc', 'state': state, 'me': 'http://foo.bar/'})
+            self.assertEqual(
+                ['http://foo.bar/', 'token', 'post', 'http://do.re/micropub',
+                 's', None],
+                json.loads(resp.get_data(as_text=True)))
+
+        # the callback reuses the endpoints discovered at the start
+        self.assertEqual([
+            ('GET', 'http://foo.bar'),
+            ('POST', 'http://baz.bux/token'),
+        ], self.requests)
+
+    def test_token_store(self):
+        store = unittest.mock.Mock(spec=flask_micropub.TokenStore)
+        app = flask.Flask('test')
+        app.config['SECRET_KEY'] = 'secret'
+        client = flask_micropub.AsyncMicropubClient(
+            app, token_store=store,
+            transport=httpx.MockTransport(self.handle_request))
+        self.assertIs(store, client.token_store)
+
+        @app.route('/login')
+        async def login():
+            return await client.authorize('foo.bar', scope='post')
+
+        @app.route('/callback')
+        @client.authorized_handler
+        async def callback(resp):
+            return resp.access_token
+
+        with app.test_client() as test_client:
+            redirect = test_client.get('/login')
+            state = parse_qs(urlsplit(
+                redirect.headers['Location']).query)['state'][0]
+            test_client.get('/callback', query_string={
+                'code': 'abc', 'state': state, 'me': 'http://foo.bar/'})
+        self.assertEqual('token', store.save.call_args[0][0].access_token)
+
+    def test_clients_closed_after_views(self):
+        sessions = []
+        get_async_session = self.client._get_async_session
+
+        def track():
+            session = get_async_session()
+            if session not in sessions:
+                sessions.append(session)
+            return session
+        self.client._get_async_session = track
+
+        with self.app.test_client() as test_client:
+            for _ in range(2):
+                redirect = test_client.get('/login')
+                state = parse_qs(urlsplit(
+                    redirect.headers['Location']).query)['state'][0]
+                test_client.get('/callback', query_string={
+                    'code': 'abc', 'state': state, 'me': 'http://foo.bar/'})
+
+        self.assertTrue(sessions)
+        self.assertTrue(all(session.is_closed for session in sessions))
+        self.assertEqual(0, len(self.client._async_sessions))
+
+    def test_token_endpoint_down(self):
+        def handle_request(request):
+            if request.url.host == 'baz.bux':
+                raise httpx.ConnectError('connection refused', request=request)
+            return self.handle_request(request)
+        self.client.transport = httpx.MockTransport(handle_request)
+
+        with self.app.test_client() as test_client:
+            redirect = test_client.get('/login')
+            location = urlsplit(redirect.headers['Location'])
+            state = parse_qs(location.query)['state'][0]
+            resp = test_client.get('/callback', query_string={
+                'code': 'abc', 'state': state, 'me': 'http://foo.bar/'})
+
+        self.assertEqual(
+            'request to token endpoint failed: connection refused',
+            json.loads(resp.get_data(as_text=True))[5])
+
+    def test_homepage_down(self):
+        def handle_request(request):
+            raise httpx.ConnectError('connection refused', request=request)
+        self.client.transport = httpx.MockTransport(handle_request)
+
+        with self.app.test_client() as test_client:
+            redirect = test_client.get('/login')
+            self.assertEqual('/callback',
+                             urlsplit(redirect.headers['Location']).path)
+            resp = test_client.get(redirect.headers['Location'])
+        self.assertEqual(
+            'could not discover endpoints: connection refused',
+            json.loads(resp.get_data(as_text=True))[5])
+
+    def test_head_error_falls_back_to_get(self):
+        import asyncio
+
+        def handle_request(request):
+            self.requests.append(request.method)
+            if request.method == 'HEAD':
+                raise httpx.ReadTimeout('timed out', request=request)
+            return httpx.Response(200, headers={'Link': LINK_HEADER})
+        self.client.transport = httpx.MockTransport(handle_request)
+        self.client.discovery_head_first = True
+
+        result = asyncio.run(self.client.discover('http://foo.bar/'))
+        self.assertIsNone(result.error)
+        self.assertEqual('http://do.re/micropub', result.micropub_endpoint)
+        self.assertEqual(['HEAD', 'GET'], self.requests)
+
+    def test_token_required(self):
+        def handle_request(request):
+            self.requests.append((request.method, str(request.url)))
+            self.assertEqual('Bearer abc', request.headers['Authorization'])
+            return httpx.Response(200, json={
+                'me': 'http://foo.bar/', 'scope': 'create'})
+        self.client.transport = httpx.MockTransport(handle_request)
+        self.client.token_endpoint = 'http://baz.bux/token'
+
+        @self.app.route('/micropub', methods=['POST'])
+        @self.client.token_required(scope='create')
+        async def micropub():
+            return flask.g.micropub_token.me
+
+        with self.app.test_client() as test_client:
+            for _ in range(2):
+                resp = test_client.post('/micropub', data={'access_token': 'abc'})
+                self.assertEqual('http://foo.bar/', resp.get_data(as_text=True))
+        self.assertEqual([('GET', 'http://baz.bux/token')], self.requests)
+
+    def test_refresh(self):
+        import asyncio
+
+        def handle_request(request):
+            data = parse_qs(request.content.decode('utf-8'))
+            self.assertEqual(['refresh_token'], data['grant_type'])
+            return httpx.Response(200, json={
+                'access_token': 'new', 'refresh_token': 'refresh2',
+                'expires_in': 60})
+        self.client.transport = httpx.MockTransport(handle_request)
+
+        auth = flask_micropub.AuthResponse(
+            me='http://foo.bar/', access_token='token',
+            refresh_token='refresh1', token_endpoint='http://baz.bux/token')
+        results = asyncio.run(self.client.refresh_batch(
+            [auth, auth.replace(refresh_token=None)]))
+        self.assertEqual(('new', 'refresh2'), (
+            results[0].access_token, results[0].refresh_token))
+        self.assertIsNotNone(results[0].expires)
+        self.assertEqual('no_refresh_token', results[1].error_code)
+
+    def test_prewarm(self):
+        import asyncio
+
+        results = asyncio.run(self.client.prewarm(['foo.bar', 'http://other.example/']))
+        self.assertEqual([None, 'HTTP 404'], [result.error for result in results])
+        self.assertEqual('http://foo.bar/auth', results[0].authorization_endpoint)
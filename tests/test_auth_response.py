@@ -0,0 +1,80 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import pickle
+import unittest
+
+import flask_micropub
+
+
+class AuthResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resp = flask_micropub.AuthResponse(
+            me='http://foo.bar/', micropub_endpoint='http://do.re/micropub',
+            access_token='token', state='s', scope='create')
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.resp.me = 'http://other.example/'
+        self.assertFalse(hasattr(self.resp, '__dict__'))
+        self.assertEqual('s', self.resp.next_url)
+
+    def test_round_trips(self):
+        for resp in (self.resp, flask_micropub.AuthResponse(
+                state='s', error='mismatched CSRF token',
+                error_code='mismatched_csrf_token')):
+            self.assertEqual(resp, flask_micropub.AuthResponse.from_dict(resp.to_dict()))
+            self.assertEqual(resp, flask_micropub.AuthResponse.from_json(resp.to_json()))
+            self.assertEqual(resp, flask_micropub.AuthResponse.from_bytes(resp.to_bytes()))
+            self.assertEqual(resp, pickle.loads(pickle.dumps(resp)))
+
+    def test_legacy_pickles(self):
+        # pickled by flask-micropub 0.2.8, before AuthResponse was slotted
+        for data in (
+                b'\x80\x02cflask_micropub\nAuthResponse\nq\x00)\x81q\x01}q\x02(X'
+                b'\x02\x00\x00\x00meq\x03X\x0f\x00\x00\x00http://foo.bar/q\x04X\x11'
+                b'\x00\x00\x00micropub_endpointq\x05X\x15\x00\x00\x00http://do.re/'
+                b'micropubq\x06X\x0c\x00\x00\x00access_tokenq\x07X\x05\x00\x00\x00'
+                b'tokenq\x08X\x08\x00\x00\x00next_urlq\tX\x01\x00\x00\x00sq\nX'
+                b'\x05\x00\x00\x00stateq\x0bh\nX\x05\x00\x00\x00scopeq\x0cX\x06'
+                b'\x00\x00\x00createq\rX\x05\x00\x00\x00errorq\x0eNub.',
+                b'ccopy_reg\n_reconstructor\np0\n(cflask_micropub\nAuthResponse\n'
+                b'p1\nc__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nVme\np6\n'
+                b'Vhttp://foo.bar/\np7\nsVmicropub_endpoint\np8\n'
+                b'Vhttp://do.re/micropub\np9\nsVaccess_token\np10\nVtoken\np11\n'
+                b'sVnext_url\np12\nVs\np13\nsVstate\np14\ng13\nsVscope\np15\n'
+                b'Vcreate\np16\nsVerror\np17\nNsb.'):
+            resp = pickle.loads(data)
+            self.assertEqual(self.resp, resp)
+            self.assertEqual('s', resp.next_url)
+            self.assertIsNone(resp.refresh_token)
+            with self.assertRaises(AttributeError):
+                resp.me = 'http://other.example/'
+
+    def test_compact_formats(self):
+        self.assertEqual(
+            b'[1,"http://foo.bar/","http://do.re/micropub","token","s","create"]',
+            self.resp.to_bytes())
+        self.assertEqual({'v': 1, 'state': 's', 'error': 'expired state token',
+                          'error_code': 'expired_state'},
+                         flask_micropub.AuthResponse(
+                             state='s', error='expired state token',
+                             error_code='expired_state').to_dict())
+
+    def test_replace(self):
+        refreshed = self.resp.replace(
+            access_token='new', refresh_token='refresh', expires=1)
+        self.assertEqual('token', self.resp.access_token)
+        self.assertEqual(('http://foo.bar/', 'new', 'refresh'), (
+            refreshed.me, refreshed.access_token, refreshed.refresh_token))
+        self.assertTrue(refreshed.expired)
+        self.assertFalse(self.resp.expired)
+        self.assertEqual(refreshed, flask_micropub.AuthResponse.from_bytes(
+            refreshed.to_bytes()))
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            flask_micropub.AuthResponse.from_dict({'v': 2, 'me': 'http://foo.bar/'})
+        with self.assertRaises(ValueError):
+            flask_micropub.AuthResponse.from_bytes(b'[2,"http://foo.bar/"]')
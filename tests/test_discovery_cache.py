@@ -0,0 +1,360 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import asyncio
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import flask
+import requests
+
+import flask_micropub
+
+try:
+    from unittest import mock
+except:
+    import mock
+
+
+def link_response(status_code=200, **headers):
+    r = requests.Response()
+    r.headers['Link'] = '<http://foo.bar/auth>;rel=authorization_endpoint, <http://baz.bux/token>;rel=token_endpoint, <http://do.re/micropub>;rel=micropub'
+    r.headers.update(headers)
+    r.raw = io.BytesIO()
+    r.status_code = status_code
+    return r
+
+
+class DiscoveryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = flask_micropub.MicropubClient()
+
+    @mock.patch('requests.Session.get')
+    def test_fresh_entry_skips_fetch(self, get_method):
+        get_method.return_value = link_response(**{'Cache-Control': 'max-age=60'})
+        first = self.client._discover_endpoints('http://foo.bar/')
+        second = self.client._discover_endpoints('HTTP://FOO.BAR')
+        self.assertEqual(1, get_method.call_count)
+        self.assertEqual(first, second)
+
+    @mock.patch('requests.Session.get')
+    def test_stale_entry_revalidated(self, get_method):
+        get_method.return_value = link_response(
+            ETag='"v1"', **{'Cache-Control': 'no-cache'})
+        expected = self.client._discover_endpoints('http://foo.bar/')
+
+        not_modified = requests.Response()
+        not_modified.status_code = 304
+        not_modified.raw = io.BytesIO()
+        get_method.return_value = not_modified
+        result = self.client._discover_endpoints('http://foo.bar/')
+
+        get_method.assert_called_with(
+            'http://foo.bar/', headers={'If-None-Match': '"v1"'}, timeout=(5, 10),
+            stream=True)
+        self.assertEqual(expected, result)
+
+    @mock.patch('requests.Session.get')
+    def test_no_store_is_not_cached(self, get_method):
+        get_method.return_value = link_response(**{'Cache-Control': 'no-store'})
+        self.client._discover_endpoints('http://foo.bar/')
+        self.client._discover_endpoints('http://foo.bar/')
+        self.assertEqual(2, get_method.call_count)
+
+    def test_cache_expiry(self):
+        self.assertEqual(1030, flask_micropub.cache_expiry(
+            {'Cache-Control': 'public, max-age=60', 'Age': '30'}, 1000, 300))
+        self.assertEqual(1300, flask_micropub.cache_expiry({}, 1000, 300))
+        self.assertEqual(1100, flask_micropub.cache_expiry(
+            {'Cache-Control': 'max-age=600'}, 1000, 300, max_ttl=100))
+        self.assertEqual(1120, flask_micropub.cache_expiry({
+            'Date': 'Thu, 01 Jan 2015 00:00:00 GMT',
+            'Expires': 'Thu, 01 Jan 2015 00:02:00 GMT',
+        }, 1000, 300))
+        self.assertIsNone(flask_micropub.cache_expiry(
+            {'Cache-Control': 'no-store'}, 1000, 300))
+
+    def test_lru_eviction(self):
+        cache = flask_micropub.LRUDiscoveryCache(max_size=2)
+        entry = flask_micropub.DiscoveryCacheEntry((None, None, None), 0)
+        cache.set('a', entry)
+        cache.set('b', entry)
+        cache.get('a')
+        cache.set('c', entry)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(2, len(cache))
+
+
+class DiscoveryStrategyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = flask_micropub.MicropubClient()
+        self.client.discovery_head_first = True
+
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.head')
+    def test_head_satisfies_discovery(self, head_method, get_method):
+        head_method.return_value = link_response()
+        result = self.client._discover_endpoints('http://foo.bar/')
+        self.assertEqual(('http://foo.bar/auth', 'http://baz.bux/token', 'http://do.re/micropub'), result)
+        self.assertFalse(get_method.called)
+
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.head')
+    def test_falls_back_to_get(self, head_method, get_method):
+        head = requests.Response()
+        head.status_code = 200
+        head_method.return_value = head
+        get_method.return_value = link_response()
+        result = self.client._discover_endpoints('http://foo.bar/')
+        self.assertEqual(('http://foo.bar/auth', 'http://baz.bux/token', 'http://do.re/micropub'), result)
+        get_method.assert_called_once_with(
+            'http://foo.bar/', headers={}, timeout=(5, 10), stream=True)
+
+
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.head')
+    def test_head_error_falls_back_to_get(self, head_method, get_method):
+        head_method.side_effect = requests.ConnectionError('reset')
+        get_method.return_value = link_response()
+        result = self.client.discover('http://foo.bar/')
+        self.assertIsNone(result.error)
+        self.assertEqual('http://do.re/micropub', result.micropub_endpoint)
+        self.assertEqual(1, get_method.call_count)
+
+class DiscoveryCoalescingTest(unittest.TestCase):
+
+    def test_concurrent_discoveries_share_a_fetch(self):
+        client = flask_micropub.MicropubClient()
+        started = threading.Event()
+        release = threading.Event()
+
+        def get(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return link_response()
+
+        with mock.patch.object(client.session, 'get', side_effect=get) as get_method:
+            results = []
+            threads = [threading.Thread(target=lambda me=me: results.append(
+                client._discover_endpoints(me))) for me in ['foo.bar', 'http://foo.bar/', 'http://FOO.bar']]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(1, get_method.call_count)
+        self.assertEqual(3, len(results))
+        self.assertEqual(1, len(set(results)))
+
+    def test_async_single_flight(self):
+        flights = flask_micropub.AsyncSingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        async def main():
+            return await asyncio.gather(*[flights.do('key', fetch) for _ in range(5)])
+
+        self.assertEqual(5 * ['result'], asyncio.run(main()))
+        self.assertEqual(1, len(calls))
+
+
+    def test_async_single_flight_cancelled(self):
+        flights = flask_micropub.AsyncSingleFlight()
+        calls = []
+        other_loop = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        def follow():
+            # a follower in an event loop of its own, as in a Flask view
+            other_loop.append(asyncio.run(flights.do('key', fetch)))
+
+        async def main():
+            leader = asyncio.ensure_future(flights.do('key', fetch))
+            await asyncio.sleep(0)
+            cancelled = asyncio.ensure_future(flights.do('key', fetch))
+            follower = asyncio.ensure_future(flights.do('key', fetch))
+            thread = threading.Thread(target=follow)
+            thread.start()
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            result = await follower
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+            return leader.cancelled(), cancelled.cancelled(), result
+
+        self.assertEqual((True, True, 'result'), asyncio.run(main()))
+        self.assertEqual(['result'], other_loop)
+        self.assertEqual(2, len(calls))
+        self.assertNotIn('key', flights._flights)
+
+class PrewarmTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask('test')
+        self.client = flask_micropub.MicropubClient(self.app)
+
+    def get(self, url, **kwargs):
+        if 'down' in url:
+            raise requests.ConnectionError('connection refused')
+        return link_response(**{'Cache-Control': 'max-age=60'})
+
+    def test_prewarm_fills_cache(self):
+        with mock.patch.object(self.client.session, 'get', side_effect=self.get) as get_method:
+            results = self.client.prewarm(['foo.bar', 'http://down.example/', 'https://baz.bux/'])
+            self.assertEqual(['http://foo.bar', 'http://down.example/', 'https://baz.bux/'],
+                             [result.me for result in results])
+            self.assertEqual([None, 'connection refused', None],
+                             [result.error for result in results])
+            self.assertEqual(3, get_method.call_count)
+
+            self.assertTrue(self.client.discover('http://foo.bar/').cached)
+            self.assertEqual(3, get_method.call_count)
+
+    def test_cli(self):
+        self.client.discovery_cache = flask_micropub.LRUDiscoveryCache()
+        runner = self.app.test_cli_runner()
+        with mock.patch.object(self.client.session, 'get', side_effect=self.get):
+            result = runner.invoke(args=['micropub', 'prewarm', '--quiet', '-'],
+                                   input='# users\nfoo.bar\n\nhttp://down.example/\n')
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('http://down.example/  connection refused', result.output)
+        self.assertNotIn('foo.bar', result.output)
+        self.assertIn('warmed 1 of 2 sites', result.output)
+
+
+class SQLiteDiscoveryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'discovery.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def entry(self, expires, **kwargs):
+        return flask_micropub.DiscoveryCacheEntry(
+            ('http://foo.bar/auth', 'http://baz.bux/token', None),
+            expires=expires, **kwargs)
+
+    def test_survives_restart(self):
+        cache = flask_micropub.SQLiteDiscoveryCache(self.path)
+        entry = self.entry(time.time() + 60, etag='"v1"', fetched=time.time())
+        cache.set('http://foo.bar/', entry)
+        cache.close()
+
+        restarted = flask_micropub.SQLiteDiscoveryCache(self.path)
+        self.assertEqual(entry.to_dict(), restarted.get('http://foo.bar/').to_dict())
+        restarted.delete('http://foo.bar/')
+        self.assertIsNone(cache.get('http://foo.bar/'))
+
+    def test_shared_between_threads(self):
+        cache = flask_micropub.SQLiteDiscoveryCache(self.path)
+        threads = [threading.Thread(target=cache.set, args=(
+            'http://user{}.example/'.format(n), self.entry(time.time() + 60)))
+            for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8, len(cache))
+
+    def test_compaction(self):
+        cache = flask_micropub.SQLiteDiscoveryCache(
+            self.path, max_size=3, max_stale=60, compact_every=5)
+        now = time.time()
+        cache.set('http://old.example/', self.entry(now - 120))
+        for n in range(4):
+            cache.set('http://user{}.example/'.format(n), self.entry(now + n))
+        self.assertEqual(3, len(cache))
+        self.assertIsNone(cache.get('http://old.example/'))
+        self.assertIsNone(cache.get('http://user0.example/'))
+        self.assertIsNotNone(cache.get('http://user3.example/'))
+
+    @mock.patch('requests.Session.get')
+    def test_configured_by_path(self, get_method):
+        get_method.return_value = link_response(**{'Cache-Control': 'max-age=60'})
+        app = flask.Flask('test')
+        app.config['MICROPUB_DISCOVERY_CACHE_PATH'] = self.path
+        flask_micropub.MicropubClient(app).discover('http://foo.bar/')
+
+        # a new worker finds the discovery on disk
+        restarted = flask_micropub.MicropubClient(app)
+        self.assertIsInstance(restarted.discovery_cache, flask_micropub.SQLiteDiscoveryCache)
+        self.assertTrue(restarted.discover('http://foo.bar/').cached)
+        self.assertEqual(1, get_method.call_count)
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask('test')
+        self.app.config['SECRET_KEY'] = 'secret'
+        self.app.config['MICROPUB_PREFETCH_BURST'] = 2
+        self.client = flask_micropub.MicropubClient(self.app)
+        self.app.register_blueprint(self.client.prefetch_blueprint(url_prefix='/micropub'))
+
+        @self.app.route('/login')
+        def login():
+            return self.client.authenticate(flask.request.args['me'])
+
+        @self.app.route('/callback')
+        @self.client.authenticated_handler
+        def callback(resp):
+            return ''
+
+    def wait_for_prefetches(self):
+        deadline = time.time() + 5
+        while self.client._prefetches and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_prefetch_warms_login(self):
+        release = threading.Event()
+
+        def get(*args, **kwargs):
+            release.wait(5)
+            return link_response()
+
+        with mock.patch.object(self.client.session, 'get', side_effect=get) as get_method:
+            with self.app.test_client() as test_client:
+                resp = test_client.post('/micropub/prefetch', data={'me': 'foo.bar'})
+                self.assertEqual(202, resp.status_code)
+                self.assertEqual({'prefetch': 'started'}, resp.get_json())
+                resp = test_client.post('/micropub/prefetch', data={'me': 'http://FOO.bar/'})
+                self.assertEqual({'prefetch': 'pending'}, resp.get_json())
+
+                release.set()
+                self.wait_for_prefetches()
+                self.assertEqual('cached', self.client.prefetch('foo.bar'))
+                resp = test_client.get('/login', query_string={'me': 'foo.bar'})
+                self.assertEqual('http://foo.bar/auth', resp.headers['Location'].split('?')[0])
+        self.assertEqual(1, get_method.call_count)
+
+    def test_rate_limited(self):
+        with mock.patch.object(self.client.session, 'get', return_value=link_response()):
+            with self.app.test_client() as test_client:
+                codes = [test_client.post('/micropub/prefetch', data={
+                    'me': 'user{}.example'.format(n)}).status_code for n in range(3)]
+                self.assertEqual(400, test_client.post(
+                    '/micropub/prefetch', data={'me': 'http:// /'}).status_code)
+            self.wait_for_prefetches()
+        self.assertEqual([202, 202, 429], codes)
@@ -0,0 +1,447 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import io
+import json
+import threading
+import time
+import unittest
+
+import flask
+import requests
+
+import flask_micropub
+
+try:
+    from unittest import mock
+except:
+    import mock
+
+try:
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from urlparse import urlsplit, parse_qs
+
+
+def homepage(url, token_endpoint='http://baz.bux/token'):
+    r = requests.Response()
+    r.url = url
+    r.headers['Link'] = '<http://foo.bar/auth>;rel=authorization_endpoint, <{}>;rel=token_endpoint, <http://do.re/micropub>;rel=micropub'.format(token_endpoint)
+    r.raw = io.BytesIO()
+    r.status_code = 200
+    return r
+
+
+def token_response(me='http://foo.bar/'):
+    r = requests.Response()
+    r.headers['Content-Type'] = 'application/json'
+    r._content = json.dumps({
+        'access_token': 'token', 'me': me, 'scope': 'post'}).encode('utf-8')
+    r.status_code = 200
+    return r
+
+
+class AuthorizeFlowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask('test')
+        self.app.config['SECRET_KEY'] = 'secret'
+        # make sure nothing is served from the discovery cache
+        self.app.config['MICROPUB_DISCOVERY_CACHE_SIZE'] = 0
+        self.client = flask_micropub.MicropubClient(self.app)
+
+        @self.app.route('/login')
+        def login():
+            return self.client.authorize(
+                flask.request.args['me'], state='s', scope='post')
+
+        @self.app.route('/callback')
+        @self.client.authorized_handler
+        def callback(resp):
+            self.resp = resp
+            return json.dumps([resp.me, resp.access_token,
+                               resp.micropub_endpoint, resp.error])
+
+    def authorize(self, me, callback_me):
+        with self.app.test_client() as test_client:
+            redirect = test_client.get('/login', query_string={'me': me})
+            location = urlsplit(redirect.headers['Location'])
+            state = parse_qs(location.query)['state'][0]
+            resp = test_client.get('/callback', query_string={
+                'code': 'abc', 'state': state, 'me': callback_me})
+            return json.loads(resp.get_data(as_text=True))
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_callback_reuses_endpoints(self, get_method, post_method):
+        get_method.return_value = homepage('http://foo.bar/')
+        post_method.return_value = token_response()
+        self.assertEqual(
+            ['http://foo.bar/', 'token', 'http://do.re/micropub', None],
+            self.authorize('foo.bar', 'http://foo.bar/'))
+        self.assertEqual(1, get_method.call_count)
+        self.assertEqual('http://baz.bux/token', post_method.call_args[0][0])
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_callback_keeps_refresh_token(self, get_method, post_method):
+        get_method.return_value = homepage('http://foo.bar/')
+        post_method.return_value = token_response()
+        post_method.return_value._content = json.dumps({
+            'access_token': 'token', 'me': 'http://foo.bar/', 'scope': 'post',
+            'refresh_token': 'refresh', 'expires_in': 3600}).encode('utf-8')
+        self.authorize('foo.bar', 'http://foo.bar/')
+        self.assertEqual('refresh', self.resp.refresh_token)
+        self.assertEqual('http://baz.bux/token', self.resp.token_endpoint)
+        self.assertAlmostEqual(time.time() + 3600, self.resp.expires, delta=5)
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_callback_saves_to_token_store(self, get_method, post_method):
+        store = mock.Mock(spec=flask_micropub.TokenStore)
+        self.client.token_store = store
+        get_method.return_value = homepage('http://foo.bar/')
+        post_method.return_value = token_response()
+        self.authorize('foo.bar', 'http://foo.bar/')
+        store.save.assert_called_once_with(self.resp)
+
+        store.reset_mock()
+        post_method.return_value.status_code = 400
+        self.authorize('foo.bar', 'http://foo.bar/')
+        store.save.assert_not_called()
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_callback_for_other_user_rediscovers(self, get_method, post_method):
+        get_method.side_effect = [
+            homepage('http://foo.bar/'),
+            homepage('http://other.example/', 'http://other.example/token'),
+        ]
+        post_method.return_value = token_response('http://other.example/')
+        self.authorize('foo.bar', 'http://other.example/')
+        self.assertEqual(2, get_method.call_count)
+        self.assertEqual('http://other.example/token', post_method.call_args[0][0])
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_verify_endpoints(self, get_method, post_method):
+        self.client.verify_endpoints = True
+        get_method.side_effect = [
+            homepage('http://foo.bar/'),
+            homepage('http://foo.bar/', 'http://evil.example/token'),
+        ]
+        result = self.authorize('foo.bar', 'http://foo.bar/')
+        self.assertEqual('endpoints changed since authorization began', result[3])
+        self.assertFalse(post_method.called)
+
+
+class StatelessFlowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask('test')
+        self.app.config['SECRET_KEY'] = 'secret'
+        self.app.config['MICROPUB_STATELESS'] = True
+        self.client = flask_micropub.MicropubClient(self.app)
+
+        @self.app.route('/login')
+        def login():
+            return self.client.authorize('foo.bar', state='s', scope='post')
+
+        @self.app.route('/callback')
+        @self.client.authorized_handler
+        def callback(resp):
+            return json.dumps([resp.me, resp.access_token, resp.state,
+                               resp.error])
+
+    def callback(self, test_client, state, cookie=None):
+        resp = test_client.get('/callback', query_string={
+            'code': 'abc', 'state': state, 'me': 'http://foo.bar/'},
+            headers={'Cookie': cookie} if cookie else {})
+        self.response = resp
+        return json.loads(resp.get_data(as_text=True))
+
+    def login(self):
+        redirect = self.app.test_client().get('/login')
+        state = parse_qs(urlsplit(redirect.headers['Location']).query)['state'][0]
+        return state, redirect.headers['Set-Cookie']
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_signed_state(self, get_method, post_method):
+        get_method.return_value = homepage('http://foo.bar/')
+        post_method.return_value = token_response()
+        state, set_cookie = self.login()
+        # the state token is tied to the browser with a cookie, not the
+        # session
+        self.assertIn('HttpOnly', set_cookie)
+        self.assertIn('SameSite=Lax', set_cookie)
+        self.assertIn('Path=/callback', set_cookie)
+        self.assertNotIn('session=', set_cookie)
+        cookie = set_cookie.split(';')[0]
+
+        # a fresh client, i.e. with no session, sending only the cookie
+        self.assertEqual(['http://foo.bar/', 'token', 's', None],
+                         self.callback(self.app.test_client(use_cookies=False), state, cookie))
+        self.assertIn(cookie.split('=')[0] + '=;',
+                      self.response.headers['Set-Cookie'])
+        self.assertEqual('state token already used',
+                         self.callback(self.app.test_client(use_cookies=False), state, cookie)[3])
+        self.assertEqual('mismatched CSRF token',
+                         self.callback(self.app.test_client(use_cookies=False), state[:-2], cookie)[3])
+        self.assertEqual(1, post_method.call_count)
+
+    @mock.patch('requests.Session.get')
+    def test_state_from_another_browser(self, get_method):
+        # an attacker's state token, sent to a victim (login CSRF)
+        get_method.return_value = homepage('http://foo.bar/')
+        state, _ = self.login()
+        _, victim_cookie = self.login()
+        self.assertEqual('mismatched CSRF token',
+                         self.callback(self.app.test_client(use_cookies=False), state)[3])
+        self.assertEqual('mismatched CSRF token', self.callback(
+            self.app.test_client(use_cookies=False), state, victim_cookie.split(';')[0])[3])
+
+    @mock.patch('requests.Session.get')
+    def test_expired_state(self, get_method):
+        get_method.return_value = homepage('http://foo.bar/')
+        self.client.state_max_age = -1
+        redirect = self.app.test_client(use_cookies=False).get('/login')
+        state = parse_qs(urlsplit(redirect.headers['Location']).query)['state'][0]
+        self.assertEqual('expired state token',
+                         self.callback(self.app.test_client(use_cookies=False), state)[3])
+
+
+class FailureHandlingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask('test')
+        self.app.config['SECRET_KEY'] = 'secret'
+        self.app.config['MICROPUB_BREAKER_FAILURES'] = 2
+        self.client = flask_micropub.MicropubClient(self.app)
+
+    @mock.patch('requests.Session.get')
+    def test_failure_is_negatively_cached(self, get_method):
+        get_method.side_effect = requests.ConnectionError('refused')
+        first = self.client.discover('http://foo.bar/')
+        second = self.client.discover('http://foo.bar/')
+        self.assertEqual(1, get_method.call_count)
+        self.assertEqual('refused', first.error)
+        self.assertTrue(second.cached)
+        self.assertEqual('refused', second.error)
+
+    @mock.patch('requests.Session.get')
+    def test_error_status_is_negatively_cached(self, get_method):
+        get_method.return_value = homepage('http://foo.bar/')
+        get_method.return_value.status_code = 404
+        self.assertEqual('HTTP 404', self.client.discover('http://foo.bar/').error)
+        self.assertEqual('HTTP 404', self.client.discover('http://foo.bar/').error)
+        self.assertEqual(1, get_method.call_count)
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_breaker_opens_after_failures(self, get_method, post_method):
+        self.client.discovery_cache = None
+        get_method.return_value = homepage('http://foo.bar/')
+        post_method.side_effect = requests.Timeout('read timed out')
+
+        @self.app.route('/login')
+        def login():
+            return self.client.authorize('foo.bar', scope='post')
+
+        @self.app.route('/callback')
+        @self.client.authorized_handler
+        def callback(resp):
+            return resp.error
+
+        errors = []
+        with self.app.test_client() as test_client:
+            for _ in range(3):
+                redirect = test_client.get('/login')
+                location = urlsplit(redirect.headers['Location'])
+                state = parse_qs(location.query)['state'][0]
+                errors.append(test_client.get('/callback', query_string={
+                    'code': 'abc', 'state': state, 'me': 'http://foo.bar/'}
+                ).get_data(as_text=True))
+
+        self.assertEqual(2, post_method.call_count)
+        self.assertEqual('request to token endpoint failed: read timed out',
+                         errors[0])
+        self.assertTrue(errors[2].startswith(
+            'token endpoint unavailable: too many failures from baz.bux'))
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_failed_discovery_fails_login(self, get_method, post_method):
+        get_method.side_effect = requests.ConnectionError('refused')
+
+        @self.app.route('/login')
+        def login():
+            return self.client.authorize('foo.bar', state='s', scope='post')
+
+        @self.app.route('/callback')
+        @self.client.authorized_handler
+        def callback(resp):
+            return json.dumps([resp.error_code, resp.error, resp.state])
+
+        with self.app.test_client() as test_client:
+            redirect = test_client.get('/login')
+            # straight back to the callback, not on to indieauth.com
+            location = urlsplit(redirect.headers['Location'])
+            self.assertEqual(('localhost', '/callback'),
+                             (location.netloc, location.path))
+            resp = test_client.get(redirect.headers['Location'])
+            self.assertEqual(
+                ['endpoint_unavailable',
+                 'could not discover endpoints: refused', 's'],
+                json.loads(resp.get_data(as_text=True)))
+        self.assertEqual(1, get_method.call_count)
+        post_method.assert_not_called()
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_failed_start_does_not_stick(self, get_method, post_method):
+        self.app.config['MICROPUB_REUSE_ENDPOINTS'] = False
+        self.client.init_app(self.app)
+        self.client.discovery_cache = None
+
+        @self.app.route('/login')
+        def login():
+            return self.client.authorize('foo.bar', scope='post')
+
+        @self.app.route('/callback')
+        @self.client.authorized_handler
+        def callback(resp):
+            return json.dumps([resp.access_token, resp.error_code])
+
+        down = homepage('http://foo.bar/')
+        down.status_code = 500
+        get_method.return_value = down
+        post_method.return_value = token_response()
+        with self.app.test_client() as test_client:
+            # the first login fails, and is abandoned
+            test_client.get('/login')
+            # the homepage is back by the next one
+            get_method.return_value = homepage('http://foo.bar/')
+            redirect = test_client.get('/login')
+            state = parse_qs(urlsplit(
+                redirect.headers['Location']).query)['state'][0]
+            resp = test_client.get('/callback', query_string={
+                'code': 'abc', 'state': state, 'me': 'http://foo.bar/'})
+        self.assertEqual(['token', None], json.loads(resp.get_data(as_text=True)))
+
+    @mock.patch('requests.Session.get')
+    def test_failed_rediscovery_on_callback(self, get_method):
+        self.app.config['MICROPUB_REUSE_ENDPOINTS'] = False
+        self.client.init_app(self.app)
+
+        @self.app.route('/login')
+        def login():
+            return self.client.authorize('foo.bar', scope='post')
+
+        @self.app.route('/callback')
+        @self.client.authorized_handler
+        def callback(resp):
+            return resp.error_code
+
+        get_method.return_value = homepage('http://foo.bar/')
+        with self.app.test_client() as test_client:
+            redirect = test_client.get('/login')
+            state = parse_qs(urlsplit(
+                redirect.headers['Location']).query)['state'][0]
+            self.client.discovery_cache = None
+            get_method.return_value = None
+            get_method.side_effect = requests.ConnectionError('refused')
+            resp = test_client.get('/callback', query_string={
+                'code': 'abc', 'state': state, 'me': 'http://foo.bar/'})
+        self.assertEqual('endpoint_unavailable', resp.get_data(as_text=True))
+
+    def test_breaker_trial_call(self):
+        breaker = flask_micropub.CircuitBreaker(max_failures=1, reset_timeout=0)
+        breaker.failed()
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.succeeded()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_cancelled_trial_call(self):
+        import asyncio
+
+        self.client.breaker_failures = 1
+        self.client.breaker_reset_timeout = 0
+        with self.assertRaises(requests.ConnectionError):
+            with self.client._circuit('http://baz.bux/token'):
+                raise requests.ConnectionError('refused')
+        # a cancelled trial call counts as failed, so the breaker can
+        # let another trial call through instead of staying open forever
+        with self.assertRaises(asyncio.CancelledError):
+            with self.client._circuit('http://baz.bux/token'):
+                raise asyncio.CancelledError()
+        breaker = self.client.circuit_breakers.get('baz.bux')
+        self.assertTrue(breaker.allow())
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        flask_micropub.outbound_call.connect(self.record)
+        self.client = flask_micropub.MicropubClient()
+
+    def tearDown(self):
+        flask_micropub.outbound_call.disconnect(self.record)
+
+    def record(self, sender, call):
+        self.calls.append(call)
+
+    @mock.patch('requests.Session.get')
+    def test_discovery_calls(self, get_method):
+        get_method.return_value = homepage('http://foo.bar/')
+        self.client.discover('http://foo.bar/')
+        self.client.discover('http://foo.bar/')
+        self.assertEqual(['miss', 'hit'], [call.cache for call in self.calls])
+        self.assertEqual('2xx', self.calls[0].status_class)
+        self.assertEqual('foo.bar', self.calls[0].host)
+        self.assertIsNotNone(self.calls[1].duration)
+
+    @mock.patch('requests.Session.get')
+    def test_shared_discovery(self, get_method):
+        started = threading.Event()
+        release = threading.Event()
+
+        def get(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return homepage('http://foo.bar/')
+        get_method.side_effect = get
+
+        threads = [threading.Thread(
+            target=self.client.discover, args=('http://foo.bar/',))
+            for _ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        # the callers that shared the fetch do not report it again
+        self.assertEqual(1, get_method.call_count)
+        self.assertEqual(['miss'], [call.cache for call in self.calls])
+
+    @mock.patch('requests.Session.get')
+    def test_failed_call(self, get_method):
+        get_method.side_effect = requests.ConnectionError()
+        tracer = mock.MagicMock()
+        self.client.tracer = tracer
+        result = self.client.discover('http://foo.bar/')
+        self.assertEqual((None, None, None), result.endpoints)
+        self.assertIsInstance(result.exception, requests.ConnectionError)
+        self.assertEqual('error', self.calls[0].status_class)
+        tracer.start_as_current_span.assert_called_once_with(
+            'micropub.discovery', attributes={
+                'http.method': 'GET', 'http.url': 'http://foo.bar/',
+                'server.address': 'foo.bar'})
+        span_context = tracer.start_as_current_span.return_value
+        self.assertIs(requests.ConnectionError, span_context.__exit__.call_args[0][0])
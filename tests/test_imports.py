@@ -0,0 +1,33 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+HEAVY_MODULES = ['bs4', 'concurrent.futures', 'html.parser', 'requests',
+                 'urllib3']
+
+SCRIPT = '''
+import json, sys
+import flask
+import flask_micropub
+
+app = flask.Flask('test')
+micropub = flask_micropub.MicropubClient(app)
+flask_micropub.AuthResponse.from_bytes(
+    flask_micropub.AuthResponse(me='http://foo.bar/').to_bytes())
+print(json.dumps(sorted(m for m in {} if m in sys.modules)))
+'''.format(HEAVY_MODULES)
+
+
+class ImportTimeTest(unittest.TestCase):
+
+    def test_heavy_dependencies_are_lazy(self):
+        # in a fresh interpreter, since this one has imported them already
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual([], json.loads(output.decode('utf-8')))
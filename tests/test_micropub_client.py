@@ -2,9 +2,11 @@
 from __future__ import unicode_literals, print_function
 
 import collections
+import io
 import json
 import os
 import unittest
+import flask
 import requests
 
 import flask_micropub
@@ -15,25 +17,32 @@ except:
     import mock
 
 
+class KeepOpenBytesIO(io.BytesIO):
+    """A response body that can still be inspected after it is closed."""
+    def close(self):
+        pass
+
+
 class MicropubClientTest(unittest.TestCase):
 
     def setUp(self):
         self.client = flask_micropub.MicropubClient()
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_discover_endpoints_from_http_header(self, get_method):
         r = requests.Response()
         r.headers['Link'] = '<http://foo.bar/auth>;rel=authorization_endpoint, <http://baz.bux/token>;rel=token_endpoint, <http://do.re/micropub>;rel=micropub'
+        r.raw = io.BytesIO()
         r.status_code = 200
         get_method.return_value = r
         result = self.client._discover_endpoints('http://foo.bar/')
-        get_method.assert_called_once_with('http://foo.bar/')
+        get_method.assert_called_once_with('http://foo.bar/', headers={}, timeout=(5, 10), stream=True)
         self.assertEqual(('http://foo.bar/auth', 'http://baz.bux/token', 'http://do.re/micropub'), result)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_discover_endpoints_from_html(self, get_method):
         r = requests.Response()
-        r._content = """
+        r.raw = io.BytesIO("""
 <!DOCTYPE html>
 <html>
   <head>
@@ -44,9 +53,90 @@ class MicropubClientTest(unittest.TestCase):
   <body>
   </body>
 </html>
-""".encode('utf-8')
+""".encode('utf-8'))
         r.status_code = 200
         get_method.return_value = r
         result = self.client._discover_endpoints('http://foo.bar/')
-        get_method.assert_called_once_with('http://foo.bar/')
+        get_method.assert_called_once_with('http://foo.bar/', headers={}, timeout=(5, 10), stream=True)
         self.assertEqual(('http://foo.bar/auth', 'http://baz.bux/token', 'http://do.re/micropub'), result)
+
+    def test_init_app_configures_session(self):
+        app = flask.Flask('test')
+        app.config['MICROPUB_POOL_MAXSIZE'] = 32
+        app.config['MICROPUB_READ_TIMEOUT'] = 3
+        self.client.init_app(app)
+        adapter = self.client.session.get_adapter('https://indieauth.com/')
+        self.assertEqual(32, adapter._pool_maxsize)
+        self.assertEqual((5, 3), self.client.timeout)
+
+    @mock.patch('requests.Session.get')
+    def test_discover_endpoints_stops_reading_early(self, get_method):
+        head = """<html><head>
+    <link href="http://foo.bar/auth" rel="authorization_endpoint">
+    <link href="http://baz.bux/token" rel="token_endpoint">
+    <link href="http://do.re/micropub" rel="micropub">
+  </head>"""
+        body = '<body>' + '<p>lorem ipsum</p>' * 100000 + '</body></html>'
+        r = requests.Response()
+        r.raw = KeepOpenBytesIO((head + body).encode('utf-8'))
+        r.status_code = 200
+        get_method.return_value = r
+        result = self.client._discover_endpoints('http://foo.bar/')
+        self.assertEqual(('http://foo.bar/auth', 'http://baz.bux/token', 'http://do.re/micropub'), result)
+        self.assertLess(r.raw.tell(), 2 * flask_micropub.DISCOVERY_CHUNK_SIZE)
+
+    def test_link_collector_head_only(self):
+        collector = flask_micropub.LinkCollector(
+            ['authorization_endpoint', 'micropub'], head_only=True)
+        collector.feed('<html><head><link rel="authorization_endpoint" href="/auth">')
+        collector.feed('</head><body><link rel="micropub" href="/micropub">')
+        self.assertTrue(collector.done)
+        self.assertEqual({'authorization_endpoint': '/auth'}, collector.links)
+
+    @mock.patch('requests.Session.get')
+    def test_discover_resolves_relative_urls(self, get_method):
+        r = requests.Response()
+        r.url = 'https://www.foo.bar/home/'
+        r.headers['Link'] = '</auth>; rel="authorization_endpoint me"'
+        r.raw = io.BytesIO("""
+<html><head>
+  <base href="/api/">
+  <link href="token" rel="token_endpoint">
+</head><body>
+  <a href="micropub" rel="nofollow Micropub">micropub</a>
+</body></html>""".encode('utf-8'))
+        r.status_code = 200
+        get_method.return_value = r
+        result = self.client.discover('http://foo.bar/')
+        self.assertEqual(('https://www.foo.bar/auth', 'https://www.foo.bar/api/token', 'https://www.foo.bar/api/micropub'), result.endpoints)
+        self.assertEqual('https://www.foo.bar/home/', result.url)
+        self.assertEqual(200, result.status_code)
+        self.assertFalse(result.cached)
+        self.assertGreater(result.bytes_read, 0)
+
+        result = self.client.discover('http://foo.bar/')
+        self.assertTrue(result.cached)
+        self.assertEqual('https://www.foo.bar/api/micropub', result.micropub_endpoint)
+
+    def test_handler_endpoint_memoized_per_app(self):
+        def callback(resp):
+            return ''
+        handler = self.client.authorized_handler(callback)
+
+        app = flask.Flask('app')
+        app.add_url_rule('/callback', 'callback', handler)
+        blueprint = flask.Blueprint('auth', 'auth')
+        blueprint.add_url_rule('/callback', 'callback', handler)
+        other_app = flask.Flask('other')
+        other_app.register_blueprint(blueprint, url_prefix='/auth')
+
+        with mock.patch.object(
+                flask_micropub.MicropubClient, 'flask_endpoint_for_function',
+                wraps=flask_micropub.MicropubClient.flask_endpoint_for_function
+        ) as lookup:
+            for _ in range(3):
+                with app.app_context():
+                    self.assertEqual('callback', self.client._handler_endpoint(handler))
+                with other_app.app_context():
+                    self.assertEqual('auth.callback', self.client._handler_endpoint(handler))
+            self.assertEqual(2, lookup.call_count)
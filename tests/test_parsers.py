@@ -0,0 +1,84 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import importlib
+import io
+import json
+import os
+import unittest
+
+import flask
+
+import flask_micropub
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'discovery_corpus.json')
+
+with io.open(CORPUS, encoding='utf-8') as f:
+    CASES = json.load(f)
+
+
+def installed(module):
+    try:
+        importlib.import_module(module)
+        return True
+    except ImportError:
+        return False
+
+
+class ParserConformanceMixin(object):
+    """Runs every page of the discovery corpus through one backend, both
+    all at once and in small chunks.
+    """
+    parser = None
+
+    def scan(self, case, chunk_size=None):
+        scanner = flask_micropub.BodyLinkScanner(
+            {}, 'utf-8', base_url=case.get('url', 'https://foo.bar/'),
+            head_only=case.get('head_only', False), parser=self.parser)
+        body = case['html'].encode('utf-8')
+        if chunk_size is None:
+            scanner.parse(case['html'])
+        else:
+            for start in range(0, len(body), chunk_size):
+                if scanner.feed(body[start:start + chunk_size]):
+                    break
+        return list(scanner.endpoints())
+
+    def test_corpus(self):
+        for case in CASES:
+            with self.subTest(case['name']):
+                self.assertEqual(case['expected'], self.scan(case))
+
+    def test_corpus_in_chunks(self):
+        for case in CASES:
+            with self.subTest(case['name']):
+                self.assertEqual(case['expected'], self.scan(case, 7))
+
+
+class HTMLParserConformanceTest(ParserConformanceMixin, unittest.TestCase):
+    parser = 'html.parser'
+
+
+@unittest.skipUnless(installed('lxml'), 'requires lxml')
+class LxmlConformanceTest(ParserConformanceMixin, unittest.TestCase):
+    parser = 'lxml'
+
+
+@unittest.skipUnless(installed('bs4'), 'requires BeautifulSoup')
+class SoupConformanceTest(ParserConformanceMixin, unittest.TestCase):
+    parser = 'bs4'
+
+
+class ParserConfigTest(unittest.TestCase):
+
+    def test_selected_by_config(self):
+        app = flask.Flask('test')
+        app.config['MICROPUB_DISCOVERY_PARSER'] = 'bs4'
+        client = flask_micropub.MicropubClient(app)
+        self.assertIs(flask_micropub.SoupLinkParser, client.discovery_parser)
+
+    def test_unknown_parser(self):
+        app = flask.Flask('test')
+        app.config['MICROPUB_DISCOVERY_PARSER'] = 'regex'
+        with self.assertRaises(ValueError):
+            flask_micropub.MicropubClient(app)
@@ -0,0 +1,281 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import collections
+import functools
+import io
+import json
+import threading
+import time
+import unittest
+
+import requests
+
+import flask_micropub
+
+try:
+    from unittest import mock
+except:
+    import mock
+
+
+def created(location='http://foo.bar/1'):
+    r = requests.Response()
+    r.status_code = 201
+    r.headers['Location'] = location
+    r._content = b''
+    return r
+
+
+class MicropubSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.auth = flask_micropub.AuthResponse(
+            me='http://foo.bar/', micropub_endpoint='http://foo.bar/micropub',
+            access_token='token')
+        self.session = flask_micropub.MicropubSession(self.auth)
+
+    @mock.patch('requests.Session.post')
+    def test_create_form_encoded(self, post_method):
+        post_method.return_value = created()
+        result = self.session.create(
+            {'content': 'hello', 'category': ['a', 'b'], 'name': ['title']})
+        self.assertTrue(result.ok)
+        self.assertEqual('http://foo.bar/1', result.location)
+        post_method.assert_called_once_with(
+            'http://foo.bar/micropub',
+            headers={'Authorization': 'Bearer token'}, timeout=(5, 10),
+            data={'h': 'entry', 'content': 'hello', 'category[]': ['a', 'b'],
+                  'name': 'title'})
+
+    @mock.patch('requests.Session.post')
+    def test_create_json_and_update(self, post_method):
+        post_method.return_value = created()
+        self.session.create({'content': 'hello'}, as_json=True)
+        self.assertEqual({'type': ['h-entry'], 'properties': {'content': ['hello']}},
+                         post_method.call_args[1]['json'])
+        self.session.update('http://foo.bar/1', replace={'content': ['bye']})
+        self.assertEqual({'action': 'update', 'url': 'http://foo.bar/1',
+                          'replace': {'content': ['bye']}},
+                         post_method.call_args[1]['json'])
+        self.session.delete('http://foo.bar/1')
+        self.assertEqual({'action': 'delete', 'url': 'http://foo.bar/1'},
+                         post_method.call_args[1]['data'])
+
+    @mock.patch('requests.Session.post')
+    def test_error(self, post_method):
+        r = requests.Response()
+        r.status_code = 403
+        r._content = json.dumps({'error': 'insufficient_scope'}).encode('utf-8')
+        post_method.return_value = r
+        result = self.session.create({'content': 'hello'})
+        self.assertFalse(result.ok)
+        self.assertEqual('micropub request failed. 403: insufficient_scope', result.error)
+
+    def test_requires_token(self):
+        with self.assertRaises(ValueError):
+            flask_micropub.MicropubSession(flask_micropub.AuthResponse(me='http://foo.bar/'))
+
+
+class PublishBatchTest(unittest.TestCase):
+
+    def test_bounded_per_host(self):
+        client = flask_micropub.MicropubClient()
+        lock = threading.Lock()
+        in_flight = collections.Counter()
+        peak = collections.Counter()
+
+        def post(url, **kwargs):
+            host = url.split('/')[2]
+            with lock:
+                in_flight[host] += 1
+                peak[host] = max(peak[host], in_flight[host])
+            time.sleep(0.01)
+            with lock:
+                in_flight[host] -= 1
+            if kwargs['data']['content'] == 'fail':
+                raise requests.ConnectionError('boom')
+            return created(url + '/' + kwargs['data']['content'])
+
+        posts = []
+        for n in range(12):
+            host = 'a.example' if n % 3 else 'b.example'
+            auth = flask_micropub.AuthResponse(
+                me='http://{}/'.format(host), access_token='t',
+                micropub_endpoint='http://{}/micropub'.format(host))
+            posts.append((auth, {'h': 'entry', 'content': 'fail' if n == 5 else str(n)}))
+
+        with mock.patch.object(client.session, 'post', side_effect=post):
+            results = client.publish_batch(posts, max_workers=4, max_per_host=2)
+
+        self.assertEqual(12, len(results))
+        self.assertEqual('http://b.example/micropub/0', results[0].location)
+        self.assertEqual('http://a.example/micropub/11', results[11].location)
+        self.assertEqual('boom', results[5].error)
+        self.assertEqual(2, peak['a.example'])
+        self.assertLessEqual(peak['b.example'], 2)
+
+    def test_many_hosts(self):
+        lock = threading.Lock()
+        in_flight = collections.Counter()
+        calls = []
+
+        def job(host, n):
+            with lock:
+                in_flight[host] += 1
+                in_flight['total'] += 1
+                calls.append((host, n, in_flight[host], in_flight['total']))
+            time.sleep(0.0001)
+            with lock:
+                in_flight[host] -= 1
+                in_flight['total'] -= 1
+            return n
+
+        hosts = ['h{}'.format(n % 500) for n in range(2000)]
+        jobs = [(host, functools.partial(job, host, n))
+                for n, host in enumerate(hosts)]
+        results = flask_micropub.MicropubClient._run_per_host(jobs, 8, 1)
+        self.assertEqual(list(range(2000)), results)
+        self.assertEqual(1, max(call[2] for call in calls))
+        self.assertLessEqual(max(call[3] for call in calls), 8)
+        for host in ('h0', 'h499'):
+            order = [n for h, n, _, _ in calls if h == host]
+            self.assertEqual(sorted(order), order)
+
+    def test_unusable_auth(self):
+        client = flask_micropub.MicropubClient()
+        good = flask_micropub.AuthResponse(
+            me='http://a.example/', access_token='t',
+            micropub_endpoint='http://a.example/micropub')
+        # e.g. a failed authorization, with no token
+        bad = flask_micropub.AuthResponse(
+            me='http://b.example/', error='no micropub endpoint found.')
+        with mock.patch.object(client.session, 'post',
+                               return_value=created('http://a.example/1')):
+            results = client.publish_batch(
+                [(good, {'h': 'entry'}), (bad, {'h': 'entry'})])
+        self.assertEqual('http://a.example/1', results[0].location)
+        self.assertIsNone(results[1].status_code)
+        self.assertIn('access token', results[1].error)
+
+
+class MediaUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.auth = flask_micropub.AuthResponse(
+            me='http://foo.bar/', micropub_endpoint='http://foo.bar/micropub',
+            access_token='token')
+        self.session = flask_micropub.MicropubSession(self.auth)
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_streamed_upload(self, get_method, post_method):
+        config = requests.Response()
+        config.status_code = 200
+        config._content = json.dumps({'media-endpoint': 'http://foo.bar/media'}).encode('utf-8')
+        get_method.return_value = config
+
+        chunks = []
+
+        def post(url, data, headers, timeout):
+            self.assertEqual('http://foo.bar/media', url)
+            chunks.extend(data)
+            self.boundary = headers['Content-Type'].split('boundary=')[1]
+            return created('http://foo.bar/media/photo.jpg')
+        post_method.side_effect = post
+
+        media = io.BytesIO(b'x' * 2500)
+        media.name = '/tmp/photo.jpg'
+        result = self.session.upload(media, chunk_size=1000)
+
+        self.assertEqual('http://foo.bar/media/photo.jpg', result.location)
+        get_method.assert_called_once_with(
+            'http://foo.bar/micropub', params={'q': 'config'},
+            headers={'Authorization': 'Bearer token', 'Accept': 'application/json'},
+            timeout=(5, 10))
+        # preamble, three chunks of the file, epilogue
+        self.assertEqual([1000, 1000, 500], [len(c) for c in chunks[1:-1]])
+        self.assertIn(b'filename="photo.jpg"\r\nContent-Type: image/jpeg\r\n\r\n', chunks[0])
+        self.assertEqual('\r\n--{}--\r\n'.format(self.boundary).encode('utf-8'), chunks[-1])
+
+        self.session.upload(io.BytesIO(b'y'))
+        self.assertEqual(1, get_method.call_count)
+
+
+def query_response(data, **headers):
+    r = requests.Response()
+    r.status_code = 200
+    r.headers.update(headers)
+    r._content = json.dumps(data).encode('utf-8')
+    return r
+
+
+class QueryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = flask_micropub.MicropubClient()
+        auth = flask_micropub.AuthResponse(
+            me='http://foo.bar/', micropub_endpoint='http://foo.bar/micropub',
+            access_token='token')
+        self.session = self.client.publisher(auth)
+
+    @mock.patch('requests.Session.get')
+    def test_cached_by_endpoint_and_token(self, get_method):
+        get_method.return_value = query_response(
+            {'syndicate-to': [{'uid': 'x', 'name': 'X'}]},
+            **{'Cache-Control': 'max-age=300'})
+        self.assertEqual([{'uid': 'x', 'name': 'X'}], self.session.syndicate_to())
+        self.session.syndicate_to()
+        self.assertEqual(1, get_method.call_count)
+
+        other = self.client.publisher(flask_micropub.AuthResponse(
+            micropub_endpoint='http://foo.bar/micropub', access_token='other'))
+        other.syndicate_to()
+        self.session.query('syndicate-to', cache=False)
+        self.assertEqual(3, get_method.call_count)
+
+    @mock.patch('requests.Session.get')
+    def test_no_store(self, get_method):
+        get_method.return_value = query_response(
+            {}, **{'Cache-Control': 'no-store'})
+        self.session.config()
+        self.session.config()
+        self.assertEqual(2, get_method.call_count)
+
+    def test_concurrent_queries_share_a_request(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def get(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return query_response({'media-endpoint': 'http://foo.bar/media'})
+
+        with mock.patch.object(self.client.session, 'get', side_effect=get) as get_method:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(self.session.config()))
+                       for _ in range(5)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, get_method.call_count)
+        self.assertEqual(5 * [{'media-endpoint': 'http://foo.bar/media'}], results)
+
+    @mock.patch('requests.Session.get')
+    def test_refresh_ahead(self, get_method):
+        get_method.return_value = query_response(
+            {'v': 1}, **{'Cache-Control': 'max-age=100'})
+        self.session.config()
+        key, entry = list(self.client.query_cache._entries.items())[0]
+        entry.refresh_at = time.time() - 1
+
+        get_method.return_value = query_response(
+            {'v': 2}, **{'Cache-Control': 'max-age=100'})
+        self.assertEqual({'v': 1}, self.session.config())
+        self.client._executor.shutdown(wait=True)
+        self.assertEqual({'v': 2}, self.client.query_cache.get(key).value)
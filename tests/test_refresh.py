@@ -0,0 +1,200 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import io
+import json
+import threading
+import time
+import unittest
+
+import flask
+import requests
+
+import flask_micropub
+
+try:
+    from unittest import mock
+except:
+    import mock
+
+
+def token_response(status_code=200, **data):
+    r = requests.Response()
+    r.headers['Content-Type'] = 'application/json'
+    r._content = json.dumps(data).encode('utf-8')
+    r.status_code = status_code
+    return r
+
+
+def auth_response(n=0, **kwargs):
+    values = dict(
+        me='http://user{}.example/'.format(n),
+        micropub_endpoint='http://user{}.example/micropub'.format(n),
+        access_token='access{}'.format(n), scope='create',
+        refresh_token='refresh{}'.format(n),
+        expires=time.time() + 60,
+        token_endpoint='http://tokens{}.example/token'.format(n % 2))
+    values.update(kwargs)
+    return flask_micropub.AuthResponse(**values)
+
+
+class RefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask('test')
+        self.client = flask_micropub.MicropubClient(
+            self.app, client_id='http://app.example/')
+
+    @mock.patch('requests.Session.post')
+    def test_refresh(self, post_method):
+        post_method.return_value = token_response(
+            access_token='access1', expires_in=3600)
+        auth = auth_response()
+        new = self.client.refresh(auth)
+
+        self.assertIsNone(new.error)
+        self.assertEqual('access1', new.access_token)
+        # the refresh token was not rotated, so it is kept
+        self.assertEqual('refresh0', new.refresh_token)
+        self.assertEqual(auth.me, new.me)
+        self.assertEqual(auth.micropub_endpoint, new.micropub_endpoint)
+        self.assertAlmostEqual(time.time() + 3600, new.expires, delta=5)
+        post_method.assert_called_once_with(
+            'http://tokens0.example/token', data={
+                'grant_type': 'refresh_token',
+                'refresh_token': 'refresh0',
+                'client_id': 'http://app.example/',
+            }, timeout=(5, 10))
+
+    @mock.patch('requests.Session.post')
+    def test_rotated_refresh_token(self, post_method):
+        post_method.return_value = token_response(
+            access_token='access1', refresh_token='refresh1', scope='read')
+        new = self.client.refresh(auth_response(), scope='read')
+        self.assertEqual('refresh1', new.refresh_token)
+        self.assertEqual('read', new.scope)
+        self.assertIsNone(new.expires)
+        self.assertEqual('read', post_method.call_args[1]['data']['scope'])
+
+    @mock.patch('requests.Session.post')
+    def test_refresh_failures(self, post_method):
+        auth = auth_response()
+        self.assertEqual('no_refresh_token', self.client.refresh(
+            auth.replace(refresh_token=None)).error_code)
+
+        post_method.return_value = token_response(
+            400, error='invalid_grant', error_description='revoked')
+        failed = self.client.refresh(auth)
+        self.assertEqual('refresh_failed', failed.error_code)
+        self.assertIn('invalid_grant', failed.error)
+        # the tokens are kept, so the refresh can be retried
+        self.assertEqual('access0', failed.access_token)
+        self.assertEqual('refresh0', failed.refresh_token)
+
+        post_method.return_value = token_response(scope='create')
+        self.assertEqual('missing_access_token',
+                         self.client.refresh(auth).error_code)
+
+        post_method.side_effect = requests.ConnectionError('refused')
+        self.assertEqual('endpoint_unavailable',
+                         self.client.refresh(auth).error_code)
+
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.post')
+    def test_discovers_token_endpoint(self, post_method, get_method):
+        homepage = requests.Response()
+        homepage.url = 'http://user0.example/'
+        homepage.headers['Link'] = \
+            '<http://tokens.example/token>; rel="token_endpoint"'
+        homepage.raw = io.BytesIO()
+        homepage.status_code = 200
+        get_method.return_value = homepage
+        post_method.return_value = token_response(access_token='access1')
+        new = self.client.refresh(auth_response(token_endpoint=None))
+        self.assertEqual('http://tokens.example/token', new.token_endpoint)
+        self.assertEqual('http://tokens.example/token',
+                         post_method.call_args[0][0])
+
+    @mock.patch('requests.Session.post')
+    def test_refresh_batch(self, post_method):
+        lock = threading.Lock()
+        in_flight = []
+        peak = [0]
+
+        def post(url, data, timeout):
+            with lock:
+                in_flight.append(url)
+                peak[0] = max(peak[0], in_flight.count(url))
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(url)
+            if data['refresh_token'] == 'refresh3':
+                return token_response(400, error='invalid_grant')
+            return token_response(
+                access_token=data['refresh_token'].replace('refresh', 'new'))
+        post_method.side_effect = post
+
+        auths = [auth_response(n) for n in range(8)]
+        results = self.client.refresh_batch(auths, max_workers=4,
+                                            max_per_host=2)
+        self.assertEqual(
+            ['new0', 'new1', 'new2', 'access3', 'new4', 'new5', 'new6',
+             'new7'], [r.access_token for r in results])
+        self.assertEqual('refresh_failed', results[3].error_code)
+        self.assertLessEqual(peak[0], 2)
+
+
+class TokenRefreshSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask('test')
+        self.client = flask_micropub.MicropubClient(
+            self.app, client_id='http://app.example/')
+        self.store = {n: auth_response(n, expires=time.time() + 60 * n)
+                      for n in range(5)}
+        self.saved = []
+        self.failed = []
+
+    def load(self, before):
+        return [auth for auth in self.store.values()
+                if auth.expires is not None and auth.expires < before]
+
+    def save(self, old, new):
+        self.saved.append(new.access_token)
+        self.store[int(old.me[11:-9])] = new
+
+    @mock.patch('requests.Session.post')
+    def test_run_once(self, post_method):
+        def post(url, data, timeout):
+            if data['refresh_token'] == 'refresh1':
+                return token_response(400, error='invalid_grant')
+            return token_response(
+                access_token=data['refresh_token'].replace('refresh', 'new'),
+                expires_in=3600)
+        post_method.side_effect = post
+
+        scheduler = flask_micropub.TokenRefreshScheduler(
+            self.client, self.load, self.save,
+            on_error=lambda old, new: self.failed.append(new.error_code),
+            margin=150, batch_size=2)
+        self.assertEqual((2, 1), scheduler.run_once())
+        self.assertEqual(['new0', 'new2'], sorted(self.saved))
+        self.assertEqual(['refresh_failed'], self.failed)
+        self.assertEqual(3, post_method.call_count)
+
+        # refreshed tokens are not due again
+        self.failed = []
+        self.assertEqual((0, 1), scheduler.run_once())
+
+    @mock.patch('requests.Session.post')
+    def test_start_stop(self, post_method):
+        post_method.return_value = token_response(
+            access_token='new', expires_in=3600)
+        scheduler = flask_micropub.TokenRefreshScheduler(
+            self.client, self.load, self.save, margin=0, interval=0.01)
+        scheduler.start()
+        deadline = time.time() + 5
+        while not self.saved and time.time() < deadline:
+            time.sleep(0.01)
+        scheduler.stop()
+        self.assertEqual(['new'], self.saved)
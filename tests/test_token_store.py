@@ -0,0 +1,118 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import flask
+
+import flask_micropub
+
+try:
+    from cryptography.fernet import Fernet
+except ImportError:
+    Fernet = None
+
+
+def auth_response(n, **kwargs):
+    values = dict(
+        me='http://user{}.example/'.format(n),
+        micropub_endpoint='http://micropub{}.example/'.format(n % 2),
+        access_token='access{}'.format(n), scope='create', state='s',
+        refresh_token='refresh{}'.format(n),
+        expires=1000 + n)
+    values.update(kwargs)
+    return flask_micropub.AuthResponse(**values)
+
+
+class SQLiteTokenStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tokens.db')
+        self.store = flask_micropub.SQLiteTokenStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_save_and_get(self):
+        auth = auth_response(0)
+        self.store.save(auth)
+        # the state belonged to the login, and is not kept
+        self.assertEqual(auth.replace(state=None),
+                         self.store.get('USER0.example'))
+        self.assertIsNone(self.store.get('http://other.example/'))
+
+        self.store.save(auth.replace(access_token='new'))
+        self.assertEqual(1, len(self.store))
+        self.assertEqual('new', self.store.get(auth.me).access_token)
+
+        self.store.delete('user0.example')
+        self.assertIsNone(self.store.get(auth.me))
+
+    def test_lookups(self):
+        for n in range(6):
+            self.store.save(auth_response(n))
+        self.store.save(auth_response(6, refresh_token=None))
+
+        self.assertEqual(
+            ['access0', 'access2', 'access4', 'access6'],
+            sorted(a.access_token for a in
+                   self.store.for_endpoint('http://micropub0.example/')))
+        self.assertEqual(['access0', 'access1', 'access2'], [
+            a.access_token for a in self.store.expiring(1003)])
+        self.assertEqual(['access0'], [
+            a.access_token for a in self.store.expiring(1003, limit=1)])
+
+        # only tokens that cannot be refreshed are swept
+        self.assertEqual(1, self.store.sweep(2000))
+        self.assertEqual(6, len(self.store))
+        self.assertEqual(0, self.store.sweep())
+
+    def test_configured(self):
+        app = flask.Flask('test')
+        self.assertIsNone(flask_micropub.MicropubClient(app).token_store)
+        app.config['MICROPUB_TOKEN_STORE_PATH'] = self.path
+        client = flask_micropub.MicropubClient(app)
+        self.assertIsInstance(client.token_store,
+                              flask_micropub.SQLiteTokenStore)
+        client.token_store.close()
+
+    def test_indexed(self):
+        db = sqlite3.connect(self.path)
+        for query, args in (
+                ('SELECT auth FROM tokens WHERE me = ?', ('x',)),
+                ('SELECT auth FROM tokens WHERE micropub_endpoint = ?',
+                 ('x',)),
+                ('SELECT auth FROM tokens WHERE refreshable = 1 AND '
+                 'expires < ? ORDER BY expires', (1,)),
+                ('DELETE FROM tokens WHERE refreshable = 0 AND expires < ?',
+                 (1,))):
+            plan = ' '.join(row[-1] for row in db.execute(
+                'EXPLAIN QUERY PLAN ' + query, args))
+            self.assertIn('USING', plan, query)
+            self.assertNotIn('TEMP B-TREE', plan, query)
+        db.close()
+
+    @unittest.skipIf(Fernet is None, 'requires cryptography')
+    def test_encrypted(self):
+        old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+        store = flask_micropub.SQLiteTokenStore(self.path, key=old_key)
+        store.save(auth_response(0, expires=time.time() + 60))
+        store.close()
+
+        raw = sqlite3.connect(self.path)
+        blob = raw.execute('SELECT auth FROM tokens').fetchone()[0]
+        raw.close()
+        self.assertNotIn(b'refresh0', bytes(blob))
+
+        # rotating keys: saved tokens can still be read with the old one
+        store = flask_micropub.SQLiteTokenStore(
+            self.path, key=[new_key, old_key])
+        self.assertEqual('access0', store.get('user0.example').access_token)
+        store.close()
@@ -0,0 +1,115 @@
+# coding=utf-8
+from __future__ import unicode_literals, print_function
+
+import json
+import unittest
+
+import flask
+import requests
+
+import flask_micropub
+
+try:
+    from unittest import mock
+except:
+    import mock
+
+
+def verification(status_code=200, **data):
+    r = requests.Response()
+    r.headers['Content-Type'] = 'application/json'
+    r._content = json.dumps(data).encode('utf-8')
+    r.status_code = status_code
+    return r
+
+
+class VerifyTokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask('test')
+        self.app.config['MICROPUB_ME'] = 'http://foo.bar/'
+        self.app.config['MICROPUB_TOKEN_ENDPOINT'] = 'http://baz.bux/token'
+        self.client = flask_micropub.MicropubClient(self.app)
+
+        @self.app.route('/micropub', methods=['POST'])
+        @self.client.token_required(scope='create')
+        def micropub():
+            token = flask.g.micropub_token
+            return json.dumps([token.me, token.client_id, token.cached])
+
+    def post(self, token):
+        with self.app.test_client() as test_client:
+            return test_client.post('/micropub', headers={
+                'Authorization': 'Bearer ' + token})
+
+    @mock.patch('requests.Session.get')
+    def test_verification_is_cached(self, get_method):
+        get_method.return_value = verification(
+            me='http://foo.bar/', client_id='http://app.example/',
+            scope='create update')
+        first = self.post('abc')
+        second = self.post('abc')
+        self.assertEqual(['http://foo.bar/', 'http://app.example/', False],
+                         json.loads(first.get_data(as_text=True)))
+        self.assertEqual(['http://foo.bar/', 'http://app.example/', True],
+                         json.loads(second.get_data(as_text=True)))
+        get_method.assert_called_once_with(
+            'http://baz.bux/token', headers={
+                'Authorization': 'Bearer abc', 'Accept': 'application/json'},
+            timeout=(5, 10))
+
+    @mock.patch('requests.Session.get')
+    def test_rejected_token_is_not_cached(self, get_method):
+        get_method.return_value = verification(
+            400, error='invalid_request', error_description='bad token')
+        resp = self.post('abc')
+        self.assertEqual(401, resp.status_code)
+        self.assertEqual({'error': 'unauthorized', 'error_description': 'bad token'},
+                         json.loads(resp.get_data(as_text=True)))
+        self.post('abc')
+        self.assertEqual(2, get_method.call_count)
+
+    @mock.patch('requests.Session.get')
+    def test_scope_and_owner(self, get_method):
+        get_method.return_value = verification(me='http://foo.bar/', scope='read')
+        resp = self.post('abc')
+        self.assertEqual(401, resp.status_code)
+        self.assertEqual('insufficient_scope',
+                         json.loads(resp.get_data(as_text=True))['error'])
+
+        get_method.return_value = verification(me='http://other.example/', scope='create')
+        resp = self.post('def')
+        self.assertEqual(403, resp.status_code)
+
+    @mock.patch('requests.Session.get')
+    def test_expiry_bounds_cache(self, get_method):
+        get_method.return_value = verification(
+            me='http://foo.bar/', scope='create', expires_in=0)
+        self.assertEqual(401, self.post('abc').status_code)
+
+        get_method.return_value = verification(
+            me='http://foo.bar/', scope='create', expires_in=60)
+        with self.app.test_request_context():
+            info = self.client.verify_token('def')
+        self.assertLessEqual(
+            self.client.token_cache.get(flask_micropub.token_key('def'))[1],
+            info.expires)
+
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_revoke(self, get_method, post_method):
+        get_method.return_value = verification(me='http://foo.bar/', scope='create')
+        post_method.return_value = verification()
+        self.post('abc')
+        self.assertTrue(self.client.revoke_token('abc'))
+        post_method.assert_called_once_with(
+            'http://baz.bux/token', data={'action': 'revoke', 'token': 'abc'},
+            timeout=(5, 10))
+        self.post('abc')
+        self.assertEqual(2, get_method.call_count)
+
+    def test_missing_token(self):
+        with self.app.test_client() as test_client:
+            resp = test_client.post('/micropub')
+        self.assertEqual(401, resp.status_code)
+        self.assertEqual('Bearer', resp.headers['WWW-Authenticate'])